@@ -0,0 +1,224 @@
+import itertools
+import math
+import os
+import threading
+import time
+
+from ai_server.metrics import get_logger, inc, observe, registry as metrics_registry
+
+log = get_logger("admission")
+
+# Số request được xử lý đồng thời (0 = tắt admission control)
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "16"))
+# Số request tối đa được chờ slot; đầy thì request ưu tiên thấp nhất bị loại
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+# Hệ số EWMA cho thời gian giữ slot (dùng để ước lượng thời gian chờ)
+ADMISSION_EWMA_ALPHA = float(os.getenv("ADMISSION_EWMA_ALPHA", "0.2"))
+# Ước lượng ban đầu khi chưa có request nào hoàn tất (ms)
+ADMISSION_INITIAL_SERVICE_MS = float(os.getenv("ADMISSION_INITIAL_SERVICE_MS", "200"))
+
+# Mức ưu tiên: số nhỏ hơn được phục vụ trước
+PRIORITY_UPLOAD = 0
+PRIORITY_TEST = 1
+PRIORITY_NAMES = {PRIORITY_UPLOAD: "upload", PRIORITY_TEST: "test"}
+
+# Thời gian chờ tối đa chấp nhận được theo mức ưu tiên (ms): frame quét real-time
+# cũ vài trăm ms là vô ích, còn ảnh /upload vẫn đáng chờ lâu hơn
+ADMISSION_DEADLINES_MS = {
+    PRIORITY_UPLOAD: float(os.getenv("ADMISSION_DEADLINE_UPLOAD_MS", "10000")),
+    PRIORITY_TEST: float(os.getenv("ADMISSION_DEADLINE_TEST_MS", "500")),
+}
+
+admission_shed = metrics_registry.counter(
+    "waste_admission_shed_total", "Request bị từ chối (429) theo lý do", ("priority", "reason"))
+admission_wait_seconds = metrics_registry.histogram(
+    "waste_admission_wait_seconds", "Thời gian chờ slot trước khi được xử lý", ("priority",),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+
+class Overloaded(Exception):
+    """Request bị từ chối để giữ độ trễ ổn định; retry_after tính bằng giây."""
+
+    def __init__(self, retry_after, reason):
+        super().__init__(f"Server đang quá tải ({reason}), thử lại sau {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "event", "granted", "evicted")
+
+    def __init__(self, priority, seq):
+        self.priority = priority
+        self.seq = seq
+        self.event = threading.Event()
+        self.granted = False
+        self.evicted = False
+
+
+# ==========================================================
+# 🚦 ADMISSION CONTROL
+# ==========================================================
+class AdmissionController:
+    """
+    Giới hạn số request xử lý đồng thời, xếp hàng phần còn lại theo mức ưu
+    tiên (cùng mức thì FIFO) và loại sớm bằng 429 + Retry-After khi thời gian
+    chờ ước lượng vượt deadline của request.
+
+    Thời gian chờ ước lượng = (số request đứng trước + 1) × EWMA thời gian
+    giữ slot / số slot. Khi hàng đợi đầy, request mới có ưu tiên cao hơn đẩy
+    request ưu tiên thấp nhất (mới nhất) ra khỏi hàng.
+    """
+
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_queue=ADMISSION_MAX_QUEUE,
+                 deadlines_ms=None, alpha=ADMISSION_EWMA_ALPHA, initial_service_ms=ADMISSION_INITIAL_SERVICE_MS):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_queue = max(0, int(max_queue))
+        self.deadlines_ms = dict(deadlines_ms or ADMISSION_DEADLINES_MS)
+        self.alpha = alpha
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._service_ms = float(initial_service_ms)
+
+        self._admitted = {}
+        self._shed = {}
+        self._total_wait_ms = {}
+
+    # ------------------------------------------------------
+    def _estimate_wait_ms(self, priority):
+        """Thời gian chờ ước lượng cho request mới ở mức `priority` (gọi khi giữ lock)."""
+        ahead = sum(1 for w in self._waiters if w.priority <= priority)
+        if self._in_flight < self.max_in_flight and ahead == 0:
+            return 0.0
+        return (ahead + 1) * self._service_ms / self.max_in_flight
+
+    def _retry_after(self, wait_ms):
+        return max(1, math.ceil(wait_ms / 1000))
+
+    def _record_shed(self, priority, reason):
+        # gọi khi giữ lock
+        key = (PRIORITY_NAMES.get(priority, str(priority)), reason)
+        self._shed[key] = self._shed.get(key, 0) + 1
+        inc(admission_shed, priority=key[0], reason=reason)
+
+    def acquire(self, priority, deadline_ms=None):
+        """Chờ tới khi có slot; raise Overloaded nếu không kịp deadline. Trả về thời điểm bắt đầu giữ slot."""
+        deadline_ms = self.deadlines_ms.get(priority) if deadline_ms is None else deadline_ms
+        started = time.monotonic()
+
+        with self._lock:
+            estimate = self._estimate_wait_ms(priority)
+            if estimate == 0.0:
+                self._in_flight += 1
+                self._record_admit(priority, 0.0)
+                return time.monotonic()
+
+            if deadline_ms is not None and estimate > deadline_ms:
+                self._record_shed(priority, "deadline")
+                raise Overloaded(self._retry_after(estimate), "deadline")
+
+            if len(self._waiters) >= self.max_queue:
+                victim = max(self._waiters, key=lambda w: (w.priority, w.seq), default=None)
+                if victim is None or victim.priority <= priority:
+                    self._record_shed(priority, "queue_full")
+                    raise Overloaded(self._retry_after(estimate), "queue_full")
+                # Đẩy request ưu tiên thấp hơn ra để nhường chỗ
+                self._waiters.remove(victim)
+                victim.evicted = True
+                victim.event.set()
+
+            waiter = _Waiter(priority, next(self._seq))
+            self._waiters.append(waiter)
+
+        timeout = deadline_ms / 1000 if deadline_ms is not None else None
+        waiter.event.wait(timeout)
+
+        with self._lock:
+            if waiter.granted:
+                self._record_admit(priority, (time.monotonic() - started) * 1000)
+                return time.monotonic()
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            reason = "evicted" if waiter.evicted else "timeout"
+            self._record_shed(priority, reason)
+            raise Overloaded(self._retry_after(self._estimate_wait_ms(priority)), reason)
+
+    def _record_admit(self, priority, wait_ms):
+        # gọi khi giữ lock
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        self._admitted[name] = self._admitted.get(name, 0) + 1
+        self._total_wait_ms[name] = self._total_wait_ms.get(name, 0.0) + wait_ms
+        observe(admission_wait_seconds, wait_ms / 1000, priority=name)
+
+    def release(self, held_since):
+        """Trả slot, cập nhật EWMA thời gian xử lý và trao slot cho request ưu tiên nhất đang chờ."""
+        held_ms = (time.monotonic() - held_since) * 1000
+        with self._lock:
+            self._service_ms += self.alpha * (held_ms - self._service_ms)
+            if self._waiters:
+                waiter = min(self._waiters, key=lambda w: (w.priority, w.seq))
+                self._waiters.remove(waiter)
+                # Slot chuyển thẳng cho waiter, _in_flight giữ nguyên
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self._in_flight -= 1
+
+    def slot(self, priority, deadline_ms=None):
+        """with controller.slot(PRIORITY_UPLOAD): ... (raise Overloaded nếu bị loại)."""
+        return _Slot(self, priority, deadline_ms)
+
+    # ------------------------------------------------------
+    def queue_lengths(self):
+        with self._lock:
+            lengths = {name: 0 for name in PRIORITY_NAMES.values()}
+            for w in self._waiters:
+                name = PRIORITY_NAMES.get(w.priority, str(w.priority))
+                lengths[name] = lengths.get(name, 0) + 1
+            return lengths
+
+    def stats(self):
+        queued = self.queue_lengths()
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "queued": queued,
+                "service_ms_ewma": round(self._service_ms, 1),
+                "deadlines_ms": {PRIORITY_NAMES.get(p, str(p)): d for p, d in self.deadlines_ms.items()},
+                "admitted": dict(self._admitted),
+                "avg_wait_ms": {
+                    name: round(self._total_wait_ms[name] / n, 2) for name, n in self._admitted.items() if n
+                },
+                "shed": {f"{name}:{reason}": n for (name, reason), n in self._shed.items()},
+                "shed_total": sum(self._shed.values()),
+            }
+
+
+class _Slot:
+    __slots__ = ("controller", "priority", "deadline_ms", "held_since")
+
+    def __init__(self, controller, priority, deadline_ms):
+        self.controller = controller
+        self.priority = priority
+        self.deadline_ms = deadline_ms
+
+    def __enter__(self):
+        self.held_since = self.controller.acquire(self.priority, self.deadline_ms)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.controller.release(self.held_since)
+        return False
+
+
+admission = AdmissionController() if ADMISSION_MAX_IN_FLIGHT > 0 else None
+
+if admission is not None:
+    metrics_registry.gauge("waste_admission_queue_length", "Số request đang chờ slot", admission.queue_lengths, label="priority")
+    metrics_registry.gauge("waste_admission_in_flight", "Số request đang giữ slot", lambda: admission.stats()["in_flight"])
+    log.info(f"🚦 Admission control: {admission.max_in_flight} request đồng thời, hàng đợi {admission.max_queue}")
@@ -0,0 +1,211 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from ai_server.metrics import get_logger
+
+log = get_logger("backends")
+
+# Ép một backend cho mọi mô hình (bỏ trống → dùng cột ai_models.backend)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "").strip().lower()
+# Thư mục lưu bản export, mỗi file trọng số một thư mục con theo hash nội dung
+BACKEND_CACHE_DIR = os.getenv(
+    "BACKEND_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "weights", ".cache")
+)
+# Kích thước ảnh lớn nhất khi export (export dynamic nên các profile nhỏ hơn vẫn chạy được)
+BACKEND_EXPORT_IMGSZ = int(os.getenv("BACKEND_EXPORT_IMGSZ", "640"))
+# Kiểm tra kết quả bản export so với PyTorch trước khi dùng
+BACKEND_PARITY_CHECK = os.getenv("BACKEND_PARITY_CHECK", "1") == "1"
+# Ảnh dùng để so sánh (glob); bỏ trống → ảnh val/train trong thư mục huấn luyện của mô hình
+BACKEND_PARITY_IMAGES = os.getenv("BACKEND_PARITY_IMAGES", "")
+BACKEND_PARITY_MAX_IMAGES = int(os.getenv("BACKEND_PARITY_MAX_IMAGES", "4"))
+# Tỉ lệ box khớp tối thiểu, IoU tối thiểu và chênh lệch confidence tối đa để coi là khớp
+BACKEND_PARITY_MIN_MATCH = float(os.getenv("BACKEND_PARITY_MIN_MATCH", "0.95"))
+BACKEND_PARITY_MIN_IOU = float(os.getenv("BACKEND_PARITY_MIN_IOU", "0.9"))
+BACKEND_PARITY_MAX_CONF_DIFF = float(os.getenv("BACKEND_PARITY_MAX_CONF_DIFF", "0.05"))
+
+PYTORCH = "pytorch"
+ONNX = "onnx"
+ONNX_INT8 = "onnx_int8"
+OPENVINO = "openvino"
+BACKENDS = (PYTORCH, ONNX, ONNX_INT8, OPENVINO)
+
+_export_lock = threading.Lock()
+_hash_cache = {}
+
+
+def resolve_backend(info):
+    """Backend cho một bản ghi ai_models: INFERENCE_BACKEND > cột backend > pytorch."""
+    backend = INFERENCE_BACKEND or (info.get("backend") or PYTORCH).strip().lower()
+    if backend not in BACKENDS:
+        log.warning(f"⚠️ Backend '{backend}' không hợp lệ cho mô hình {info.get('name')}, dùng {PYTORCH}")
+        return PYTORCH
+    return backend
+
+def weights_hash(path):
+    """sha256 của file trọng số (cache theo đường dẫn + mtime để không đọc lại file)."""
+    key = (path, os.path.getmtime(path))
+    digest = _hash_cache.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        _hash_cache[key] = digest
+    return digest
+
+
+# ==========================================================
+# 📦 EXPORT TRỌNG SỐ SANG RUNTIME CPU
+# ==========================================================
+def _export(path, backend, target_dir):
+    """Export best.pt vào target_dir; trả về đường dẫn mô hình mà YOLO(...) nạp được."""
+    from ultralytics import YOLO
+
+    os.makedirs(target_dir, exist_ok=True)
+    # Chép trọng số vào thư mục cache để file export nằm cạnh nó, không ghi vào weights/
+    local_pt = os.path.join(target_dir, "model.pt")
+    shutil.copyfile(path, local_pt)
+    model = YOLO(local_pt)
+
+    if backend == OPENVINO:
+        exported = model.export(format="openvino", imgsz=BACKEND_EXPORT_IMGSZ, dynamic=True, half=False)
+    else:
+        exported = model.export(format="onnx", imgsz=BACKEND_EXPORT_IMGSZ, dynamic=True, simplify=True)
+
+    if backend == ONNX_INT8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized = os.path.join(target_dir, "model_int8.onnx")
+        quantize_dynamic(exported, quantized, weight_type=QuantType.QUInt8)
+        exported = quantized
+
+    return str(exported)
+
+def _parity_images(path):
+    if BACKEND_PARITY_IMAGES:
+        files = sorted(glob.glob(BACKEND_PARITY_IMAGES))
+    else:
+        # weights/<run>/weights/best.pt → ảnh val/train trong weights/<run>/
+        run_dir = os.path.dirname(os.path.dirname(path))
+        files = sorted(glob.glob(os.path.join(run_dir, "val_batch*_labels.jpg")))
+        files += sorted(glob.glob(os.path.join(run_dir, "train_batch*.jpg")))
+    return files[:BACKEND_PARITY_MAX_IMAGES]
+
+def _iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+def _boxes(result):
+    if result.boxes is None:
+        return []
+    return list(zip(result.boxes.xyxy.tolist(), result.boxes.conf.tolist(), result.boxes.cls.tolist()))
+
+def check_parity(reference_path, runtime_path, images):
+    """
+    So sánh box của bản export với PyTorch trên cùng ảnh: mỗi box tham chiếu
+    phải có box cùng lớp với IoU và confidence đủ gần. Trả về báo cáo dict.
+    """
+    from ultralytics import YOLO
+
+    reference = YOLO(reference_path)
+    runtime = YOLO(runtime_path, task="detect")
+    kwargs = {"imgsz": BACKEND_EXPORT_IMGSZ, "verbose": False}
+
+    total, matched = 0, 0
+    ref_ms, run_ms = 0.0, 0.0
+    for image in images:
+        started = time.perf_counter()
+        expected = _boxes(reference.predict(image, **kwargs)[0])
+        ref_ms += (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        actual = _boxes(runtime.predict(image, **kwargs)[0])
+        run_ms += (time.perf_counter() - started) * 1000
+
+        total += max(len(expected), len(actual))
+        used = set()
+        for box, conf, cls in expected:
+            for i, (other, other_conf, other_cls) in enumerate(actual):
+                if i in used or other_cls != cls:
+                    continue
+                if _iou(box, other) >= BACKEND_PARITY_MIN_IOU and abs(conf - other_conf) <= BACKEND_PARITY_MAX_CONF_DIFF:
+                    used.add(i)
+                    matched += 1
+                    break
+
+    match_ratio = matched / total if total else 1.0
+    count = max(1, len(images))
+    return {
+        "images": len(images),
+        "boxes": total,
+        "matched": matched,
+        "match_ratio": round(match_ratio, 4),
+        "passed": match_ratio >= BACKEND_PARITY_MIN_MATCH,
+        "pytorch_ms_per_image": round(ref_ms / count, 1),
+        "runtime_ms_per_image": round(run_ms / count, 1),
+    }
+
+def prepare_runtime(info, path):
+    """
+    Trả về (backend, runtime_path) cho mô hình: với backend khác pytorch,
+    export một lần (cache theo hash trọng số) và kiểm tra parity; nếu export
+    hoặc parity lỗi thì quay về trọng số PyTorch gốc.
+    """
+    backend = resolve_backend(info)
+    if backend == PYTORCH:
+        return PYTORCH, path
+
+    target_dir = os.path.join(BACKEND_CACHE_DIR, weights_hash(path), backend)
+    manifest_path = os.path.join(target_dir, "manifest.json")
+
+    with _export_lock:
+        try:
+            if os.path.exists(manifest_path):
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            else:
+                started = time.perf_counter()
+                runtime_path = _export(path, backend, target_dir)
+                manifest = {
+                    "backend": backend,
+                    "source": path,
+                    "runtime_path": os.path.relpath(runtime_path, target_dir),
+                    "export_ms": round((time.perf_counter() - started) * 1000),
+                    "parity": None,
+                }
+                if BACKEND_PARITY_CHECK:
+                    images = _parity_images(path)
+                    if images:
+                        manifest["parity"] = check_parity(path, runtime_path, images)
+                    else:
+                        log.warning("⚠️ Không có ảnh để kiểm tra parity, bỏ qua bước so sánh")
+                with open(manifest_path, "w", encoding="utf-8") as f:
+                    json.dump(manifest, f, ensure_ascii=False, indent=2)
+                log.info(f"📦 Đã export {info['name']} sang {backend} trong {manifest['export_ms']} ms")
+        except Exception as e:
+            log.error(f"❌ Không export được {info['name']} sang {backend}, dùng PyTorch: {e}")
+            return PYTORCH, path
+
+    parity = manifest.get("parity")
+    if parity is not None and not parity["passed"]:
+        log.warning(f"⚠️ {backend} lệch kết quả so với PyTorch (khớp {parity['match_ratio']:.0%}), dùng PyTorch")
+        return PYTORCH, path
+    if parity is not None:
+        log.info(f"⚡ {backend}: {parity['runtime_ms_per_image']} ms/ảnh (PyTorch {parity['pytorch_ms_per_image']} ms/ảnh)")
+
+    return backend, os.path.join(target_dir, manifest["runtime_path"])
+
+def load_runtime(backend, runtime_path):
+    """Nạp mô hình cho backend đã chọn (YOLO tự chọn ONNX Runtime/OpenVINO theo định dạng)."""
+    from ultralytics import YOLO
+
+    if backend == PYTORCH:
+        return YOLO(runtime_path)
+    return YOLO(runtime_path, task="detect")
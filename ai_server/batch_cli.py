@@ -0,0 +1,421 @@
+"""
+Phân loại hàng loạt và chấm lại (re-score) ảnh ngoài luồng Flask.
+
+Ví dụ:
+    # Phân loại cả thư mục / file zip / tar cho một user, lưu vào Supabase
+    python -m ai_server.batch_cli classify ./anh_cu --user-id <uuid>
+    python -m ai_server.batch_cli classify backlog.tar.gz --user-id <uuid> --upload
+
+    # Chấm lại lịch sử bằng mô hình đang active (predictions mới gắn model_id mới)
+    python -m ai_server.batch_cli rescore --since-image-id 0
+
+    # So sánh mô hình mà không ghi database
+    python -m ai_server.batch_cli classify ./val --dry-run --output val_yolov8m.jsonl
+
+Tiến độ được ghi vào file checkpoint sau mỗi batch; chạy lại cùng lệnh sẽ
+tiếp tục từ chỗ đã dừng (dùng --restart để chạy lại từ đầu).
+"""
+import argparse
+import io
+import json
+import mimetypes
+import os
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+BATCH_CLI_BATCH_SIZE = int(os.getenv("BATCH_CLI_BATCH_SIZE", "16"))
+BATCH_CLI_WORKERS = int(os.getenv("BATCH_CLI_WORKERS", "2"))
+BATCH_CLI_REPORT_SECONDS = float(os.getenv("BATCH_CLI_REPORT_SECONDS", "10"))
+BATCH_CLI_FETCH_TIMEOUT = float(os.getenv("BATCH_CLI_FETCH_TIMEOUT", "30"))
+
+
+# ==========================================================
+# 📂 ĐỌC ẢNH TỪ THƯ MỤC / ZIP / TAR (STREAMING)
+# ==========================================================
+def _is_image(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+def iter_source(source):
+    """Sinh (key, filename, bytes) theo thứ tự cố định, không giải nén cả archive ra đĩa."""
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if _is_image(name):
+                    path = os.path.join(root, name)
+                    with open(path, "rb") as f:
+                        yield os.path.relpath(path, source), name, f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in sorted(archive.infolist(), key=lambda i: i.filename):
+                if not info.is_dir() and _is_image(info.filename):
+                    yield info.filename, os.path.basename(info.filename), archive.read(info)
+    elif tarfile.is_tarfile(source):
+        # Chế độ stream "r|*": đọc tuần tự, hợp với archive rất lớn
+        with tarfile.open(source, "r|*") as archive:
+            for member in archive:
+                if member.isfile() and _is_image(member.name):
+                    yield member.name, os.path.basename(member.name), archive.extractfile(member).read()
+    else:
+        raise ValueError(f"❌ Nguồn ảnh không hợp lệ (cần thư mục, .zip hoặc .tar*): {source}")
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ==========================================================
+# 📍 CHECKPOINT + THỐNG KÊ
+# ==========================================================
+class Checkpoint:
+    """Lưu vị trí đã xử lý xong (liên tục) để chạy lại không làm lại việc cũ."""
+
+    def __init__(self, path, mode, source, restart=False):
+        self.path = path
+        self.state = {"mode": mode, "source": source, "position": None,
+                      "processed": 0, "predictions": 0, "failed": 0}
+        if path and os.path.exists(path) and not restart:
+            with open(path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("mode") != mode or saved.get("source") != source:
+                raise ValueError(f"❌ Checkpoint {path} thuộc lệnh khác ({saved.get('mode')} {saved.get('source')}), dùng --restart")
+            self.state.update(saved)
+            print(f"📍 Tiếp tục từ checkpoint: vị trí {self.state['position']}, đã xử lý {self.state['processed']} ảnh")
+
+    @property
+    def position(self):
+        return self.state["position"]
+
+    def advance(self, position, processed, predictions, failed):
+        self.state["position"] = position
+        self.state["processed"] += processed
+        self.state["predictions"] += predictions
+        self.state["failed"] += failed
+        self.state["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        if self.path:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.state, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.path)
+
+
+class Progress:
+    """Đếm ảnh đã xử lý và in throughput (ảnh/giây) định kỳ."""
+
+    def __init__(self, report_seconds=BATCH_CLI_REPORT_SECONDS):
+        self.report_seconds = report_seconds
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.last_count = 0
+        self.count = 0
+        self.predictions = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, images, predictions, failed):
+        with self._lock:
+            self.count += images
+            self.predictions += predictions
+            self.failed += failed
+            now = time.monotonic()
+            if now - self.last_report >= self.report_seconds:
+                window = (self.count - self.last_count) / (now - self.last_report)
+                print(f"📈 {self.count} ảnh | {window:.1f} ảnh/giây (gần đây) | {self.rate():.1f} ảnh/giây (trung bình) | lỗi {self.failed}")
+                self.last_report, self.last_count = now, self.count
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "images": self.count,
+            "predictions": self.predictions,
+            "failed": self.failed,
+            "seconds": round(elapsed, 1),
+            "images_per_sec": round(self.rate(), 2),
+        }
+
+
+def _run_pipeline(batches, process_batch, checkpoint, progress, workers):
+    """
+    Chạy process_batch cho nhiều batch song song (tối đa `workers` batch cùng lúc).
+    Checkpoint chỉ tiến tới khi mọi batch phía trước đã xong, để dừng giữa chừng
+    không bỏ sót ảnh nào.
+    """
+    workers = max(1, workers)
+    pending = {}
+    finished = {}
+    next_index = 0
+    index = 0
+
+    def _commit():
+        nonlocal next_index
+        while next_index in finished:
+            position, images, predictions, failed = finished.pop(next_index)
+            checkpoint.advance(position, images, predictions, failed)
+            next_index += 1
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-cli") as executor:
+        for position, batch in batches:
+            while len(pending) >= workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished[pending.pop(future)] = future.result()
+                _commit()
+            future = executor.submit(lambda b=batch, p=position: (p, *process_batch(b)))
+            pending[future] = index
+            index += 1
+
+        for future in list(pending):
+            finished[pending.pop(future)] = future.result()
+        _commit()
+
+
+def _predict(images, profile):
+    """Giải mã + inference một batch; trả về (predictions theo ảnh, số ảnh lỗi)."""
+    from ai_server.ingest import IngestedImage
+    from ai_server.inference import predict_batch
+
+    arrays, index = [], []
+    for i, (filename, data) in enumerate(images):
+        try:
+            arrays.append(IngestedImage(filename, None, data=data).array)
+            index.append(i)
+        except ValueError as e:
+            print(f"⚠️ Bỏ qua {filename}: {e}")
+
+    results = [None] * len(images)
+    if arrays:
+        for i, predictions in zip(index, predict_batch(arrays, profile)):
+            results[i] = predictions
+    return results, len(images) - len(arrays)
+
+
+# ==========================================================
+# 🗂️ PHÂN LOẠI HÀNG LOẠT
+# ==========================================================
+def classify_command(args):
+    from ai_server.model_manager import get_active_model
+    from ai_server.persistence import build_item, finalize_items
+    from ai_server.supabase_utils import create_image_records
+
+    if not args.dry_run and not args.user_id:
+        raise ValueError("❌ Cần --user-id để lưu ảnh vào Supabase (hoặc dùng --dry-run)")
+
+    loaded = get_active_model()
+    print(f"🤖 Mô hình: {loaded.info['name']} (model_id={loaded.model_id}, {loaded.backend})")
+
+    source = os.path.abspath(args.source)
+    checkpoint = Checkpoint(args.checkpoint, "classify", source, args.restart)
+    progress = Progress()
+    skip = checkpoint.position or 0
+    output = open(args.output, "a", encoding="utf-8") if args.output else None
+    output_lock = threading.Lock()
+    pool = None
+    if args.upload and not args.dry_run:
+        from ai_server.storage import get_upload_pool
+
+        pool = get_upload_pool()
+
+    def batches():
+        offset = 0
+        for batch in _batched(iter_source(source), args.batch_size):
+            offset += len(batch)
+            if offset <= skip:
+                continue
+            # Batch bị cắt ngang bởi checkpoint: bỏ phần đã làm
+            yield offset, batch[max(0, len(batch) - (offset - skip)):]
+
+    def process(batch):
+        results, failed = _predict([(name, data) for _, name, data in batch], args.profile)
+        done = [(item, preds) for item, preds in zip(batch, results) if preds is not None]
+
+        if output is not None:
+            with output_lock:
+                for (key, _, _), preds in done:
+                    output.write(json.dumps({"key": key, "model_id": loaded.model_id, "predictions": preds}, ensure_ascii=False) + "\n")
+                output.flush()
+
+        if not args.dry_run and done:
+            if pool is not None:
+                paths = [
+                    pool.upload_fileobj(io.BytesIO(data), name, args.folder_id,
+                                        mimetypes.guess_type(name)[0], len(data))
+                    for (_, name, data), _ in done
+                ]
+            else:
+                paths = [f"{os.path.basename(source)}:{key}" for (key, _, _), _ in done]
+            image_ids = create_image_records(args.user_id, paths, status="processing")
+            finalize_items([
+                build_item(image_id, preds, "done", None)
+                for image_id, (_, preds) in zip(image_ids, done)
+            ])
+
+        count = sum(len(preds) for _, preds in done)
+        progress.add(len(batch), count, failed)
+        return len(batch), count, failed
+
+    try:
+        _run_pipeline(batches(), process, checkpoint, progress, args.workers)
+    finally:
+        if output is not None:
+            output.close()
+    return progress.summary()
+
+
+# ==========================================================
+# 🔁 CHẤM LẠI LỊCH SỬ BẰNG MÔ HÌNH ACTIVE
+# ==========================================================
+def _fetch_image(file_path):
+    """Tải ảnh từ URL (Drive/storage) hoặc đọc file cục bộ."""
+    if file_path.startswith(("http://", "https://")):
+        from ai_server.http_transport import get_session
+
+        response = get_session().get(file_path, timeout=BATCH_CLI_FETCH_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+    if file_path.startswith("file://"):
+        file_path = file_path[len("file://"):]
+    with open(file_path, "rb") as f:
+        return f.read()
+
+def _iter_history(since_image_id, user_id, page_size, limit):
+    from ai_server.supabase_utils import supabase
+
+    last_id, seen = since_image_id, 0
+    while limit is None or seen < limit:
+        query = supabase.table("images").select("image_id, file_path").eq("status", "done").gt("image_id", last_id)
+        if user_id:
+            query = query.eq("user_id", user_id)
+        rows = query.order("image_id").limit(page_size).execute().data or []
+        if not rows:
+            return
+        for row in rows:
+            yield row
+            seen += 1
+            if limit is not None and seen >= limit:
+                return
+        last_id = rows[-1]["image_id"]
+
+def rescore_command(args):
+    from ai_server.model_manager import get_active_model
+    from ai_server.supabase_utils import build_prediction_rows, insert_prediction_rows, supabase
+
+    loaded = get_active_model()
+    model_id = loaded.model_id
+    print(f"🔁 Chấm lại bằng mô hình: {loaded.info['name']} (model_id={model_id}, {loaded.backend})")
+
+    checkpoint = Checkpoint(args.checkpoint, "rescore", f"model:{model_id}:user:{args.user_id or '*'}", args.restart)
+    progress = Progress()
+    start_id = checkpoint.position if checkpoint.position is not None else args.since_image_id
+
+    def batches():
+        for batch in _batched(_iter_history(start_id, args.user_id, max(args.batch_size, 100), args.limit), args.batch_size):
+            yield batch[-1]["image_id"], batch
+
+    def process(batch):
+        image_ids = [row["image_id"] for row in batch]
+        # Ảnh đã có predictions của mô hình này (lần chạy trước) thì bỏ qua
+        scored = supabase.table("predictions").select("image_id").eq("model_id", model_id).in_("image_id", image_ids).execute()
+        already = {row["image_id"] for row in (scored.data or [])}
+        todo = [row for row in batch if row["image_id"] not in already]
+
+        with ThreadPoolExecutor(max_workers=max(1, args.fetch_workers)) as fetcher:
+            fetched = list(fetcher.map(lambda row: _safe_fetch(row), todo))
+        images = [(str(row["image_id"]), data) for row, data in zip(todo, fetched) if data is not None]
+        results, failed = _predict(images, args.profile)
+        failed += len(todo) - len(images)
+
+        scored_ids = [int(image_id) for (image_id, _), preds in zip(images, results) if preds is not None]
+        rows = [
+            row
+            for (image_id, _), preds in zip(images, results) if preds is not None
+            for row in build_prediction_rows(int(image_id), preds)
+        ]
+        if not args.dry_run:
+            if args.replace and scored_ids:
+                # Chỉ giữ predictions của mô hình mới cho các ảnh đã chấm lại
+                supabase.table("predictions").delete().in_("image_id", scored_ids).neq("model_id", model_id).execute()
+            insert_prediction_rows(rows)
+
+        progress.add(len(batch), len(rows), failed)
+        return len(batch), len(rows), failed
+
+    _run_pipeline(batches(), process, checkpoint, progress, args.workers)
+    return progress.summary()
+
+def _safe_fetch(row):
+    try:
+        return _fetch_image(row["file_path"])
+    except Exception as e:
+        print(f"⚠️ Không tải được ảnh {row['image_id']} ({row['file_path']}): {e}")
+        return None
+
+
+# ==========================================================
+# 🚀 CLI
+# ==========================================================
+def build_parser():
+    from ai_server.profiles import DEFAULT_UPLOAD_PROFILE
+
+    parser = argparse.ArgumentParser(prog="python -m ai_server.batch_cli",
+                                     description="Phân loại hàng loạt / chấm lại ảnh bằng mô hình active")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def common(p, checkpoint):
+        p.add_argument("--profile", default=DEFAULT_UPLOAD_PROFILE, help="Profile suy luận (realtime/accurate/...)")
+        p.add_argument("--batch-size", type=int, default=BATCH_CLI_BATCH_SIZE)
+        p.add_argument("--workers", type=int, default=BATCH_CLI_WORKERS, help="Số batch xử lý song song")
+        p.add_argument("--checkpoint", default=checkpoint, help="File checkpoint JSON (rỗng để tắt)")
+        p.add_argument("--restart", action="store_true", help="Bỏ qua checkpoint cũ, chạy lại từ đầu")
+        p.add_argument("--dry-run", action="store_true", help="Chỉ chạy inference, không ghi Supabase")
+
+    classify = sub.add_parser("classify", help="Phân loại ảnh trong thư mục / zip / tar")
+    classify.add_argument("source")
+    classify.add_argument("--user-id", help="User sở hữu các ảnh được tạo")
+    classify.add_argument("--upload", action="store_true", help="Upload ảnh gốc lên storage (Drive/local)")
+    classify.add_argument("--folder-id", default=None, help="Folder Drive đích khi --upload")
+    classify.add_argument("--output", help="Ghi predictions ra file JSONL (để so sánh mô hình)")
+    common(classify, "batch_classify.checkpoint.json")
+
+    rescore = sub.add_parser("rescore", help="Chấm lại ảnh đã xử lý bằng mô hình active")
+    rescore.add_argument("--since-image-id", type=int, default=0)
+    rescore.add_argument("--user-id", help="Chỉ chấm lại ảnh của một user")
+    rescore.add_argument("--limit", type=int, default=None)
+    rescore.add_argument("--fetch-workers", type=int, default=8, help="Số ảnh tải song song trong một batch")
+    rescore.add_argument("--replace", action="store_true", help="Xóa predictions của mô hình cũ sau khi chấm lại")
+    common(rescore, "batch_rescore.checkpoint.json")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.checkpoint = args.checkpoint or None
+    try:
+        if args.command == "classify":
+            summary = classify_command(args)
+        else:
+            summary = rescore_command(args)
+    except ValueError as e:
+        print(e)
+        return 2
+
+    print(f"✅ Xong: {summary['images']} ảnh, {summary['predictions']} predictions, "
+          f"{summary['failed']} lỗi trong {summary['seconds']} giây ({summary['images_per_sec']} ảnh/giây)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
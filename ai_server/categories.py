@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from ai_server.supabase_utils import supabase
+from ai_server.metrics import get_logger
+
+log = get_logger("categories")
+
+# Nếu YOLO trả nhãn tiếng Anh mà DB lưu tiếng Việt, bạn có thể map như sau:
+LABEL_TO_CATEGORY = {
+    "plastic": "Nhựa",
+    "paper": "Giấy",
+    "metal": "Kim loại",
+    "glass": "Thủy tinh",
+    "organic": "Hữu cơ"
+}
+
+# Thời gian (giây) giữ bảng waste_categories trong bộ nhớ trước khi tải lại
+CATEGORY_CACHE_TTL = float(os.getenv("CATEGORY_CACHE_TTL", "300"))
+
+
+# ==========================================================
+# 🗂️ CHỈ MỤC DANH MỤC RÁC TRONG BỘ NHỚ
+# ==========================================================
+class CategoryIndex:
+    """
+    Giữ bảng waste_categories trong bộ nhớ và biên dịch sẵn bảng tra
+    chỉ số lớp của model (model.names) → {category_id, category_name}.
+    Bảng được tải lại khi hết TTL hoặc khi gọi invalidate().
+    """
+
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self._by_name = None
+        self._loaded_at = 0.0
+        self._lookups = {}
+        self._table = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Xóa cache, lần tra cứu tiếp theo sẽ tải lại waste_categories."""
+        with self._lock:
+            self._by_name = None
+            self._lookups = {}
+            self._table = None
+
+    def _categories(self):
+        by_name = self._by_name
+        if by_name is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return by_name
+
+        res = supabase.table("waste_categories").select("category_id, name").execute()
+        by_name = {
+            row["name"]: {"category_id": row["category_id"], "category_name": row["name"]}
+            for row in (res.data or [])
+        }
+        self._by_name = by_name
+        self._loaded_at = time.monotonic()
+        self._lookups = {}
+        self._table = None
+        log.info(f"🗂️ Đã tải {len(by_name)} danh mục rác vào bộ nhớ.")
+        return by_name
+
+    def table(self):
+        """
+        Bảng danh mục [{category_id, name}] theo category_id cùng ETag (hash nội dung),
+        để client cache và response compact chỉ cần gửi category_id.
+        """
+        with self._lock:
+            by_name = self._categories()
+            if self._table is None:
+                rows = sorted(
+                    ({"category_id": c["category_id"], "name": c["category_name"]} for c in by_name.values()),
+                    key=lambda row: row["category_id"],
+                )
+                digest = hashlib.sha1(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+                self._table = (rows, digest)
+            return self._table
+
+    def lookup_for(self, names):
+        """
+        Trả về dict {class_index: category_info} cho model.names.
+        Các lớp không có danh mục tương ứng sẽ không có trong dict.
+        """
+        key = tuple(sorted(names.items())) if isinstance(names, dict) else tuple(enumerate(names))
+        with self._lock:
+            by_name = self._categories()
+            lookup = self._lookups.get(key)
+            if lookup is not None:
+                return lookup
+
+            lookup = {}
+            for idx, label_name in key:
+                category_name = LABEL_TO_CATEGORY.get(label_name, label_name.lower())
+                category_info = by_name.get(category_name)
+                if category_info is None:
+                    log.warning(f"⚠️ Không tìm thấy danh mục '{category_name}' trong bảng waste_categories.")
+                    continue
+                lookup[int(idx)] = category_info
+            self._lookups[key] = lookup
+            return lookup
+
+
+category_index = CategoryIndex()
+
+def get_category_lookup(names):
+    """Bảng tra class_index → category cho model.names (dùng chung toàn process)."""
+    return category_index.lookup_for(names)
+
+def invalidate_category_index():
+    """Gọi sau khi admin sửa bảng waste_categories để tải lại ngay."""
+    category_index.invalidate()
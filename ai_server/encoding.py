@@ -0,0 +1,165 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # msgpack là tùy chọn: thiếu thì định dạng compact dùng JSON
+    msgpack = None
+
+# ==========================================================
+# 📦 ĐỊNH DẠNG RESPONSE PREDICTIONS
+# ==========================================================
+#   json            : mặc định, mỗi box là một object (như trước đây)
+#   compact         : JSON dạng cột - tọa độ nguyên (pixel), confidence ×10000,
+#                     chỉ gửi category_id (tên lấy từ /api/categories, cache được)
+#   msgpack         : cùng cấu trúc compact, mã hóa MessagePack, tọa độ và
+#                     confidence đóng gói thành mảng uint16 little-endian
+JSON = "json"
+COMPACT = "compact"
+MSGPACK = "msgpack"
+
+MEDIA_TYPES = {
+    JSON: "application/json",
+    COMPACT: "application/vnd.waste.compact+json",
+    MSGPACK: "application/vnd.waste.compact+msgpack",
+}
+_ACCEPT_ALIASES = {
+    "application/json": JSON,
+    "application/vnd.waste.compact+json": COMPACT,
+    "application/vnd.waste.compact+msgpack": MSGPACK,
+    "application/msgpack": MSGPACK,
+    "application/x-msgpack": MSGPACK,
+}
+
+COMPACT_VERSION = 1
+CONFIDENCE_SCALE = 10000  # khớp DECIMAL(5,4) của predictions.confidence
+UINT16_MAX = 0xFFFF
+
+
+def _parse_accept(accept):
+    """[(media_type, q)] theo thứ tự q giảm dần (giữ thứ tự gốc khi bằng nhau)."""
+    entries = []
+    for index, part in enumerate((accept or "").split(",")):
+        fields = [f.strip() for f in part.split(";")]
+        if not fields[0]:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        entries.append((-q, index, fields[0].lower()))
+    return [(media, -neg_q) for neg_q, _, media in sorted(entries)]
+
+def available(encoding):
+    return encoding != MSGPACK or msgpack is not None
+
+def negotiate(accept=None, requested=None):
+    """
+    Chọn định dạng response: ?format=json|compact|msgpack được ưu tiên, sau đó
+    tới header Accept. msgpack không cài đặt thì dùng compact (JSON).
+    """
+    requested = (requested or "").strip().lower()
+    if requested in MEDIA_TYPES:
+        return requested if available(requested) else COMPACT
+
+    for media, q in _parse_accept(accept):
+        if q <= 0:
+            continue
+        encoding = _ACCEPT_ALIASES.get(media)
+        if encoding is not None and available(encoding):
+            return encoding
+    return JSON
+
+
+# ==========================================================
+# 🔁 PREDICTIONS ⇄ DẠNG CỘT
+# ==========================================================
+def _clamp_uint16(value):
+    return min(UINT16_MAX, max(0, int(round(value))))
+
+def compact_predictions(predictions, binary=False):
+    """
+    Chuyển list predictions thành dạng cột:
+        {"n", "category_id": [...], "model_id": id hoặc [...],
+         "conf": [...] (×10000), "xyxy": [x1, y1, x2, y2, ...] (pixel nguyên)}
+    Với binary=True, "conf" và "xyxy" là bytes uint16 little-endian.
+    """
+    n = len(predictions)
+    category_ids = [p["category_id"] for p in predictions]
+    model_ids = [p.get("model_id") for p in predictions]
+    conf = [_clamp_uint16(float(p["confidence"]) * CONFIDENCE_SCALE) for p in predictions]
+    xyxy = [_clamp_uint16(v) for p in predictions for v in p["bbox"][:4]]
+
+    # Thường mọi box cùng một mô hình: gửi một giá trị thay vì lặp lại
+    model_id = model_ids[0] if model_ids and all(m == model_ids[0] for m in model_ids) else model_ids
+    if binary:
+        conf = struct.pack(f"<{n}H", *conf)
+        xyxy = struct.pack(f"<{4 * n}H", *xyxy)
+    return {"n": n, "category_id": category_ids, "model_id": model_id, "conf": conf, "xyxy": xyxy}
+
+def expand_predictions(boxes, category_names=None):
+    """Ngược lại của compact_predictions; category_names: {category_id: name} (tùy chọn)."""
+    n = boxes["n"]
+    conf, xyxy = boxes["conf"], boxes["xyxy"]
+    if isinstance(conf, (bytes, bytearray)):
+        conf = struct.unpack(f"<{n}H", conf)
+        xyxy = struct.unpack(f"<{4 * n}H", xyxy)
+    model_id = boxes["model_id"]
+    model_ids = model_id if isinstance(model_id, list) else [model_id] * n
+
+    predictions = []
+    for i in range(n):
+        prediction = {
+            "category_id": boxes["category_id"][i],
+            "model_id": model_ids[i],
+            "confidence": conf[i] / CONFIDENCE_SCALE,
+            "bbox": [float(v) for v in xyxy[4 * i:4 * i + 4]],
+        }
+        if category_names is not None:
+            prediction["category_name"] = category_names.get(prediction["category_id"])
+        predictions.append(prediction)
+    return predictions
+
+
+# ==========================================================
+# ✉️ MÃ HÓA / GIẢI MÃ CẢ RESPONSE
+# ==========================================================
+def compact_payload(payload, binary=False, categories_etag=None):
+    """Thay "predictions" trong payload bằng "boxes" dạng cột (các trường khác giữ nguyên)."""
+    result = {k: v for k, v in payload.items() if k != "predictions"}
+    result["v"] = COMPACT_VERSION
+    result["boxes"] = compact_predictions(payload.get("predictions") or [], binary)
+    if categories_etag is not None:
+        # Client so với ETag của /api/categories để biết khi nào cần tải lại bảng danh mục
+        result["categories_etag"] = categories_etag
+    return result
+
+def encode(payload, encoding=JSON, categories_etag=None):
+    """Trả về (body, content_type); body là str với JSON/compact, bytes với msgpack."""
+    if encoding == MSGPACK:
+        body = msgpack.packb(compact_payload(payload, True, categories_etag), use_bin_type=True)
+        return body, MEDIA_TYPES[MSGPACK]
+    if encoding == COMPACT:
+        body = json.dumps(compact_payload(payload, False, categories_etag), ensure_ascii=False, separators=(",", ":"))
+        return body, MEDIA_TYPES[COMPACT] + "; charset=utf-8"
+    return json.dumps(payload, ensure_ascii=False), MEDIA_TYPES[JSON]
+
+def decode(body, content_type, category_names=None):
+    """Giải mã response về dạng JSON gốc (dùng cho client Python, benchmark và kiểm tra)."""
+    media = (content_type or "").split(";")[0].strip().lower()
+    encoding = _ACCEPT_ALIASES.get(media, JSON)
+    if encoding == MSGPACK:
+        data = msgpack.unpackb(body, raw=False)
+    else:
+        data = json.loads(body)
+    if encoding == JSON:
+        return data
+
+    boxes = data.pop("boxes")
+    data.pop("v", None)
+    data.pop("categories_etag", None)
+    data["predictions"] = expand_predictions(boxes, category_names)
+    return data
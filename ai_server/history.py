@@ -0,0 +1,171 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from ai_server.supabase_utils import supabase, is_missing_function
+from ai_server.metrics import get_logger
+
+log = get_logger("history")
+
+# get_user_history (history_supabase.txt) trả tối đa 101 dòng = 100 ảnh + 1 dòng dò trang sau;
+# hai số này phải đổi cùng nhau
+HISTORY_PAGE_SIZE_LIMIT = 100
+# Số ảnh mỗi trang mặc định / tối đa (không vượt HISTORY_PAGE_SIZE_LIMIT)
+HISTORY_MAX_PAGE_SIZE = min(int(os.getenv("HISTORY_MAX_PAGE_SIZE", "100")), HISTORY_PAGE_SIZE_LIMIT)
+HISTORY_PAGE_SIZE = min(int(os.getenv("HISTORY_PAGE_SIZE", "20")), HISTORY_MAX_PAGE_SIZE)
+# Cache trang lịch sử theo (user, cursor, limit): trong TTL, request có
+# If-None-Match khớp được trả 304 mà không chạm database
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "60"))
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "2048"))
+
+_rpc_available = True
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+# ==========================================================
+# 🔖 CURSOR (created_at, image_id)
+# ==========================================================
+def encode_cursor(created_at, image_id):
+    raw = f"{created_at}|{image_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    """
+    Trả về (created_at, image_id); raise ValueError nếu cursor không hợp lệ.
+    created_at được parse rồi serialize lại, nên chuỗi ghép vào bộ lọc or_()
+    của PostgREST chỉ có thể là một timestamp ISO 8601.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, image_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at).isoformat(), int(image_id)
+    except Exception:
+        raise ValueError("Cursor không hợp lệ")
+
+
+def _category_names(predictions):
+    names = {
+        ((p.get("waste_categories") or {}).get("name") or "").strip()
+        for p in predictions or []
+    }
+    names.discard("")
+    return sorted(names)
+
+
+# ==========================================================
+# 🗂️ ĐỌC MỘT TRANG LỊCH SỬ
+# ==========================================================
+def _fetch_rows_legacy(user_id, before, limit):
+    """Truy vấn PostgREST có embed, chỉ dùng khi chưa tạo get_user_history."""
+    query = supabase.table("images").select(
+        "image_id, created_at, file_path, predictions(waste_categories(name))"
+    ).eq("user_id", user_id).eq("status", "done")
+    if before is not None:
+        created_at, image_id = before
+        query = query.or_(
+            f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",image_id.lt.{image_id})'
+        )
+    res = query.order("created_at", desc=True).order("image_id", desc=True).limit(limit).execute()
+    return [{
+        "image_id": row["image_id"],
+        "created_at": row["created_at"],
+        "file_path": row.get("file_path"),
+        # Cột thumbnail_path có thể chưa tồn tại khi chưa chạy function_finalize_images.txt
+        "thumbnail_path": None,
+        "categories": _category_names(row.get("predictions")),
+    } for row in (res.data or [])]
+
+
+def fetch_history_rows(user_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Đọc tối đa `limit` ảnh đã xử lý xong của user, mới nhất trước, nằm sau
+    `before` = (created_at, image_id). Một RPC (history_supabase.txt) join sẵn
+    tên danh mục nên mỗi ảnh là một dòng gọn.
+    """
+    global _rpc_available
+    if _rpc_available:
+        try:
+            res = supabase.rpc("get_user_history", {
+                "p_user_id": user_id,
+                "p_limit": limit,
+                "p_before_created_at": before[0] if before else None,
+                "p_before_image_id": before[1] if before else None,
+            }).execute()
+            return [{
+                "image_id": row["image_id"],
+                "created_at": row["created_at"],
+                "file_path": row.get("file_path"),
+                "thumbnail_path": row.get("thumbnail_path"),
+                "categories": list(row.get("categories") or []),
+            } for row in (res.data or [])]
+        except Exception as e:
+            if not is_missing_function(e):
+                raise
+            _rpc_available = False
+            log.warning("⚠️ Chưa có hàm get_user_history trong database, dùng truy vấn embed cũ.")
+    return _fetch_rows_legacy(user_id, before, limit)
+
+
+def _build_page(user_id, cursor, limit):
+    before = decode_cursor(cursor) if cursor else None
+    # Lấy dư một dòng để biết còn trang sau hay không
+    rows = fetch_history_rows(user_id, before, limit + 1)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["image_id"])
+    return {"items": rows, "next_cursor": next_cursor}
+
+
+def _etag(page):
+    body = json.dumps(page, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+
+
+def clamp_limit(limit):
+    try:
+        limit = int(limit) if limit not in (None, "") else HISTORY_PAGE_SIZE
+    except (TypeError, ValueError):
+        raise ValueError("limit phải là số nguyên")
+    return min(max(limit, 1), HISTORY_MAX_PAGE_SIZE)
+
+
+def get_history_page(user_id, cursor=None, limit=None):
+    """
+    Một trang lịch sử {"items", "next_cursor"} kèm ETag theo nội dung.
+    Trang đã có trong cache (chưa hết HISTORY_CACHE_TTL, chưa bị invalidate)
+    được trả lại mà không truy vấn database.
+    """
+    limit = clamp_limit(limit)
+    key = (user_id, cursor or "", limit)
+    now = time.monotonic()
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] > now:
+            _cache.move_to_end(key)
+            return entry[1], entry[2]
+
+    page = _build_page(user_id, cursor, limit)
+    etag = _etag(page)
+
+    with _cache_lock:
+        _cache[key] = (time.monotonic() + HISTORY_CACHE_TTL, page, etag)
+        _cache.move_to_end(key)
+        while len(_cache) > HISTORY_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return page, etag
+
+
+def invalidate_user_history(user_id=None):
+    """Xóa mọi trang lịch sử đã cache của một user (hoặc toàn bộ khi user_id=None)."""
+    with _cache_lock:
+        if user_id is None:
+            _cache.clear()
+            return
+        for key in [k for k in _cache if k[0] == user_id]:
+            del _cache[key]
@@ -0,0 +1,258 @@
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ai_server.metrics import get_logger, inc, observe, registry as metrics_registry
+
+log = get_logger("http_transport")
+
+# Số kết nối keep-alive tối đa tới MỖI host; nên >= số thread gọi ra ngoài cùng lúc
+# (thread Flask + STORAGE_UPLOAD_WORKERS + worker job nền)
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+# Số host giữ pool riêng (Supabase REST, Supabase Auth, Google APIs, ...)
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "8"))
+# Hết kết nối trong pool thì chờ (giới hạn cứng theo host) thay vì mở kết nối ngoài pool
+HTTP_POOL_BLOCK = os.getenv("HTTP_POOL_BLOCK", "1") == "1"
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+# Ngân sách retry cho mỗi request (lỗi kết nối; lỗi đọc và 429/5xx chỉ với method đọc)
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.3"))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Chỉ retry method đọc. Mặc định của urllib3 gồm cả PUT/DELETE: chunk upload
+# resumable của Drive (PUT) sẽ bị retry chồng lên num_retries của googleapiclient,
+# vốn tự hỏi lại offset trước khi gửi tiếp.
+RETRY_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+http_requests = metrics_registry.counter(
+    "waste_http_client_requests_total", "Request HTTP gửi ra ngoài", ("host", "result"))
+http_seconds = metrics_registry.histogram(
+    "waste_http_client_duration_seconds", "Thời gian request HTTP gửi ra ngoài", ("host",))
+
+
+# ==========================================================
+# 📊 THỐNG KÊ THEO HOST
+# ==========================================================
+class TransportStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, host):
+        entry = self._hosts.get(host)
+        if entry is None:
+            entry = self._hosts[host] = {"requests": 0, "errors": 0, "in_flight": 0, "total_ms": 0.0}
+        return entry
+
+    def start(self, host):
+        with self._lock:
+            self._host(host)["in_flight"] += 1
+        return time.perf_counter()
+
+    def finish(self, host, started, error=False):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            entry = self._host(host)
+            entry["in_flight"] -= 1
+            entry["requests"] += 1
+            entry["errors"] += int(error)
+            entry["total_ms"] += elapsed * 1000
+        inc(http_requests, host=host, result="error" if error else "ok")
+        observe(http_seconds, elapsed, host=host)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                host: {
+                    "requests": e["requests"],
+                    "errors": e["errors"],
+                    "in_flight": e["in_flight"],
+                    "avg_ms": round(e["total_ms"] / e["requests"], 1) if e["requests"] else 0.0,
+                }
+                for host, e in self._hosts.items()
+            }
+
+    def in_flight(self):
+        with self._lock:
+            return {host: e["in_flight"] for host, e in self._hosts.items()}
+
+
+transport_stats = TransportStats()
+
+
+# ==========================================================
+# 🔌 POOL KẾT NỐI DÙNG CHUNG (requests / urllib3)
+# ==========================================================
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter có timeout mặc định, retry giới hạn và đếm request theo host."""
+
+    def __init__(self):
+        retry = Retry(
+            total=HTTP_RETRIES,
+            connect=HTTP_RETRIES,
+            read=HTTP_RETRIES,
+            status=HTTP_RETRIES,
+            backoff_factor=HTTP_RETRY_BACKOFF,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=RETRY_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        super().__init__(
+            pool_connections=HTTP_POOL_HOSTS,
+            pool_maxsize=HTTP_POOL_MAXSIZE,
+            pool_block=HTTP_POOL_BLOCK,
+            max_retries=retry,
+        )
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        host = urlsplit(request.url).netloc
+        started = transport_stats.start(host)
+        try:
+            response = super().send(request, timeout=timeout, **kwargs)
+        except Exception:
+            transport_stats.finish(host, started, error=True)
+            raise
+        transport_stats.finish(host, started, error=response.status_code >= 500)
+        return response
+
+    def pool_stats(self):
+        """Số kết nối đã mở / request đã gửi / chỗ trống của từng pool urllib3."""
+        pools = {}
+        manager = self.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            opened, sent = pool.num_connections, pool.num_requests
+            pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections_opened": opened,
+                "requests": sent,
+                # Hàng đợi của urllib3 chứa cả kết nối rảnh lẫn chỗ chưa mở kết nối
+                "available": pool.pool.qsize() if pool.pool is not None else 0,
+                "reuse_ratio": round(1 - opened / sent, 3) if sent else 0.0,
+            }
+        return pools
+
+
+_adapter = PooledHTTPAdapter()
+_session = None
+_session_lock = threading.Lock()
+
+def mount_pool(session):
+    """Gắn pool dùng chung vào một Session khác (ví dụ AuthorizedSession của Google)."""
+    session.mount("https://", _adapter)
+    session.mount("http://", _adapter)
+    return session
+
+def get_session():
+    """requests.Session dùng chung cho cả process (pool urllib3 an toàn giữa các thread)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = mount_pool(requests.Session())
+        return _session
+
+
+class RequestsHttp:
+    """
+    Thay cho httplib2.Http trong googleapiclient: gửi request qua một Session
+    dùng pool chung, nên nhiều thread upload Drive dùng lại cùng các kết nối.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        import httplib2
+
+        response = self.session.request(
+            method, uri, data=body, headers=headers, allow_redirects=redirections > 0
+        )
+        info = {k.lower(): v for k, v in response.headers.items()}
+        info["status"] = response.status_code
+        return httplib2.Response(info), response.content
+
+
+# ==========================================================
+# 🔌 POOL HTTPX CHO CLIENT SUPABASE
+# ==========================================================
+_httpx_client = None
+
+def get_httpx_client():
+    """httpx.Client dùng chung (client supabase-py chạy trên httpx) với giới hạn pool và timeout."""
+    global _httpx_client
+    with _session_lock:
+        if _httpx_client is None:
+            import httpx
+
+            class CountingTransport(httpx.HTTPTransport):
+                def handle_request(self, request):
+                    host = request.url.netloc.decode("ascii")
+                    started = transport_stats.start(host)
+                    try:
+                        response = super().handle_request(request)
+                    except Exception:
+                        transport_stats.finish(host, started, error=True)
+                        raise
+                    transport_stats.finish(host, started, error=response.status_code >= 500)
+                    return response
+
+            # httpx.Limits không có giới hạn theo host (chỉ tổng toàn client). Client
+            # này chỉ dùng cho supabase-py, mọi request (REST, Auth, Storage) tới
+            # cùng một host SUPABASE_URL, nên max_connections chính là giới hạn
+            # HTTP_POOL_MAXSIZE cho host đó, giống pool urllib3 ở trên.
+            transport = CountingTransport(
+                limits=httpx.Limits(
+                    max_connections=HTTP_POOL_MAXSIZE,
+                    max_keepalive_connections=HTTP_POOL_MAXSIZE,
+                ),
+                # httpx chỉ retry lỗi kết nối, không retry theo status
+                retries=HTTP_RETRIES,
+            )
+            _httpx_client = httpx.Client(
+                transport=transport,
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            )
+        return _httpx_client
+
+def supabase_client_options():
+    """
+    ClientOptions cho create_client: timeout PostgREST theo cấu hình chung, và
+    httpx client dùng chung khi phiên bản supabase-py cho phép truyền vào.
+    """
+    import dataclasses
+    from supabase import ClientOptions
+
+    kwargs = {"postgrest_client_timeout": HTTP_READ_TIMEOUT}
+    if dataclasses.is_dataclass(ClientOptions) and any(
+        f.name == "httpx_client" for f in dataclasses.fields(ClientOptions)
+    ):
+        kwargs["httpx_client"] = get_httpx_client()
+    else:
+        log.warning("⚠️ supabase-py này không nhận httpx_client, client Supabase dùng pool httpx riêng "
+                    "(không theo HTTP_POOL_MAXSIZE, không có trong /api/transport/stats).")
+    return ClientOptions(**kwargs)
+
+
+def stats():
+    """Thống kê transport: request theo host và tình trạng pool kết nối."""
+    return {
+        "pool_maxsize": HTTP_POOL_MAXSIZE,
+        "pool_block": HTTP_POOL_BLOCK,
+        "retries": HTTP_RETRIES,
+        "hosts": transport_stats.snapshot(),
+        "pools": _adapter.pool_stats(),
+        "httpx_shared": _httpx_client is not None,
+    }
+
+
+metrics_registry.gauge("waste_http_client_in_flight", "Request HTTP đang chờ response", transport_stats.in_flight, label="host")
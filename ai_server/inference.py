@@ -1,80 +1,206 @@
-from ultralytics import YOLO
-from ai_server.model_manager import get_active_model_path,get_active_model_info
-from ai_server.supabase_utils import supabase
-
-# Nếu YOLO trả nhãn tiếng Anh mà DB lưu tiếng Việt, bạn có thể map như sau:
-LABEL_TO_CATEGORY = {
-    "plastic": "Nhựa",
-    "paper": "Giấy",
-    "metal": "Kim loại",
-    "glass": "Thủy tinh",
-    "organic": "Hữu cơ"
-}
-
-def get_category_info_by_name(label_name: str):
-    """Truy vấn category_id và category_name từ bảng waste_categories theo tên nhãn."""
-    label_name = LABEL_TO_CATEGORY.get(label_name, label_name.lower())
-    res = supabase.table("waste_categories").select("category_id, name").eq("name", label_name).execute()
-    if res.data:
-        return {
-            "category_id": res.data[0]["category_id"],
-            "category_name": res.data[0]["name"]
-        }
-    else:
-        print(f"⚠️ Không tìm thấy danh mục '{label_name}' trong bảng waste_categories.")
-        return None
+import os
+import time
+from ai_server.model_manager import get_active_model, registry
+from ai_server.scheduler import InferenceScheduler
+from ai_server.worker_pool import INFERENCE_WORKERS, get_worker_pool, current_worker_pool
+from ai_server.profiles import DEFAULT_UPLOAD_PROFILE, get_profile, predict_kwargs
+from ai_server.categories import get_category_lookup
+from ai_server.prediction_cache import prediction_cache, perceptual_hash
+from ai_server.preprocess import model_input, rescale_predictions
+from ai_server.ingest import IngestedImage
+from ai_server.metrics import get_logger, span, inc, detections, cache_lookups
+
+log = get_logger("inference")
+
+def predictions_from_boxes(xyxy, confs, classes, lookup, model_id):
+    """Ghép các list xyxy/conf/cls của một ảnh với danh mục thành predictions."""
+    predictions = []
+    for bbox, conf, cls in zip(xyxy, confs, classes):
+        category_info = lookup.get(int(cls))
+        if category_info is None:
+            continue
+
+        predictions.append({
+            "category_id": category_info["category_id"],
+            "category_name": category_info["category_name"],
+            "model_id": model_id,
+            "confidence": conf,
+            "bbox": bbox  # [x1, y1, x2, y2] - tọa độ để vẽ trên frontend
+        })
+    return predictions
+
+def extract_predictions(results, names, model_id):
+    """
+    Chuyển kết quả YOLO thành danh sách predictions trong một lượt:
+    xyxy/conf/cls được chuyển sang list một lần cho mỗi ảnh thay vì từng box.
+    """
+    lookup = get_category_lookup(names)
+    predictions = []
+
+    for r in results or []:
+        boxes = r.boxes
+        if boxes is None or len(boxes) == 0:
+            continue
+
+        predictions.extend(predictions_from_boxes(
+            boxes.xyxy.tolist(), boxes.conf.tolist(), boxes.cls.tolist(), lookup, model_id
+        ))
+
+    return predictions
+
+def load_image(source):
+    """
+    Đưa nguồn ảnh về numpy BGR: YOLO cần một batch đồng nhất, nên đường dẫn
+    (từ CLI/script cũ) được đọc thành mảng giống ảnh nhận trong bộ nhớ.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        # Đọc qua IngestedImage để xoay theo EXIF giống ảnh nhận từ request
+        try:
+            return IngestedImage(os.path.basename(source), None, path=os.fspath(source)).array
+        except ValueError:
+            raise ValueError(f"❌ Không đọc được ảnh: {source}")
+    return source
+
+def predict_batch(sources, profile=DEFAULT_UPLOAD_PROFILE, with_model_id=False):
+    """
+    Chạy một lần model.predict cho nhiều ảnh với tham số của `profile` và
+    trả về danh sách predictions tương ứng với từng ảnh (cùng thứ tự với sources).
+    with_model_id=True: mỗi phần tử là (model_id đã thực sự chạy, predictions).
+    """
+    # Mô hình được giữ sẵn trong bộ nhớ, chỉ nạp lại khi mô hình active thay đổi
+    loaded = get_active_model()
+
+    if INFERENCE_WORKERS > 0:
+        # Chạy trong pool process riêng, ảnh chuyển qua shared memory
+        pool = get_worker_pool(loaded.model_id, loaded.runtime_path, loaded.backend)
+        with span("model_predict"):
+            names, model_id, boxes = pool.predict([load_image(s) for s in sources], predict_kwargs(profile))
+        lookup = get_category_lookup(names)
+        batch = [predictions_from_boxes(xyxy, confs, classes, lookup, model_id) for xyxy, confs, classes in boxes]
+        return [(model_id, p) for p in batch] if with_model_id else batch
+
+    with span("model_predict"):
+        results = loaded.predict(
+            [load_image(s) for s in sources],
+            verbose=False,
+            **predict_kwargs(profile)
+        )
 
-def run_inference(image_path):
+    batch = [extract_predictions([r], loaded.names, loaded.model_id) for r in results]
+    return [(loaded.model_id, p) for p in batch] if with_model_id else batch
+
+# Scheduler gom ảnh từ /upload và /test thành batch (tắt bằng INFERENCE_BATCHING=0).
+# Ảnh khác profile không bao giờ chung batch; mỗi profile có thời gian chờ gom riêng.
+INFERENCE_BATCHING = os.getenv("INFERENCE_BATCHING", "1") == "1"
+scheduler = InferenceScheduler(
+    lambda profile, sources: predict_batch(sources, profile, with_model_id=True),
+    max_wait_fn=lambda profile: get_profile(profile).get("max_wait_ms"),
+    # Mỗi worker process nhận một batch tại một thời điểm
+    max_in_flight=max(1, INFERENCE_WORKERS),
+)
+
+def run_inference(image, profile=None):
     """
     Chạy YOLO và trả về danh sách predictions đã định dạng để lưu Supabase.
     Không tạo ảnh có bounding box - chỉ trả về tọa độ để frontend vẽ.
-    
+
     Args:
-        image_path: Đường dẫn đến ảnh cần nhận diện
-    
+        image: Ảnh đã giải mã (numpy BGR) hoặc đường dẫn đến ảnh cần nhận diện
+        profile: Tên profile suy luận ("realtime", "accurate", ...);
+            mặc định là DEFAULT_UPLOAD_PROFILE
+
     Returns:
         dict: {
-            "predictions": list of predictions với bbox coordinates
+            "predictions": list of predictions với bbox coordinates,
+            "profile": profile đã dùng,
+            "inference_ms": thời gian suy luận (kể cả chờ gom batch),
+            "model_id": mô hình đã thực sự chạy (có thể khác mô hình active lúc gọi nếu vừa hot-swap)
         }
     """
-    model_info = get_active_model_info()
-    model_path = get_active_model_path()
-    model_id = model_info["model_id"]
+    profile = profile or DEFAULT_UPLOAD_PROFILE
+    budget_ms = get_profile(profile).get("latency_budget_ms")
 
-    print(f"✅ Đang dùng mô hình: {model_info['name']} (v{model_info['version']})")
-    print(f"📂 Trọng số: {model_path}")
+    started = time.perf_counter()
+    with span("inference"):
+        if INFERENCE_BATCHING:
+            model_id, predictions = scheduler.run(image, key=profile)
+        else:
+            model_id, predictions = predict_batch([image], profile, with_model_id=True)[0]
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    inc(detections, len(predictions), profile=profile)
 
-    model = YOLO(model_path)
-    results = model.predict(
-        image_path,
-        conf=0.3,
-        augment=True,save=True
-    )
+    log.info(f"✅ Phát hiện {len(predictions)} vật thể hợp lệ để lưu ({profile}, {elapsed_ms:.0f} ms).")
+    if budget_ms is not None and elapsed_ms > budget_ms:
+        log.warning(f"⚠️ Profile '{profile}' vượt ngân sách độ trễ: {elapsed_ms:.0f} ms > {budget_ms} ms")
 
-    predictions = []
-    
-    # Lấy predictions với tọa độ bounding box
-    if results and len(results) > 0:
-        for r in results:
-            for box in r.boxes:
-                label_name = model.names[int(box.cls[0])]
-                category_info = get_category_info_by_name(label_name)
-                if category_info is None:
-                    continue
-                
-                # Lấy tọa độ bounding box [x1, y1, x2, y2]
-                bbox = box.xyxy[0].tolist()
-                
-                predictions.append({
-                    "category_id": category_info["category_id"],
-                    "category_name": category_info["category_name"],
-                    "model_id": model_id,
-                    "confidence": float(box.conf[0]),
-                    "bbox": bbox  # [x1, y1, x2, y2] - tọa độ để vẽ trên frontend
-                })
-    
-    print(f"✅ Phát hiện {len(predictions)} vật thể hợp lệ để lưu.")
-    
     return {
-        "predictions": predictions
+        "predictions": predictions,
+        "profile": profile,
+        "inference_ms": round(elapsed_ms, 1),
+        "model_id": model_id
+    }
+
+# Kết quả cache chỉ đúng với mô hình đã sinh ra nó: xóa khi hot-swap
+registry.add_listener(prediction_cache.invalidate)
+
+def _reload_worker_pool(old, new):
+    pool = current_worker_pool()
+    if pool is not None:
+        pool.reload(new.model_id, new.runtime_path, new.backend)
+
+# Pool process inference nạp thế hệ worker mới và drain worker cũ khi đổi mô hình
+registry.add_listener(_reload_worker_pool)
+
+def classify(image, profile=None, allow_near=False):
+    """
+    Nhận diện một IngestedImage có tra cache trước khi chạy mô hình.
+
+    Khóa cache là (model_id, profile, sha256 nội dung): ảnh gửi lại y hệt
+    không phải giải mã hay inference lần nữa. Với allow_near=True (quét
+    real-time) còn tra thêm tầng gần trùng bằng perceptual hash. Ảnh lớn được
+    thu nhỏ về imgsz của profile trước khi inference; bbox trả về luôn theo
+    tọa độ ảnh gốc.
+
+    Returns:
+        dict giống run_inference, thêm "cache": "exact" | "near" | "miss"
+    """
+    profile = profile or DEFAULT_UPLOAD_PROFILE
+    model_id = get_active_model().model_id
+    started = time.perf_counter()
+
+    predictions = prediction_cache.get_exact(model_id, profile, image.sha256)
+    if predictions is not None:
+        return _cached_result(predictions, profile, "exact", started)
+
+    with span("decode"):
+        array = image.array
+    shape, phash = None, None
+    if allow_near:
+        shape, phash = array.shape[:2], perceptual_hash(array)
+        predictions = prediction_cache.get_near(model_id, profile, shape, phash)
+        if predictions is not None:
+            return _cached_result(predictions, profile, "near", started)
+
+    prediction_cache.record_miss()
+    inc(cache_lookups, result="miss")
+    # Thu nhỏ một lần về imgsz của profile (YOLO cũng thu nhỏ nội bộ, nhưng sau khi
+    # ảnh gốc đã được copy/chuyển qua worker), bbox được đổi lại về tọa độ ảnh gốc
+    small, scale_x, scale_y = model_input(array, get_profile(profile).get("imgsz"))
+    result = run_inference(small, profile)
+    result["predictions"] = rescale_predictions(result["predictions"], scale_x, scale_y)
+    # Khóa cache theo mô hình đã chạy: hot-swap xảy ra giữa lúc tra cache và lúc
+    # inference thì kết quả không bị lưu dưới model_id cũ
+    prediction_cache.put(result["model_id"], profile, image.sha256, result["predictions"], shape, phash)
+    result["cache"] = "miss"
+    return result
+
+def _cached_result(predictions, profile, cache, started):
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    inc(cache_lookups, result=cache)
+    log.info(f"⚡ Dùng kết quả cache ({cache}): {len(predictions)} vật thể ({profile}).")
+    return {
+        "predictions": predictions,
+        "profile": profile,
+        "inference_ms": round(elapsed_ms, 1),
+        "cache": cache
     }
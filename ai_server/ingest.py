@@ -0,0 +1,224 @@
+import hashlib
+import io
+import mimetypes
+import os
+import shutil
+import struct
+import tempfile
+import uuid
+from ai_server.metrics import get_logger
+
+log = get_logger("ingest")
+
+# Ảnh lớn hơn ngưỡng này (byte) mới được ghi ra đĩa, còn lại giữ hoàn toàn trong RAM
+INGEST_SPILL_BYTES = int(os.getenv("INGEST_SPILL_BYTES", str(8 * 1024 * 1024)))
+INGEST_SPILL_DIR = os.getenv("INGEST_SPILL_DIR", "uploads")
+# Header JPEG đọc để tìm EXIF (APP1 tối đa 64KB, nằm ngay sau SOI/APP0)
+EXIF_HEAD_BYTES = 128 * 1024
+
+
+def _safe_filename(filename):
+    name = os.path.basename(filename or "") or "image.jpg"
+    return name.replace("\x00", "")
+
+
+def unique_spill_path(filename, directory=INGEST_SPILL_DIR):
+    """Đường dẫn file tạm duy nhất (tránh 2 upload cùng tên ghi đè nhau)."""
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{uuid.uuid4().hex}_{_safe_filename(filename)}")
+
+
+def ingest_stream_factory(total_content_length, content_type, filename=None, content_length=None):
+    """
+    stream_factory cho Werkzeug khi parse multipart: request nhỏ được đọc
+    thẳng vào BytesIO, request lớn hơn INGEST_SPILL_BYTES mới ghi ra file
+    tạm có tên duy nhất trong INGEST_SPILL_DIR.
+    """
+    if total_content_length is not None and 0 <= total_content_length <= INGEST_SPILL_BYTES:
+        return io.BytesIO()
+    os.makedirs(INGEST_SPILL_DIR, exist_ok=True)
+    suffix = os.path.splitext(filename or "")[1]
+    return tempfile.NamedTemporaryFile(dir=INGEST_SPILL_DIR, prefix="upload_", suffix=suffix, delete=False)
+
+
+def cleanup_spilled(streams, keep=()):
+    """
+    Đóng và xóa các file tạm mà ingest_stream_factory đã tạo cho một request,
+    trừ đường dẫn trong `keep` (file đã giao cho job nền, job tự xóa khi xong).
+    """
+    keep = {os.path.abspath(path) for path in keep if path}
+    for stream in streams:
+        name = getattr(stream, "name", None)
+        try:
+            stream.close()
+            if isinstance(name, str) and os.path.abspath(name) not in keep and os.path.exists(name):
+                os.remove(name)
+        except Exception as e:
+            log.warning(f"⚠️ Không thể xóa file tạm {name}: {e}")
+
+
+# ==========================================================
+# 🧭 HƯỚNG ẢNH THEO EXIF
+# ==========================================================
+def _tiff_orientation(tiff):
+    try:
+        order = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        offset = struct.unpack(order + "I", tiff[4:8])[0]
+        count = struct.unpack(order + "H", tiff[offset:offset + 2])[0]
+        for n in range(count):
+            entry = offset + 2 + 12 * n
+            tag = struct.unpack(order + "H", tiff[entry:entry + 2])[0]
+            if tag == 0x0112:
+                value = struct.unpack(order + "H", tiff[entry + 8:entry + 10])[0]
+                return value if 1 <= value <= 8 else 1
+    except (KeyError, struct.error):
+        pass
+    return 1
+
+def exif_orientation(head):
+    """Giá trị Orientation (1-8) trong EXIF của JPEG; 1 nếu không có hoặc không đọc được."""
+    if head[:2] != b"\xff\xd8":
+        return 1
+    i = 2
+    while i + 4 <= len(head):
+        if head[i] != 0xFF:
+            return 1
+        marker = head[i + 1]
+        if marker == 0xFF:  # byte đệm
+            i += 1
+            continue
+        if marker in (0xD9, 0xDA):  # EOI / SOS: hết phần header
+            return 1
+        length = struct.unpack(">H", head[i + 2:i + 4])[0]
+        segment = head[i + 4:i + 2 + length]
+        if marker == 0xE1 and segment[:6] == b"Exif\x00\x00":
+            return _tiff_orientation(segment[6:])
+        i += 2 + length
+    return 1
+
+def apply_orientation(array, orientation):
+    """Xoay/lật ảnh (numpy HxWxC) từ hướng lưu trong file về hướng hiển thị theo EXIF."""
+    import numpy as np
+
+    if orientation == 2:
+        array = array[:, ::-1]
+    elif orientation == 3:
+        array = array[::-1, ::-1]
+    elif orientation == 4:
+        array = array[::-1]
+    elif orientation == 5:
+        array = array.swapaxes(0, 1)
+    elif orientation == 6:
+        array = np.rot90(array, k=-1)
+    elif orientation == 7:
+        array = array[::-1, ::-1].swapaxes(0, 1)
+    elif orientation == 8:
+        array = np.rot90(array, k=1)
+    else:
+        return array
+    return np.ascontiguousarray(array)
+
+
+# ==========================================================
+# 📥 ẢNH ĐÃ NHẬN TỪ REQUEST
+# ==========================================================
+class IngestedImage:
+    """
+    Ảnh upload đã nhận: nằm trong RAM (`data`) hoặc đã spill ra đĩa (`path`).
+    `array` giải mã ảnh một lần thành numpy BGR để đưa thẳng vào model, đã
+    xoay theo EXIF Orientation: bbox, ảnh thu nhỏ và thumbnail đều ở hướng
+    người dùng nhìn thấy.
+    """
+
+    def __init__(self, filename, mimetype, data=None, path=None):
+        self.filename = _safe_filename(filename)
+        self.mimetype = mimetype or mimetypes.guess_type(self.filename)[0] or "image/jpeg"
+        self.data = data
+        self.path = path
+        self._array = None
+        self._sha256 = None
+
+    @property
+    def size(self):
+        if self.data is not None:
+            return len(self.data)
+        return os.path.getsize(self.path)
+
+    @property
+    def array(self):
+        if self._array is None:
+            import cv2
+            import numpy as np
+
+            # Tự xoay theo EXIF thay vì dựa vào OpenCV (hành vi khác nhau giữa
+            # imread/imdecode và giữa các phiên bản)
+            flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+            if self.data is not None:
+                array = cv2.imdecode(np.frombuffer(self.data, np.uint8), flags)
+                head = self.data[:EXIF_HEAD_BYTES]
+            else:
+                array = cv2.imread(self.path, flags)
+                with open(self.path, "rb") as f:
+                    head = f.read(EXIF_HEAD_BYTES)
+            if array is None:
+                raise ValueError("❌ File gửi lên không phải ảnh hợp lệ.")
+            self._array = apply_orientation(array, exif_orientation(head))
+        return self._array
+
+    @property
+    def sha256(self):
+        """Hash nội dung file gốc (dùng làm khóa cache kết quả)."""
+        if self._sha256 is None:
+            digest = hashlib.sha256()
+            if self.data is not None:
+                digest.update(self.data)
+            else:
+                with open(self.path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+            self._sha256 = digest.hexdigest()
+        return self._sha256
+
+    def open(self):
+        """File-like để upload lên storage mà không cần ghi thêm file tạm."""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, "rb")
+
+    def cleanup(self):
+        """Xóa file spill (nếu có)."""
+        if self.path:
+            try:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+            except Exception as e:
+                log.warning(f"⚠️ Không thể xóa file tạm: {e}")
+            self.path = None
+
+
+def ingest_upload(file, spill_dir=INGEST_SPILL_DIR):
+    """Nhận FileStorage của Flask thành IngestedImage, ưu tiên giữ trong RAM."""
+    stream = file.stream
+    filename = _safe_filename(file.filename)
+    mimetype = file.mimetype if file.mimetype and file.mimetype.startswith("image/") else None
+
+    if isinstance(stream, io.BytesIO):
+        return IngestedImage(filename, mimetype, data=stream.getvalue())
+
+    # Đã được ingest_stream_factory ghi ra file tạm duy nhất
+    name = getattr(stream, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        stream.flush()
+        return IngestedImage(filename, mimetype, path=name)
+
+    # Stream khác (ví dụ stream_factory mặc định của Werkzeug)
+    stream.seek(0)
+    head = stream.read(INGEST_SPILL_BYTES + 1)
+    if len(head) <= INGEST_SPILL_BYTES:
+        return IngestedImage(filename, mimetype, data=head)
+
+    path = unique_spill_path(filename, spill_dir)
+    with open(path, "wb") as out:
+        out.write(head)
+        shutil.copyfileobj(stream, out)
+    return IngestedImage(filename, mimetype, path=path)
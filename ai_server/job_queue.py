@@ -0,0 +1,317 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from ai_server.metrics import get_logger
+
+log = get_logger("job_queue")
+
+# File SQLite lưu hàng đợi job (bền vững qua các lần khởi động lại server)
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", os.path.join("uploads", "jobs.sqlite3"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Backoff lũy thừa: base * 2^(attempts-1), tối đa JOB_RETRY_MAX_SECONDS
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "300"))
+# Job 'running' được giữ bằng lease của process đang chạy nó, gia hạn mỗi
+# JOB_LEASE_SECONDS/3 giây; chỉ lease đã hết hạn (process đó đã chết) mới bị nhận lại
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    image_id INTEGER,
+    payload TEXT NOT NULL,
+    blob BLOB,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_run_at REAL NOT NULL,
+    last_error TEXT,
+    owner TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state_next_run ON jobs(state, next_run_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_image_id ON jobs(image_id);
+"""
+
+
+class Job:
+    """Một job đã được worker nhận; handler có thể lưu tiến độ giữa các bước."""
+
+    def __init__(self, queue, row):
+        self.queue = queue
+        self.job_id = row["job_id"]
+        self.kind = row["kind"]
+        self.image_id = row["image_id"]
+        self.payload = json.loads(row["payload"])
+        self.blob = row.get("blob")
+        self.attempts = row["attempts"]
+
+    def save_progress(self, **fields):
+        """Ghi thêm trường vào payload để lần retry không lặp lại bước đã xong."""
+        self.payload.update(fields)
+        self.queue._update(self.job_id, payload=json.dumps(self.payload))
+
+
+# ==========================================================
+# 🧵 HÀNG ĐỢI JOB CỤC BỘ (SQLITE) + WORKER POOL
+# ==========================================================
+class JobQueue:
+    """
+    Hàng đợi job bền vững trên SQLite với worker pool.
+
+    - handlers: dict {kind: handler(job)}; handler raise Exception để retry.
+    - Job lỗi được thử lại với backoff lũy thừa, quá max_attempts thì chuyển
+      sang 'failed' và gọi on_failed(job, error) nếu có.
+    - Job đang chạy ghi owner (process) và lease_until; process còn sống gia
+      hạn lease định kỳ. Job 'running' có lease hết hạn (process chết giữa
+      chừng) được đưa lại về 'pending', còn job của process khác đang sống
+      (worker gunicorn khác, process cha) thì không bị đụng tới.
+    """
+
+    def __init__(self, handlers, path=JOB_QUEUE_PATH, workers=JOB_WORKERS,
+                 max_attempts=JOB_MAX_ATTEMPTS, on_failed=None, name="jobs"):
+        self.handlers = handlers
+        self.path = path
+        self.workers = max(1, int(workers))
+        self.max_attempts = max(1, int(max_attempts))
+        self.on_failed = on_failed
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = max(1.0, JOB_LEASE_SECONDS)
+
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._running = False
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+
+    # ------------------------------------------------------
+    # Kết nối SQLite
+    # ------------------------------------------------------
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: không fsync mỗi lần commit, vẫn an toàn khi process crash
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("blob", "BLOB"), ("owner", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._db_lock:
+            return self._connect().execute(sql, params)
+
+    def _fetchall(self, sql, params=()):
+        with self._db_lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{k} = ?" for k in fields)
+        self._execute(f"UPDATE jobs SET {columns} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def _release(self, job_id, **fields):
+        """Kết thúc lượt chạy của job; bỏ qua nếu lease đã mất (process khác đã nhận lại job)."""
+        fields.update(owner=None, lease_until=None, updated_at=time.time())
+        columns = ", ".join(f"{k} = ?" for k in fields)
+        cur = self._execute(
+            f"UPDATE jobs SET {columns} WHERE job_id = ? AND state = 'running' AND owner = ?",
+            (*fields.values(), job_id, self.owner),
+        )
+        if cur.rowcount == 0:
+            log.warning(f"⚠️ Job {job_id} không còn thuộc process này (lease đã hết hạn), bỏ qua kết quả.")
+
+    # ------------------------------------------------------
+    # Vòng đời
+    # ------------------------------------------------------
+    def start(self):
+        """Khôi phục job dang dở và khởi động worker (gọi nhiều lần vẫn an toàn)."""
+        with self._start_lock:
+            if self._running:
+                return self
+            recovered = self.recover()
+            self._running = True
+            self._stopped.clear()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker_loop, name=f"{self.name}-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            t = threading.Thread(target=self._lease_loop, name=f"{self.name}-lease", daemon=True)
+            t.start()
+            self._threads.append(t)
+        log.info(f"🧵 Job queue '{self.name}' chạy {self.workers} worker ({recovered} job được khôi phục).")
+        return self
+
+    def stop(self, timeout=None):
+        self._running = False
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def recover(self):
+        """
+        Đưa các job 'running' có lease đã hết hạn (process chạy nó đã chết) về
+        lại 'pending'. Job không có lease là job của phiên bản cũ chưa ghi owner.
+        """
+        now = time.time()
+        cur = self._execute(
+            "UPDATE jobs SET state = 'pending', owner = NULL, lease_until = NULL, next_run_at = ?, updated_at = ? "
+            "WHERE state = 'running' AND (lease_until IS NULL OR lease_until < ?)",
+            (now, now, now),
+        )
+        return cur.rowcount
+
+    def _renew_leases(self):
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET lease_until = ? WHERE state = 'running' AND owner = ?",
+            (now + self.lease_seconds, self.owner),
+        )
+
+    def _lease_loop(self):
+        """Gia hạn lease của job đang chạy và nhận lại job của process đã chết."""
+        while not self._stopped.wait(self.lease_seconds / 3):
+            try:
+                self._renew_leases()
+                recovered = self.recover()
+            except Exception as e:
+                log.error(f"❌ Lỗi khi gia hạn lease job: {e}")
+                continue
+            if recovered:
+                log.warning(f"⚠️ Nhận lại {recovered} job có lease hết hạn.")
+                with self._wakeup:
+                    self._wakeup.notify_all()
+
+    # ------------------------------------------------------
+    # API
+    # ------------------------------------------------------
+    def enqueue(self, kind, payload, image_id=None, blob=None):
+        """
+        Thêm job mới và đánh thức worker; trả về job_id.
+        blob: dữ liệu nhị phân đi kèm (ví dụ ảnh gốc) lưu cùng job trong SQLite.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Không có handler cho job '{kind}'")
+        now = time.time()
+        cur = self._execute(
+            "INSERT INTO jobs (kind, image_id, payload, blob, state, next_run_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'pending', ?, ?, ?)",
+            (kind, image_id, json.dumps(payload), blob, now, now, now),
+        )
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return cur.lastrowid
+
+    def get_by_image(self, image_id):
+        """Trả về job mới nhất của image_id (dict) hoặc None."""
+        rows = self._fetchall(
+            "SELECT job_id, kind, state, attempts, last_error, payload, created_at, updated_at "
+            "FROM jobs WHERE image_id = ? ORDER BY job_id DESC LIMIT 1",
+            (image_id,),
+        )
+        if not rows:
+            return None
+        job = dict(rows[0])
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def counts(self):
+        """Số job theo từng trạng thái."""
+        rows = self._fetchall("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")
+        return {row["state"]: row["n"] for row in rows}
+
+    # ------------------------------------------------------
+    # Worker
+    # ------------------------------------------------------
+    def _claim(self):
+        """Nhận một job đến hạn; trả về (Job, None) hoặc (None, giây chờ tới job kế tiếp)."""
+        now = time.time()
+        with self._db_lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE state = 'pending' AND next_run_at <= ? "
+                    "ORDER BY next_run_at, job_id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    nxt = conn.execute(
+                        "SELECT MIN(next_run_at) AS t FROM jobs WHERE state = 'pending'"
+                    ).fetchone()["t"]
+                    conn.execute("COMMIT")
+                    return None, (max(0.0, nxt - now) if nxt is not None else None)
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', attempts = attempts + 1, owner = ?, lease_until = ?, "
+                    "updated_at = ? WHERE job_id = ?",
+                    (self.owner, now + self.lease_seconds, now, row["job_id"]),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        row = dict(row)
+        row["attempts"] += 1
+        return Job(self, row), None
+
+    def _worker_loop(self):
+        while self._running:
+            try:
+                job, wait = self._claim()
+            except Exception as e:
+                log.error(f"❌ Lỗi khi đọc hàng đợi job: {e}")
+                job, wait = None, 1.0
+
+            if job is None:
+                with self._wakeup:
+                    if self._running:
+                        self._wakeup.wait(timeout=min(wait, 5.0) if wait is not None else 5.0)
+                continue
+
+            self._run_job(job)
+
+    def _run_job(self, job):
+        try:
+            self.handlers[job.kind](job)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts >= self.max_attempts:
+                self._release(job.job_id, state="failed", last_error=error)
+                log.error(f"❌ Job {job.job_id} ({job.kind}) thất bại sau {job.attempts} lần: {error}")
+                if self.on_failed is not None:
+                    try:
+                        self.on_failed(job, e)
+                    except Exception as cb_error:
+                        log.warning(f"⚠️ Lỗi trong on_failed của job {job.job_id}: {cb_error}")
+                return
+
+            delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1)))
+            self._release(job.job_id, state="pending", last_error=error, next_run_at=time.time() + delay)
+            log.info(f"🔁 Job {job.job_id} ({job.kind}) lỗi lần {job.attempts}, thử lại sau {delay:.0f}s: {error}")
+            return
+
+        # Job xong thì không cần giữ dữ liệu nhị phân nữa
+        self._release(job.job_id, state="done", last_error=None, blob=None)
+        log.info(f"✅ Job {job.job_id} ({job.kind}) hoàn tất.")
@@ -0,0 +1,272 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+# Tắt toàn bộ đo đạc bằng METRICS_ENABLED=0 (span trở thành no-op)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Định dạng log: "text" (giống print cũ), "json" (mỗi dòng một object) hoặc "off"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Endpoint của request hiện tại (đặt trong before_request), dùng làm nhãn cho span
+current_endpoint = contextvars.ContextVar("current_endpoint", default="background")
+
+
+# ==========================================================
+# 📈 COUNTER / HISTOGRAM / GAUGE
+# ==========================================================
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [counts theo bucket..., +Inf], sum, count
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in sorted(self._values.items())]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Gauge:
+    """Gauge tính lúc scrape: fn() trả về số hoặc dict {giá trị nhãn: số}."""
+
+    def __init__(self, name, help_text, fn, label=None):
+        self.name, self.help, self.fn, self.label = name, help_text, fn, label
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            log.warning(f"⚠️ Không đọc được gauge {self.name}: {e}")
+            return lines
+        if isinstance(value, dict):
+            for label_value, n in sorted(value.items()):
+                lines.append(f"{self.name}{_format_labels((self.label,), (label_value,))} {n}")
+        elif value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._get(Counter, name, help_text, labels)
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, labels, buckets)
+
+    def gauge(self, name, help_text, fn, label=None):
+        with self._lock:
+            self._metrics[name] = Gauge(name, help_text, fn, label)
+
+    def render(self):
+        """Định dạng text exposition của Prometheus (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.histogram(
+    "waste_stage_duration_seconds", "Thời gian từng bước pipeline", ("stage", "endpoint"))
+stage_errors = registry.counter(
+    "waste_stage_errors_total", "Số lần một bước pipeline lỗi", ("stage", "endpoint"))
+request_seconds = registry.histogram(
+    "waste_http_request_duration_seconds", "Thời gian xử lý request HTTP", ("endpoint", "method", "status"))
+request_errors = registry.counter(
+    "waste_http_errors_total", "Số response lỗi (status >= 400)", ("endpoint", "status"))
+detections = registry.counter(
+    "waste_detections_total", "Số vật thể phát hiện được", ("profile",))
+cache_lookups = registry.counter(
+    "waste_prediction_cache_total", "Kết quả tra cache dự đoán", ("result",))
+model_loads = registry.counter(
+    "waste_model_loads_total", "Số lần nạp mô hình", ("model", "backend", "result"))
+model_load_seconds = registry.histogram(
+    "waste_model_load_duration_seconds", "Thời gian nạp mô hình", ("backend",),
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+
+
+# ==========================================================
+# ⏱️ SPAN ĐO THỜI GIAN TỪNG BƯỚC
+# ==========================================================
+class _Span:
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        endpoint = current_endpoint.get()
+        stage_seconds.observe(elapsed, stage=self.stage, endpoint=endpoint)
+        if exc_type is not None:
+            stage_errors.inc(stage=self.stage, endpoint=endpoint)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("span", extra={"fields": {
+                "stage": self.stage, "endpoint": endpoint,
+                "ms": round(elapsed * 1000, 2), "error": exc_type is not None,
+            }})
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+def span(stage):
+    """with span("inference"): ... → ghi thời gian vào histogram theo stage + endpoint."""
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return _Span(stage)
+
+def inc(counter, value=1, **labels):
+    """Tăng counter (bỏ qua khi tắt metrics)."""
+    if METRICS_ENABLED:
+        counter.inc(value, **labels)
+
+def observe(histogram, value, **labels):
+    """Ghi một giá trị vào histogram (bỏ qua khi tắt metrics)."""
+    if METRICS_ENABLED:
+        histogram.observe(value, **labels)
+
+def observe_request(endpoint, method, status, seconds):
+    if not METRICS_ENABLED:
+        return
+    request_seconds.observe(seconds, endpoint=endpoint, method=method, status=status)
+    if status >= 400:
+        request_errors.inc(endpoint=endpoint, status=status)
+
+
+# ==========================================================
+# 📝 LOGGING CÓ CẤU TRÚC
+# ==========================================================
+class _JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "endpoint": current_endpoint.get(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    """Giữ nguyên dòng log như print trước đây, thêm field (nếu có) ở cuối."""
+
+    def format(self, record):
+        message = record.getMessage()
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        return message
+
+
+def _configure_logging():
+    logger = logging.getLogger("waste")
+    logger.propagate = False
+    if LOG_FORMAT == "off":
+        logger.disabled = True
+        return logger
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(_JSONFormatter() if LOG_FORMAT == "json" else _TextFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    return logger
+
+
+log = _configure_logging()
+
+def get_logger(name):
+    """Logger con của "waste" (cùng handler/định dạng)."""
+    return log.getChild(name)
@@ -0,0 +1,410 @@
+"""
+So sánh độ trễ / throughput / bộ nhớ / độ chính xác của các mô hình trong
+bảng ai_models trên một bộ ảnh có nhãn (định dạng YOLO) và ghi kết quả
+ngược vào ai_models (cột benchmark, xem ai_models_benchmark.txt).
+
+Ví dụ:
+    # Đo mọi mô hình đã đăng ký với tất cả profile, ghi vào Supabase
+    python -m ai_server.model_benchmark ./dataset/valid/images
+
+    # Chỉ đo hai mô hình với profile realtime, thử cả ONNX, không ghi database
+    python -m ai_server.model_benchmark ./dataset/valid/images \\
+        --model waste_yolov8s --model waste_yolov8m --profile realtime --backend onnx --dry-run
+
+Nhãn của ảnh <...>/images/x.jpg đọc từ <...>/labels/x.txt (class cx cy w h,
+tọa độ chuẩn hóa); chỉ số class phải trùng với thứ tự lớp của mô hình.
+Mỗi (mô hình, backend, profile) chạy trong một process riêng để đo được
+đỉnh bộ nhớ của riêng lần chạy đó.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+BENCHMARK_WARMUP_RUNS = int(os.getenv("BENCHMARK_WARMUP_RUNS", "3"))
+BENCHMARK_BATCH_SIZE = int(os.getenv("BENCHMARK_BATCH_SIZE", "8"))
+BENCHMARK_MAX_IMAGES = int(os.getenv("BENCHMARK_MAX_IMAGES", "500"))
+# Ngưỡng IoU 0.50:0.95 (bước 0.05) như mAP50-95 của COCO / ultralytics
+IOU_STEPS = 10
+
+
+# ==========================================================
+# 📂 BỘ ẢNH CÓ NHÃN
+# ==========================================================
+def list_images(source, limit=BENCHMARK_MAX_IMAGES):
+    files = sorted(
+        f for f in glob.glob(os.path.join(source, "**", "*"), recursive=True)
+        if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS
+    )
+    if not files:
+        raise ValueError(f"❌ Không có ảnh nào trong {source}")
+    return files[:limit] if limit else files
+
+def label_path(image_path):
+    """<...>/images/<tên>.jpg → <...>/labels/<tên>.txt (quy ước dataset YOLO)."""
+    head, _, tail = image_path.rpartition(f"{os.sep}images{os.sep}")
+    base = os.path.join(head, "labels", tail) if head else image_path
+    return os.path.splitext(base)[0] + ".txt"
+
+def load_labels(image_path, shape):
+    """Đọc nhãn YOLO thành (boxes xyxy theo pixel, classes); nhãn polygon được quy về bbox."""
+    import numpy as np
+
+    height, width = shape[:2]
+    boxes, classes = [], []
+    path = label_path(image_path)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 5:
+                    continue
+                values = [float(v) for v in parts[1:]]
+                if len(values) == 4:
+                    cx, cy, w, h = values
+                    x1, y1, x2, y2 = cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2
+                else:
+                    xs, ys = values[0::2], values[1::2]
+                    x1, y1, x2, y2 = min(xs), min(ys), max(xs), max(ys)
+                boxes.append([x1 * width, y1 * height, x2 * width, y2 * height])
+                classes.append(int(parts[0]))
+    return np.asarray(boxes, dtype=np.float32).reshape(-1, 4), np.asarray(classes, dtype=np.int64)
+
+
+# ==========================================================
+# 🎯 mAP / PRECISION / RECALL (VECTOR HÓA BẰNG NUMPY)
+# ==========================================================
+def box_iou(a, b):
+    """Ma trận IoU (N, M) giữa hai tập box xyxy."""
+    import numpy as np
+
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+def match_predictions(pred_boxes, pred_classes, gt_boxes, gt_classes):
+    """
+    Đánh dấu true positive cho từng prediction ở mỗi ngưỡng IoU: mỗi box
+    nhãn chỉ được ghép với một prediction cùng lớp (ưu tiên IoU cao nhất).
+    Trả về mảng bool (số prediction, IOU_STEPS).
+    """
+    import numpy as np
+
+    thresholds = np.linspace(0.5, 0.95, IOU_STEPS)
+    tp = np.zeros((len(pred_boxes), IOU_STEPS), dtype=bool)
+    if not len(pred_boxes) or not len(gt_boxes):
+        return tp
+
+    iou = box_iou(gt_boxes, pred_boxes) * (gt_classes[:, None] == pred_classes[None, :])
+    for i, threshold in enumerate(thresholds):
+        gt_idx, pred_idx = np.nonzero(iou >= threshold)
+        if not gt_idx.size:
+            continue
+        order = np.argsort(-iou[gt_idx, pred_idx], kind="stable")
+        gt_idx, pred_idx = gt_idx[order], pred_idx[order]
+        # np.unique trả về lần xuất hiện đầu tiên = cặp có IoU cao nhất
+        _, first = np.unique(pred_idx, return_index=True)
+        first.sort()
+        gt_idx, pred_idx = gt_idx[first], pred_idx[first]
+        _, first = np.unique(gt_idx, return_index=True)
+        tp[pred_idx[first], i] = True
+    return tp
+
+def detection_metrics(tp, confidences, pred_classes, gt_classes):
+    """
+    Precision / recall (ở ngưỡng conf của profile) và mAP50, mAP50-95 trung
+    bình theo lớp, AP nội suy 101 điểm như COCO.
+    """
+    import numpy as np
+
+    order = np.argsort(-confidences, kind="stable")
+    tp, pred_classes = tp[order], pred_classes[order]
+    classes = np.unique(gt_classes)
+    if not classes.size:
+        return {"map50": 0.0, "map50_95": 0.0, "precision": 0.0, "recall": 0.0, "f1": 0.0}
+
+    recall_points = np.linspace(0, 1, 101)
+    ap = np.zeros((classes.size, IOU_STEPS))
+    precision = np.zeros(classes.size)
+    recall = np.zeros(classes.size)
+    for ci, cls in enumerate(classes):
+        mask = pred_classes == cls
+        n_gt = int((gt_classes == cls).sum())
+        if not mask.any():
+            continue
+        tpc = tp[mask].cumsum(axis=0)
+        fpc = (~tp[mask]).cumsum(axis=0)
+        rec = tpc / n_gt
+        prec = tpc / (tpc + fpc)
+        precision[ci], recall[ci] = prec[-1, 0], rec[-1, 0]
+
+        # Đường bao precision giảm dần theo recall, lấy mẫu tại 101 mức recall
+        envelope = np.flip(np.maximum.accumulate(np.flip(prec, axis=0), axis=0), axis=0)
+        envelope = np.vstack([envelope, np.zeros((1, IOU_STEPS))])
+        for j in range(IOU_STEPS):
+            idx = np.searchsorted(rec[:, j], recall_points, side="left")
+            ap[ci, j] = envelope[idx, j].mean()
+
+    p, r = float(precision.mean()), float(recall.mean())
+    return {
+        "map50": round(float(ap[:, 0].mean()), 4),
+        "map50_95": round(float(ap.mean()), 4),
+        "precision": round(p, 4),
+        "recall": round(r, 4),
+        "f1": round(2 * p * r / (p + r), 4) if p + r else 0.0,
+    }
+
+def evaluate(image_paths, shapes, outputs):
+    """Gộp kết quả của cả bộ ảnh rồi tính metrics một lần."""
+    import numpy as np
+
+    tps, confs, pred_classes, gt_classes = [], [], [], []
+    for path, shape, (boxes, conf, cls) in zip(image_paths, shapes, outputs):
+        gt_boxes, gt_cls = load_labels(path, shape)
+        cls = cls.astype(np.int64)
+        tps.append(match_predictions(boxes, cls, gt_boxes, gt_cls))
+        confs.append(conf)
+        pred_classes.append(cls)
+        gt_classes.append(gt_cls)
+    return detection_metrics(
+        np.concatenate(tps), np.concatenate(confs), np.concatenate(pred_classes), np.concatenate(gt_classes)
+    )
+
+
+# ==========================================================
+# ⏱️ ĐO TRONG PROCESS RIÊNG
+# ==========================================================
+def _peak_memory_mb():
+    """Đỉnh RSS của process hiện tại (MB), None nếu không đo được trên nền tảng này."""
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux trả về KB, macOS trả về byte
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    except ImportError:
+        return None
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def _measure(backend, runtime_path, image_paths, kwargs, warmup_runs, batch_size):
+    """Chạy trong process con: nạp mô hình, warm-up, đo từng ảnh rồi đo theo batch."""
+    import cv2
+    import numpy as np
+    from ai_server.backends import load_runtime
+
+    started = time.perf_counter()
+    model = load_runtime(backend, runtime_path)
+    load_ms = (time.perf_counter() - started) * 1000
+
+    # Giải mã trước để chỉ đo thời gian suy luận
+    images = [cv2.imread(p, cv2.IMREAD_COLOR) for p in image_paths]
+    for _ in range(warmup_runs):
+        model.predict(images[0], verbose=False, **kwargs)
+
+    latencies, outputs = [], []
+    for image in images:
+        started = time.perf_counter()
+        result = model.predict(image, verbose=False, **kwargs)[0]
+        latencies.append((time.perf_counter() - started) * 1000)
+        boxes = result.boxes
+        if boxes is None:
+            outputs.append((np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.float32)))
+        else:
+            outputs.append((boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(), boxes.cls.cpu().numpy()))
+
+    started = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        model.predict(images[i:i + batch_size], verbose=False, **kwargs)
+    batch_seconds = time.perf_counter() - started
+
+    peak_gpu_mb = None
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            peak_gpu_mb = round(torch.cuda.max_memory_allocated() / (1024 * 1024), 1)
+    except ImportError:
+        pass
+
+    return {
+        "load_ms": round(load_ms, 1),
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "p50": round(_percentile(latencies, 50), 2),
+            "p95": round(_percentile(latencies, 95), 2),
+        },
+        "throughput_ips": round(len(images) / batch_seconds, 2) if batch_seconds else None,
+        "batch_size": batch_size,
+        "peak_memory_mb": _peak_memory_mb(),
+        "peak_gpu_mb": peak_gpu_mb,
+        "shapes": [image.shape[:2] for image in images],
+        "outputs": outputs,
+    }
+
+def benchmark_model(info, image_paths, profiles, backend=None, warmup_runs=BENCHMARK_WARMUP_RUNS,
+                    batch_size=BENCHMARK_BATCH_SIZE):
+    """Đo một mô hình với từng profile; trả về (backend thực dùng, {profile: kết quả})."""
+    from ai_server.backends import prepare_runtime
+    from ai_server.model_manager import resolve_model_path
+    from ai_server.profiles import predict_kwargs
+
+    path = resolve_model_path(info)
+    # Dùng đúng runtime mà server sẽ chạy (export ONNX/OpenVINO được cache)
+    runtime_backend, runtime_path = prepare_runtime({**info, "backend": backend or info.get("backend")}, path)
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for profile in profiles:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            measured = executor.submit(
+                _measure, runtime_backend, runtime_path, image_paths,
+                predict_kwargs(profile), warmup_runs, batch_size,
+            ).result()
+        shapes, outputs = measured.pop("shapes"), measured.pop("outputs")
+        measured.update(evaluate(image_paths, shapes, outputs))
+        results[profile] = measured
+        print(f"⏱️ {info['name']} [{runtime_backend}/{profile}]: p50 {measured['latency_ms']['p50']} ms, "
+              f"{measured['throughput_ips']} ảnh/giây, RAM {measured['peak_memory_mb']} MB, "
+              f"mAP50 {measured['map50']}, P {measured['precision']}, R {measured['recall']}")
+    return runtime_backend, results
+
+
+# ==========================================================
+# 💾 GHI KẾT QUẢ VÀO ai_models
+# ==========================================================
+def save_results(info, backend, results, dataset, image_count, update_accuracy=False):
+    """
+    Gộp kết quả vào ai_models.benchmark theo dạng {backend: {...}}. Các cột
+    latency_ms / throughput_ips / peak_memory_mb lấy theo DEFAULT_UPLOAD_PROFILE
+    và chỉ cập nhật khi backend đo được chính là backend mô hình đang dùng.
+    """
+    from ai_server.backends import resolve_backend
+    from ai_server.model_manager import supabase
+    from ai_server.profiles import DEFAULT_UPLOAD_PROFILE
+
+    now = datetime.now(timezone.utc).isoformat()
+    benchmark = dict(info.get("benchmark") or {})
+    benchmark[backend] = {
+        "measured_at": now,
+        "host": platform.node(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "dataset": os.path.abspath(dataset),
+        "images": image_count,
+        "profiles": results,
+    }
+    data = {"benchmark": benchmark, "benchmarked_at": now}
+
+    primary = results.get(DEFAULT_UPLOAD_PROFILE) or next(iter(results.values()))
+    if backend == resolve_backend(info):
+        data.update({
+            "latency_ms": primary["latency_ms"]["p50"],
+            "throughput_ips": primary["throughput_ips"],
+            "peak_memory_mb": primary["peak_memory_mb"],
+        })
+        if update_accuracy:
+            # Thay số liệu lấy từ results.csv lúc train bằng số đo trên bộ ảnh này
+            data.update({
+                "accuracy": primary["map50"],
+                "precision": primary["precision"],
+                "recall": primary["recall"],
+                "f1_score": primary["f1"],
+            })
+
+    supabase.table("ai_models").update(data).eq("model_id", info["model_id"]).execute()
+    print(f"💾 Đã ghi benchmark {info['name']} ({backend}) vào ai_models")
+
+
+def print_summary(rows):
+    """Bảng so sánh chi phí / độ chính xác để chọn mô hình active."""
+    header = f"{'mô hình':<20} {'backend':<10} {'profile':<10} {'p50 ms':>8} {'p95 ms':>8} {'ảnh/s':>8} {'RAM MB':>8} {'mAP50':>7} {'mAP50-95':>9} {'P':>7} {'R':>7}"
+    print("\n📊 Tổng hợp benchmark:")
+    print(header)
+    print("-" * len(header))
+    for name, backend, profile, m in rows:
+        print(f"{name:<20} {backend:<10} {profile:<10} {m['latency_ms']['p50']:>8} {m['latency_ms']['p95']:>8} "
+              f"{m['throughput_ips']!s:>8} {m['peak_memory_mb']!s:>8} {m['map50']:>7} {m['map50_95']:>9} "
+              f"{m['precision']:>7} {m['recall']:>7}")
+
+
+# ==========================================================
+# 🚀 CLI
+# ==========================================================
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m ai_server.model_benchmark",
+                                     description="Đo độ trễ / throughput / bộ nhớ / mAP của các mô hình trong ai_models")
+    parser.add_argument("images", help="Thư mục ảnh có nhãn YOLO (…/images, nhãn ở …/labels)")
+    parser.add_argument("--model", action="append", help="Tên mô hình trong ai_models (lặp lại được, bỏ trống = tất cả)")
+    parser.add_argument("--profile", action="append", help="Profile suy luận (lặp lại được, bỏ trống = tất cả)")
+    parser.add_argument("--backend", help="Ép backend (pytorch/onnx/onnx_int8/openvino) thay cho cột ai_models.backend")
+    parser.add_argument("--limit", type=int, default=BENCHMARK_MAX_IMAGES, help="Số ảnh tối đa (0 = tất cả)")
+    parser.add_argument("--warmup", type=int, default=BENCHMARK_WARMUP_RUNS, help="Số lần chạy warm-up")
+    parser.add_argument("--batch-size", type=int, default=BENCHMARK_BATCH_SIZE, help="Kích thước batch khi đo throughput")
+    parser.add_argument("--update-accuracy", action="store_true",
+                        help="Ghi mAP50/P/R/F1 đo được vào các cột accuracy/precision/recall/f1_score")
+    parser.add_argument("--output", help="Ghi toàn bộ kết quả ra file JSON")
+    parser.add_argument("--dry-run", action="store_true", help="Chỉ đo và in kết quả, không ghi Supabase")
+    return parser
+
+def main(argv=None):
+    from ai_server.model_manager import supabase
+    from ai_server.profiles import PROFILES, get_profile
+
+    args = build_parser().parse_args(argv)
+    try:
+        image_paths = list_images(args.images, args.limit)
+        profiles = args.profile or sorted(PROFILES)
+        for profile in profiles:
+            get_profile(profile)
+    except ValueError as e:
+        print(e)
+        return 2
+
+    query = supabase.table("ai_models").select("*").order("model_id")
+    models = [m for m in query.execute().data or [] if not args.model or m["name"] in args.model]
+    if not models:
+        print("❌ Không có mô hình nào khớp trong ai_models.")
+        return 2
+    print(f"🧪 Benchmark {len(models)} mô hình × {len(profiles)} profile trên {len(image_paths)} ảnh")
+
+    rows, report = [], {}
+    for info in models:
+        try:
+            backend, results = benchmark_model(info, image_paths, profiles, args.backend, args.warmup, args.batch_size)
+        except Exception as e:
+            print(f"❌ Không benchmark được {info['name']}: {e}")
+            continue
+        report.setdefault(info["name"], {})[backend] = results
+        rows.extend((info["name"], backend, profile, m) for profile, m in results.items())
+        if not args.dry_run:
+            save_results(info, backend, results, args.images, len(image_paths), args.update_accuracy)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print_summary(rows)
+    return 0 if rows else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
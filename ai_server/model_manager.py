@@ -1,15 +1,23 @@
 import os
-from supabase import create_client
-from ultralytics import YOLO
+import threading
+import time
 from dotenv import load_dotenv
+from ai_server.worker_pool import INFERENCE_WORKERS
+from ai_server.backends import PYTORCH, load_runtime, prepare_runtime, resolve_backend
+from ai_server.metrics import get_logger, inc, observe, model_loads, model_load_seconds
+
+log = get_logger("model_manager")
 
 env_path = os.path.join(os.path.dirname(__file__), "..", "backend", ".env")
 load_dotenv(env_path)
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+# Dùng chung client (và pool kết nối) với supabase_utils
+from ai_server.supabase_utils import supabase
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Thời gian (giây) giữ cache bản ghi ai_models trước khi hỏi lại Supabase
+MODEL_INFO_TTL = float(os.getenv("MODEL_INFO_TTL", "30"))
+# Kích thước ảnh giả dùng để warm-up mô hình
+MODEL_WARMUP_IMGSZ = int(os.getenv("MODEL_WARMUP_IMGSZ", "640"))
 
 def get_active_model_info():
     """Trả về thông tin mô hình đang được kích hoạt (is_active=True)."""
@@ -18,10 +26,181 @@ def get_active_model_info():
         raise Exception("❌ Không có mô hình nào đang kích hoạt.")
     return res.data[0]
 
-def get_active_model_path():
-    """Trả về đường dẫn file trọng số (best.pt) của mô hình active."""
-    info = get_active_model_info()
+def resolve_model_path(info):
+    """Trả về đường dẫn tuyệt đối tới file trọng số của một bản ghi ai_models."""
     model_path = os.path.abspath(os.path.join("ai_server", info["file_path"]))
     if not os.path.exists(model_path):
         raise FileNotFoundError(f"❌ Không tìm thấy file trọng số tại: {model_path}")
     return model_path
+
+
+# ==========================================================
+# 🧠 MODEL REGISTRY - GIỮ MÔ HÌNH ACTIVE TRONG BỘ NHỚ
+# ==========================================================
+class LoadedModel:
+    """Mô hình YOLO đã nạp sẵn cùng bản ghi ai_models tương ứng."""
+
+    def __init__(self, model, info, path, mtime, backend=PYTORCH, runtime_path=None):
+        self.model = model
+        self.info = info
+        self.path = path
+        self.mtime = mtime
+        # Backend thực sự dùng (có thể là pytorch nếu export/parity thất bại)
+        self.backend = backend
+        self.runtime_path = runtime_path or path
+        self.requested_backend = resolve_backend(info)
+        # YOLO không an toàn khi nhiều thread cùng predict trên một instance
+        self._predict_lock = threading.Lock()
+
+    @property
+    def model_id(self):
+        return self.info["model_id"]
+
+    @property
+    def names(self):
+        return self.model.names if self.model is not None else None
+
+    def predict(self, source, **kwargs):
+        """Chạy model.predict trên instance này (tuần tự hóa giữa các thread)."""
+        with self._predict_lock:
+            return self.model.predict(source, **kwargs)
+
+    def is_stale(self, info, path, mtime):
+        """True nếu bản ghi active hoặc file trọng số đã khác với bản đang nạp."""
+        return (
+            self.model_id != info["model_id"]
+            or self.path != path
+            or self.mtime != mtime
+            or self.requested_backend != resolve_backend(info)
+        )
+
+
+class ModelRegistry:
+    """
+    Registry dùng chung cho cả process: nạp trọng số active một lần,
+    cache bản ghi ai_models theo TTL và hot-swap khi trigger
+    trg_single_active_model đổi is_active hoặc file trọng số thay đổi.
+
+    Việc nạp mô hình mới diễn ra ngoài đường đi của request: các request
+    đang chạy vẫn giữ tham chiếu tới LoadedModel cũ, chỉ con trỏ
+    `_current` được thay thế (atomic) khi mô hình mới đã sẵn sàng.
+
+    Với load_weights=False (inference chạy trong pool process riêng),
+    registry chỉ theo dõi bản ghi + file trọng số, không nạp YOLO vào process này.
+    """
+
+    def __init__(self, ttl=MODEL_INFO_TTL, load_weights=True):
+        self.ttl = ttl
+        self.load_weights = load_weights
+        self._current = None
+        self._checked_at = 0.0
+        self._refresh_lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Đăng ký callback(old, new) được gọi sau mỗi lần đổi mô hình."""
+        self._listeners.append(callback)
+
+    def get(self):
+        """Trả về LoadedModel hiện tại, kiểm tra lại Supabase khi hết TTL."""
+        current = self._current
+        if current is not None and time.monotonic() - self._checked_at < self.ttl:
+            return current
+        return self._refresh(current)
+
+    def invalidate(self):
+        """Buộc lần gọi get() tiếp theo kiểm tra lại bản ghi active."""
+        self._checked_at = 0.0
+
+    def _refresh(self, current):
+        if current is not None:
+            # Đã có mô hình: nếu thread khác đang refresh thì dùng tạm bản cũ
+            if not self._refresh_lock.acquire(blocking=False):
+                return current
+        else:
+            self._refresh_lock.acquire()
+
+        try:
+            current = self._current
+            if current is not None and time.monotonic() - self._checked_at < self.ttl:
+                return current
+
+            try:
+                info = get_active_model_info()
+                path = resolve_model_path(info)
+                mtime = os.path.getmtime(path)
+            except Exception as e:
+                if current is None:
+                    raise
+                log.warning(f"⚠️ Không kiểm tra được mô hình active, tiếp tục dùng bản đang nạp: {e}")
+                self._checked_at = time.monotonic()
+                return current
+
+            if current is None or current.is_stale(info, path, mtime):
+                loaded = self._load(info, path, mtime)
+                self._current = loaded
+                if current is not None:
+                    inc(model_loads, model=info['name'], backend=loaded.backend, result="swapped")
+                    log.info(f"🔁 Đã hot-swap mô hình: {current.info['name']} → {info['name']} (v{info['version']})")
+                self._notify(current, loaded)
+            else:
+                current.info = info
+
+            self._checked_at = time.monotonic()
+            return self._current
+        finally:
+            self._refresh_lock.release()
+
+    def _notify(self, old, new):
+        for callback in list(self._listeners):
+            try:
+                callback(old, new)
+            except Exception as e:
+                log.warning(f"⚠️ Lỗi trong listener đổi mô hình: {e}")
+
+    def _load(self, info, path, mtime):
+        # Export sang ONNX/OpenVINO (nếu được cấu hình) trước khi nạp, kết quả export được cache
+        backend, runtime_path = prepare_runtime(info, path)
+        if not self.load_weights:
+            log.info(f"✅ Mô hình active: {info['name']} (v{info['version']}, {backend}) - nạp trong pool inference")
+            return LoadedModel(None, info, path, mtime, backend, runtime_path)
+
+        started = time.perf_counter()
+        try:
+            model = load_runtime(backend, runtime_path)
+        except Exception:
+            inc(model_loads, model=info['name'], backend=backend, result="failed")
+            raise
+        elapsed = (time.perf_counter() - started) * 1000
+        inc(model_loads, model=info['name'], backend=backend, result="loaded")
+        observe(model_load_seconds, elapsed / 1000, backend=backend)
+        log.info(f"✅ Đã nạp mô hình: {info['name']} (v{info['version']}, {backend}) trong {elapsed:.0f} ms")
+        log.info(f"📂 Trọng số: {runtime_path}")
+        return LoadedModel(model, info, path, mtime, backend, runtime_path)
+
+    def warmup(self, imgsz=MODEL_WARMUP_IMGSZ):
+        """Nạp mô hình active và chạy một lần predict trên ảnh rỗng."""
+        import numpy as np
+
+        loaded = self.get()
+        if loaded.model is None:
+            # Worker của pool tự warm-up khi nạp mô hình
+            return loaded
+        dummy = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+        started = time.perf_counter()
+        loaded.predict(dummy, imgsz=imgsz, verbose=False)
+        elapsed = (time.perf_counter() - started) * 1000
+        log.info(f"🔥 Warm-up mô hình {loaded.info['name']} xong trong {elapsed:.0f} ms")
+        return loaded
+
+
+# Khi bật pool process inference, process Flask không cần giữ trọng số
+registry = ModelRegistry(load_weights=INFERENCE_WORKERS == 0)
+
+def get_active_model():
+    """Trả về LoadedModel của mô hình đang active (dùng chung toàn process)."""
+    return registry.get()
+
+def warmup_active_model():
+    """Warm-up mô hình active, dùng khi khởi động server."""
+    return registry.warmup()
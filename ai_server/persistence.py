@@ -0,0 +1,199 @@
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import Future
+from ai_server.supabase_utils import supabase, build_prediction_rows, insert_prediction_rows, is_missing_function
+from ai_server.metrics import get_logger, span
+
+log = get_logger("persistence")
+
+# Gọi hàm SQL finalize_images (function_finalize_images.txt) để ghi predictions + trạng thái trong một transaction
+PERSIST_USE_RPC = os.getenv("PERSIST_USE_RPC", "1") == "1"
+# Write-behind: gom kết quả của nhiều ảnh rồi ghi một lần
+PERSIST_WRITE_BEHIND = os.getenv("PERSIST_WRITE_BEHIND", "0") == "1"
+PERSIST_BUFFER_MAX_IMAGES = int(os.getenv("PERSIST_BUFFER_MAX_IMAGES", "50"))
+PERSIST_BUFFER_FLUSH_MS = float(os.getenv("PERSIST_BUFFER_FLUSH_MS", "200"))
+
+_rpc_available = PERSIST_USE_RPC
+
+
+def build_item(image_id, predictions, status, file_path, thumbnail_path=None):
+    """Gói kết quả một ảnh thành item cho finalize_items."""
+    return {
+        "image_id": image_id,
+        "status": status,
+        "file_path": file_path,
+        "thumbnail_path": thumbnail_path,
+        "rows": build_prediction_rows(image_id, predictions or []),
+    }
+
+
+# ==========================================================
+# 💾 GHI KẾT QUẢ CUỐI CỦA ẢNH (PREDICTIONS + TRẠNG THÁI)
+# ==========================================================
+def finalize_items(items):
+    """
+    Ghi predictions và trạng thái cuối của nhiều ảnh.
+    Ưu tiên RPC finalize_images (một round-trip, một transaction);
+    chỉ khi database chưa có hàm mới dùng một multi-row insert
+    (có cô lập lỗi từng dòng) và cập nhật trạng thái theo nhóm.
+    Ghi lại cùng một ảnh nhiều lần không tạo predictions trùng.
+    """
+    global _rpc_available
+    if not items:
+        return
+
+    if _rpc_available:
+        try:
+            supabase.rpc("finalize_images", {"p_items": [
+                {
+                    "image_id": it["image_id"],
+                    "status": it["status"],
+                    "file_path": it["file_path"],
+                    "thumbnail_path": it.get("thumbnail_path"),
+                    "predictions": it["rows"],
+                }
+                for it in items
+            ]}).execute()
+            log.info(f"💾 Đã ghi kết quả {len(items)} ảnh qua finalize_images.")
+            return
+        except Exception as e:
+            # Lỗi khác (timeout, mất kết nối...) có thể xảy ra khi transaction đã
+            # commit: không chuyển sang ghi thủ công mà để nơi gọi retry RPC
+            # (finalize_images bỏ qua ảnh đã có predictions nên retry không ghi trùng)
+            if not is_missing_function(e):
+                raise
+            _rpc_available = False
+            log.warning("⚠️ Chưa có hàm finalize_images trong database, chuyển sang ghi nhiều request.")
+
+    # Bỏ qua ảnh đã có predictions (lần ghi trước đã thành công) để retry không ghi trùng
+    image_ids = [it["image_id"] for it in items if it["rows"]]
+    existing = set()
+    if image_ids:
+        res = supabase.table("predictions").select("image_id").in_("image_id", image_ids).execute()
+        existing = {row["image_id"] for row in (res.data or [])}
+    insert_prediction_rows([row for it in items if it["image_id"] not in existing for row in it["rows"]])
+
+    # Ảnh không đổi file_path và cùng trạng thái → một lệnh update cho cả nhóm
+    groups = {}
+    for it in items:
+        if it["file_path"]:
+            fields = {"status": it["status"], "file_path": it["file_path"]}
+            if it.get("thumbnail_path"):
+                fields["thumbnail_path"] = it["thumbnail_path"]
+            supabase.table("images").update(fields).eq("image_id", it["image_id"]).execute()
+        else:
+            groups.setdefault(it["status"], []).append(it["image_id"])
+    for status, image_ids in groups.items():
+        supabase.table("images").update({"status": status}).in_("image_id", image_ids).execute()
+    log.info(f"💾 Đã ghi kết quả {len(items)} ảnh.")
+
+
+def finalize_image(image_id, predictions, status="done", file_path=None, thumbnail_path=None):
+    """Ghi predictions và trạng thái cuối của một ảnh."""
+    finalize_items([build_item(image_id, predictions, status, file_path, thumbnail_path)])
+
+
+# ==========================================================
+# ⏳ WRITE-BEHIND BUFFER
+# ==========================================================
+class WriteBehindBuffer:
+    """
+    Gom kết quả của nhiều ảnh (từ nhiều request/job) và ghi một lần khi đủ
+    max_images ảnh, khi ảnh cũ nhất đã chờ quá flush_ms, hoặc khi tắt server.
+    add() trả về Future để nơi gọi có thể chờ dữ liệu thực sự được ghi.
+    """
+
+    def __init__(self, max_images=PERSIST_BUFFER_MAX_IMAGES, flush_ms=PERSIST_BUFFER_FLUSH_MS):
+        self.max_images = max(1, int(max_images))
+        self.flush_interval = max(0.0, float(flush_ms)) / 1000.0
+        self._items = []
+        self._oldest_at = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, image_id, predictions, status="done", file_path=None, thumbnail_path=None):
+        future = Future()
+        item = build_item(image_id, predictions, status, file_path, thumbnail_path)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind buffer đã đóng")
+            if not self._items:
+                self._oldest_at = time.monotonic()
+            self._items.append((item, future))
+            # Ảnh đầu tiên đánh thức thread ghi để hẹn giờ flush_ms (khi rỗng nó chờ không giới hạn)
+            if len(self._items) == 1 or len(self._items) >= self.max_images:
+                self._cond.notify()
+        return future
+
+    def flush(self):
+        """Ghi ngay toàn bộ dữ liệu đang chờ."""
+        with self._cond:
+            pending, self._items = self._items, []
+            self._oldest_at = None
+        if not pending:
+            return
+        with self._flush_lock:
+            try:
+                finalize_items([item for item, _ in pending])
+            except Exception as e:
+                log.error(f"❌ Lỗi khi ghi write-behind {len(pending)} ảnh: {e}")
+                for _, future in pending:
+                    future.set_exception(e)
+                return
+        for _, future in pending:
+            future.set_result(True)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.flush()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._items) >= self.max_images:
+                        break
+                    if self._items:
+                        remaining = self._oldest_at + self.flush_interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+            self.flush()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def get_write_behind_buffer():
+    """Buffer write-behind dùng chung toàn process (tạo khi cần)."""
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = WriteBehindBuffer()
+        return _buffer
+
+def persist_image_result(image_id, predictions, status="done", file_path=None, wait=True, thumbnail_path=None):
+    """
+    Lưu kết quả cuối của một ảnh. Khi bật PERSIST_WRITE_BEHIND, kết quả đi qua
+    buffer dùng chung; wait=True chờ tới khi lô chứa ảnh này được ghi xong.
+    """
+    with span("persist"):
+        if not PERSIST_WRITE_BEHIND:
+            finalize_image(image_id, predictions, status, file_path, thumbnail_path)
+            return
+
+        future = get_write_behind_buffer().add(image_id, predictions, status, file_path, thumbnail_path)
+        if wait:
+            future.result()
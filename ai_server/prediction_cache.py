@@ -0,0 +1,144 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Số ảnh giữ trong cache theo hash nội dung (khớp chính xác)
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "2048"))
+# Tầng gần trùng (perceptual hash) cho các frame gần giống nhau
+PREDICTION_CACHE_NEAR_SIZE = int(os.getenv("PREDICTION_CACHE_NEAR_SIZE", "256"))
+# Khoảng cách Hamming tối đa (trên 64 bit dHash) để coi là gần trùng
+PREDICTION_CACHE_NEAR_DISTANCE = int(os.getenv("PREDICTION_CACHE_NEAR_DISTANCE", "4"))
+# Số link Drive nhớ theo hash nội dung (tái dùng khi upload lại cùng ảnh)
+DRIVE_URL_CACHE_SIZE = int(os.getenv("DRIVE_URL_CACHE_SIZE", "4096"))
+
+
+def perceptual_hash(array):
+    """dHash 64 bit của ảnh BGR: so sánh độ sáng các điểm kề nhau trên ảnh 9x8 xám."""
+    import cv2
+
+    gray = cv2.cvtColor(array, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _copy_predictions(predictions):
+    return [dict(p) for p in predictions]
+
+
+class _LRU:
+    def __init__(self, max_size):
+        self.max_size = max(0, int(max_size))
+        self.items = OrderedDict()
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.max_size == 0:
+            return
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+# ==========================================================
+# 🧾 CACHE KẾT QUẢ DỰ ĐOÁN
+# ==========================================================
+class PredictionCache:
+    """
+    Cache kết quả inference theo (model_id, profile, hash nội dung).
+    Tầng gần trùng dùng dHash + kích thước ảnh để bắt các frame quét liên tiếp
+    gần như giống hệt nhau. Cache tự xóa khi mô hình active thay đổi.
+    """
+
+    def __init__(self, max_size=PREDICTION_CACHE_SIZE, near_size=PREDICTION_CACHE_NEAR_SIZE,
+                 near_distance=PREDICTION_CACHE_NEAR_DISTANCE, drive_size=DRIVE_URL_CACHE_SIZE):
+        self.near_distance = near_distance
+        self._exact = _LRU(max_size)
+        self._near = _LRU(near_size)
+        self._drive = _LRU(drive_size)
+        self._lock = threading.Lock()
+        self.hits_exact = 0
+        self.hits_near = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_exact(self, model_id, profile, digest):
+        with self._lock:
+            predictions = self._exact.get((model_id, profile, digest))
+            if predictions is not None:
+                self.hits_exact += 1
+                return _copy_predictions(predictions)
+        return None
+
+    def get_near(self, model_id, profile, shape, phash):
+        with self._lock:
+            best_key, best_distance = None, None
+            for key in self._near.items:
+                if key[0] != model_id or key[1] != profile or key[2] != shape:
+                    continue
+                distance = _hamming(key[3], phash)
+                if distance <= self.near_distance and (best_distance is None or distance < best_distance):
+                    best_key, best_distance = key, distance
+            if best_key is not None:
+                self.hits_near += 1
+                return _copy_predictions(self._near.get(best_key))
+        return None
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def put(self, model_id, profile, digest, predictions, shape=None, phash=None):
+        stored = _copy_predictions(predictions)
+        with self._lock:
+            self._exact.put((model_id, profile, digest), stored)
+            if phash is not None and shape is not None:
+                self._near.put((model_id, profile, shape, phash), stored)
+
+    def get_file_url(self, digest):
+        """Link Drive đã upload cho cùng nội dung ảnh (nếu có)."""
+        with self._lock:
+            return self._drive.get(digest)
+
+    def remember_file_url(self, digest, file_url):
+        with self._lock:
+            self._drive.put(digest, file_url)
+
+    def invalidate(self, *_):
+        """Xóa kết quả dự đoán (giữ link Drive vì không phụ thuộc mô hình)."""
+        with self._lock:
+            self._exact.clear()
+            self._near.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits_exact + self.hits_near + self.misses
+            return {
+                "entries": len(self._exact.items),
+                "near_entries": len(self._near.items),
+                "hits_exact": self.hits_exact,
+                "hits_near": self.hits_near,
+                "misses": self.misses,
+                "hit_rate": round((self.hits_exact + self.hits_near) / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+prediction_cache = PredictionCache()
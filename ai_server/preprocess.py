@@ -0,0 +1,113 @@
+import io
+import os
+from ai_server.prediction_cache import prediction_cache
+from ai_server.storage import get_upload_pool
+from ai_server.metrics import get_logger, span
+
+log = get_logger("preprocess")
+
+# Thu nhỏ ảnh một lần về cạnh dài = imgsz của profile trước khi đưa vào YOLO
+PREPROCESS_DOWNSCALE = os.getenv("PREPROCESS_DOWNSCALE", "1") == "1"
+# Ảnh hiển thị (thumbnail) lưu cạnh ảnh gốc để app không phải tải ảnh gốc
+THUMBNAIL_ENABLED = os.getenv("THUMBNAIL_ENABLED", "1") == "1"
+THUMBNAIL_MAX_SIDE = int(os.getenv("THUMBNAIL_MAX_SIDE", "720"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "75"))
+
+# Ghi chú về hướng ảnh: IngestedImage.array đã được xoay theo EXIF Orientation
+# (ai_server/ingest.py, apply_orientation), nên ảnh đưa vào model, tọa độ bbox
+# và thumbnail đều ở cùng hệ tọa độ "đã xoay" mà người dùng nhìn thấy.
+
+
+# ==========================================================
+# 📐 THU NHỎ ẢNH CHO MODEL + ĐỔI TỌA ĐỘ BBOX
+# ==========================================================
+def downscale(array, max_side):
+    """
+    Thu nhỏ ảnh (numpy BGR) để cạnh dài không vượt max_side (INTER_AREA).
+    Trả về (ảnh, scale_x, scale_y) với scale = kích thước gốc / kích thước mới;
+    ảnh đã đủ nhỏ được trả lại nguyên vẹn với scale = 1.
+    """
+    height, width = array.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return array, 1.0, 1.0
+
+    import cv2
+
+    ratio = max_side / max(height, width)
+    new_width = max(1, round(width * ratio))
+    new_height = max(1, round(height * ratio))
+    resized = cv2.resize(array, (new_width, new_height), interpolation=cv2.INTER_AREA)
+    return resized, width / new_width, height / new_height
+
+
+def rescale_predictions(predictions, scale_x, scale_y):
+    """Đưa bbox từ ảnh đã thu nhỏ về tọa độ ảnh gốc (trả về list mới)."""
+    if scale_x == 1.0 and scale_y == 1.0:
+        return predictions
+    rescaled = []
+    for p in predictions:
+        x1, y1, x2, y2 = p["bbox"][:4]
+        rescaled.append({**p, "bbox": [x1 * scale_x, y1 * scale_y, x2 * scale_x, y2 * scale_y]})
+    return rescaled
+
+
+def model_input(array, imgsz):
+    """Ảnh đưa vào model cho profile có imgsz (bỏ qua khi PREPROCESS_DOWNSCALE=0)."""
+    if not PREPROCESS_DOWNSCALE:
+        return array, 1.0, 1.0
+    with span("downscale"):
+        return downscale(array, imgsz)
+
+
+# ==========================================================
+# 🖼️ THUMBNAIL HIỂN THỊ
+# ==========================================================
+def make_thumbnail(array, max_side=THUMBNAIL_MAX_SIDE, quality=THUMBNAIL_QUALITY):
+    """
+    Nén ảnh hiển thị: cạnh dài tối đa max_side, WebP (JPEG nếu OpenCV không
+    hỗ trợ WebP). Trả về (bytes, mimetype, extension).
+    """
+    import cv2
+
+    with span("thumbnail"):
+        small, _, _ = downscale(array, max_side)
+        ok, buffer = cv2.imencode(".webp", small, [cv2.IMWRITE_WEBP_QUALITY, quality])
+        if ok:
+            return buffer.tobytes(), "image/webp", ".webp"
+        ok, buffer = cv2.imencode(".jpg", small, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError("❌ Không nén được thumbnail.")
+        return buffer.tobytes(), "image/jpeg", ".jpg"
+
+
+def thumbnail_filename(filename, extension):
+    stem = os.path.splitext(os.path.basename(filename or "image"))[0] or "image"
+    return f"{stem}_thumb{extension}"
+
+
+def thumbnail_key(digest):
+    """Khóa trong prediction_cache để dùng lại link thumbnail của cùng nội dung ảnh."""
+    return f"{digest}:thumb"
+
+
+def upload_thumbnail(image, folder_id=None):
+    """
+    Tạo và upload thumbnail của một IngestedImage lên storage hiện tại.
+    Thumbnail chỉ là bản phụ: lỗi được ghi log và trả về None.
+    """
+    if not THUMBNAIL_ENABLED:
+        return None
+    cached = prediction_cache.get_file_url(thumbnail_key(image.sha256))
+    if cached:
+        return cached
+    try:
+        data, mimetype, extension = make_thumbnail(image.array)
+        url = get_upload_pool().upload_fileobj(
+            io.BytesIO(data), thumbnail_filename(image.filename, extension), folder_id, mimetype, len(data)
+        )
+    except Exception as e:
+        log.warning(f"⚠️ Không tạo được thumbnail cho {image.filename}: {e}")
+        return None
+    prediction_cache.remember_file_url(thumbnail_key(image.sha256), url)
+    log.info(f"🖼️ Đã upload thumbnail ({len(data)} bytes, {mimetype}): {url}")
+    return url
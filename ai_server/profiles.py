@@ -0,0 +1,92 @@
+import json
+import os
+
+# ==========================================================
+# ⏱️ PROFILE SUY LUẬN (REALTIME / ACCURATE)
+# ==========================================================
+# Mỗi profile là tham số truyền cho model.predict, cộng thêm:
+#   - max_wait_ms: thời gian tối đa scheduler chờ gom batch cho profile này
+#   - latency_budget_ms: ngân sách độ trễ, vượt quá sẽ được cảnh báo trong log
+DEFAULT_PROFILES = {
+    # Quét liên tục trên app (/test): 1 lần forward, ảnh nhỏ, không ghi file
+    "realtime": {
+        "imgsz": 480,
+        "augment": False,
+        "conf": 0.35,
+        "iou": 0.5,
+        "max_det": 50,
+        "save": False,
+        "max_wait_ms": 5,
+        "latency_budget_ms": 150,
+    },
+    # Phân loại để lưu lịch sử (/upload): TTA như trước đây
+    "accurate": {
+        "imgsz": 640,
+        "augment": True,
+        "conf": 0.3,
+        "iou": 0.7,
+        "max_det": 300,
+        "save": False,
+        "max_wait_ms": 20,
+        "latency_budget_ms": 2000,
+    },
+}
+
+# Các khóa không phải tham số của model.predict
+SCHEDULING_KEYS = ("max_wait_ms", "latency_budget_ms")
+
+# Profile mặc định cho từng endpoint
+DEFAULT_UPLOAD_PROFILE = os.getenv("DEFAULT_UPLOAD_PROFILE", "accurate")
+DEFAULT_TEST_PROFILE = os.getenv("DEFAULT_TEST_PROFILE", "realtime")
+
+
+def _load_overrides():
+    """
+    Đọc cấu hình profile từ INFERENCE_PROFILES_PATH (file JSON) hoặc
+    INFERENCE_PROFILES (chuỗi JSON). Mỗi profile được ghép đè lên
+    profile mặc định cùng tên, profile mới được thêm vào.
+    """
+    raw = None
+    path = os.getenv("INFERENCE_PROFILES_PATH")
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            raw = f.read()
+    elif os.getenv("INFERENCE_PROFILES"):
+        raw = os.getenv("INFERENCE_PROFILES")
+    if not raw:
+        return {}
+
+    overrides = json.loads(raw)
+    if not isinstance(overrides, dict):
+        raise ValueError("❌ INFERENCE_PROFILES phải là object JSON {tên_profile: {...}}")
+    return overrides
+
+
+def load_profiles():
+    profiles = {name: dict(values) for name, values in DEFAULT_PROFILES.items()}
+    for name, values in _load_overrides().items():
+        profiles.setdefault(name, {}).update(values)
+    return profiles
+
+
+PROFILES = load_profiles()
+
+
+def get_profile(name):
+    """Trả về cấu hình của profile; raise ValueError nếu không tồn tại."""
+    profile = PROFILES.get(name)
+    if profile is None:
+        raise ValueError(f"Profile suy luận không hợp lệ: '{name}' (có: {', '.join(sorted(PROFILES))})")
+    return profile
+
+
+def predict_kwargs(name):
+    """Tham số model.predict của profile (bỏ các khóa dành cho scheduler)."""
+    return {k: v for k, v in get_profile(name).items() if k not in SCHEDULING_KEYS}
+
+
+def resolve_profile(requested, default):
+    """Chọn profile theo yêu cầu của request, rỗng thì dùng mặc định của endpoint."""
+    name = (requested or "").strip() or default
+    get_profile(name)
+    return name
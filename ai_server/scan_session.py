@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+import time
+from ai_server.ingest import IngestedImage
+from ai_server.profiles import DEFAULT_TEST_PROFILE, resolve_profile
+from ai_server.encoding import JSON, COMPACT, MSGPACK, compact_payload, negotiate
+from ai_server.metrics import get_logger
+
+log = get_logger("scan_session")
+
+# Số frame tối đa mỗi giây một phiên quét được nhận (vượt quá sẽ bị bỏ)
+SCAN_MAX_FPS = float(os.getenv("SCAN_MAX_FPS", "15"))
+# Kích thước tối đa của một frame (byte)
+SCAN_MAX_FRAME_BYTES = int(os.getenv("SCAN_MAX_FRAME_BYTES", str(4 * 1024 * 1024)))
+
+
+class _TokenBucket:
+    """Giới hạn tốc độ đơn giản: `rate` token/giây, tối đa `burst` token."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def allow(self):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+# ==========================================================
+# 📡 PHIÊN QUÉT REAL-TIME
+# ==========================================================
+class ScanSession:
+    """
+    Một phiên quét liên tục trên một kết nối (WebSocket).
+
+    Frame nhận được đặt vào một "ô" duy nhất: nếu inference chưa xử lý xong
+    frame trước, frame cũ trong ô bị thay bằng frame mới (drop), nên worker
+    luôn làm việc trên frame mới nhất và độ trễ không bị dồn.
+    Kết quả được gửi lại qua `send(text)` trên cùng kết nối; với encoding
+    compact/msgpack, predictions được gửi dạng cột (msgpack gửi message binary).
+    `send` được gọi từ cả thread nhận (lỗi, điều khiển) lẫn worker (kết quả)
+    nên luôn đi qua một lock: WebSocket không cho hai thread gửi cùng lúc.
+    """
+
+    def __init__(self, infer, send, profile=None, max_fps=SCAN_MAX_FPS, encoding=JSON):
+        self.infer = infer
+        self.send = send
+        self.profile = resolve_profile(profile, DEFAULT_TEST_PROFILE)
+        self.encoding = encoding
+        self._bucket = _TokenBucket(max_fps)
+
+        self._slot = None  # (seq, data, received_at)
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="scan-session", daemon=True)
+
+        self.received = 0
+        self.processed = 0
+        self.dropped_stale = 0
+        self.dropped_rate_limited = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+
+    # ------------------------------------------------------
+    # Nhận dữ liệu từ kết nối
+    # ------------------------------------------------------
+    def push_frame(self, data):
+        """Nhận một frame đã mã hóa (JPEG/PNG/WebP); trả về seq hoặc None nếu bị bỏ."""
+        self.received += 1
+        seq = self.received
+
+        if len(data) > SCAN_MAX_FRAME_BYTES:
+            self._send({"type": "error", "seq": seq, "error": "Frame vượt quá kích thước cho phép"})
+            return None
+
+        if not self._bucket.allow():
+            self.dropped_rate_limited += 1
+            return None
+
+        with self._cond:
+            if self._slot is not None:
+                self.dropped_stale += 1
+            self._slot = (seq, data, time.perf_counter())
+            self._cond.notify()
+        return seq
+
+    def handle_control(self, text):
+        """Xử lý message điều khiển dạng JSON, ví dụ {"profile": "accurate"}."""
+        try:
+            message = json.loads(text)
+        except ValueError:
+            self._send({"type": "error", "error": "Message điều khiển phải là JSON"})
+            return
+        if not isinstance(message, dict):
+            self._send({"type": "error", "error": "Message điều khiển phải là JSON object"})
+            return
+
+        if "profile" in message:
+            try:
+                self.profile = resolve_profile(message.get("profile"), DEFAULT_TEST_PROFILE)
+            except ValueError as e:
+                self._send({"type": "error", "error": str(e)})
+                return
+        if "format" in message:
+            self.encoding = negotiate(None, message.get("format"))
+        if message.get("type") == "stats" or "profile" in message:
+            self._send({"type": "stats", **self.stats()})
+
+    def stats(self):
+        return {
+            "profile": self.profile,
+            "format": self.encoding,
+            "received": self.received,
+            "processed": self.processed,
+            "dropped_stale": self.dropped_stale,
+            "dropped_rate_limited": self.dropped_rate_limited,
+        }
+
+    # ------------------------------------------------------
+    # Worker xử lý frame mới nhất
+    # ------------------------------------------------------
+    def _send(self, message):
+        encoding = self.encoding
+        if "predictions" in message and encoding != JSON:
+            message = compact_payload(message, binary=encoding == MSGPACK)
+        try:
+            if encoding == MSGPACK:
+                import msgpack
+
+                frame = msgpack.packb(message, use_bin_type=True)
+            elif encoding == COMPACT:
+                frame = json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+            else:
+                frame = json.dumps(message, ensure_ascii=False)
+            with self._send_lock:
+                self.send(frame)
+        except Exception as e:
+            log.warning(f"⚠️ Không gửi được kết quả quét: {e}")
+            with self._cond:
+                self._closed = True
+                self._cond.notify()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while self._slot is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                seq, data, received_at = self._slot
+                self._slot = None
+                dropped = self.dropped_stale + self.dropped_rate_limited
+
+            started = time.perf_counter()
+            try:
+                # infer nhận IngestedImage để có thể tra cache theo nội dung trước khi giải mã
+                result = self.infer(IngestedImage("frame.jpg", None, data=data), self.profile)
+            except Exception as e:
+                self._send({"type": "error", "seq": seq, "error": str(e)})
+                continue
+            finished = time.perf_counter()
+
+            self.processed += 1
+            predictions = result.get("predictions", [])
+            self._send({
+                "type": "result",
+                "seq": seq,
+                "profile": self.profile,
+                "predictions": predictions,
+                "has_predictions": len(predictions) > 0,
+                "dropped": dropped,
+                "cache": result.get("cache"),
+                "timing": {
+                    "queue_ms": round((started - received_at) * 1000, 1),
+                    "inference_ms": round((finished - started) * 1000, 1),
+                    "total_ms": round((finished - received_at) * 1000, 1),
+                },
+            })
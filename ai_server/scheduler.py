@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from ai_server.metrics import get_logger
+
+log = get_logger("scheduler")
+
+# Số ảnh tối đa trong một batch và thời gian chờ tối đa (ms) để gom batch
+INFERENCE_MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "8"))
+INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "10"))
+# Số batch gần nhất dùng để tính thống kê trượt
+STATS_WINDOW = 200
+
+
+class _PendingRequest:
+    __slots__ = ("source", "key", "future", "enqueued_at")
+
+    def __init__(self, source, key):
+        self.source = source
+        self.key = key
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+# ==========================================================
+# 📦 MICRO-BATCHING SCHEDULER
+# ==========================================================
+class InferenceScheduler:
+    """
+    Gom các ảnh gửi tới từ nhiều request thành batch và chạy một lần
+    `batch_fn(key, sources)` cho cả batch. Batch được xả khi đủ
+    max_batch_size ảnh hoặc ảnh đầu tiên đã chờ quá max_wait_ms.
+
+    Các request có `key` khác nhau (ví dụ tham số predict khác nhau)
+    không bao giờ nằm chung một batch.
+
+    max_in_flight > 1 cho phép nhiều batch chạy cùng lúc (khi batch_fn
+    chuyển việc sang pool process inference thay vì chạy trong process này).
+    """
+
+    def __init__(self, batch_fn, max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+                 max_wait_ms=INFERENCE_MAX_WAIT_MS, name="inference", max_wait_fn=None,
+                 max_in_flight=1):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+        # max_wait_fn(key) -> ms: thời gian chờ riêng theo key (None = dùng max_wait_ms)
+        self.max_wait_fn = max_wait_fn
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._slots = threading.Semaphore(self.max_in_flight)
+        self._executor = None
+
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        self._stats_lock = threading.Lock()
+        self._total_requests = 0
+        self._total_batches = 0
+        self._total_errors = 0
+        self._recent = deque(maxlen=STATS_WINDOW)  # (batch_size, max_wait_ms, run_ms)
+
+    # ------------------------------------------------------
+    # Vòng đời
+    # ------------------------------------------------------
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+            if self.max_in_flight > 1 and self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_in_flight, thread_name_prefix=f"{self.name}-batch")
+            self._thread = threading.Thread(target=self._loop, name=f"{self.name}-scheduler", daemon=True)
+            self._thread.start()
+        log.info(f"📦 Scheduler '{self.name}' chạy: batch tối đa {self.max_batch_size}, chờ tối đa {self.max_wait * 1000:.0f} ms")
+        return self
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    # ------------------------------------------------------
+    # API cho request
+    # ------------------------------------------------------
+    def submit(self, source, key=None):
+        """Đưa một ảnh vào hàng đợi, trả về Future chứa kết quả của riêng ảnh đó."""
+        if not self._running:
+            self.start()
+        request = _PendingRequest(source, key)
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify()
+        return request.future
+
+    def run(self, source, key=None, timeout=None):
+        """Gửi ảnh vào scheduler và chờ kết quả (dùng trong thread của request)."""
+        return self.submit(source, key).result(timeout)
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        """Thống kê độ sâu hàng đợi, kích thước batch và thời gian chờ."""
+        with self._stats_lock:
+            recent = list(self._recent)
+            total_requests = self._total_requests
+            total_batches = self._total_batches
+            total_errors = self._total_errors
+
+        def _avg(values):
+            return round(sum(values) / len(values), 2) if values else 0.0
+
+        sizes = [r[0] for r in recent]
+        waits = [r[1] for r in recent]
+        runs = [r[2] for r in recent]
+        return {
+            "queue_depth": self.queue_depth,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "max_in_flight": self.max_in_flight,
+            "total_requests": total_requests,
+            "total_batches": total_batches,
+            "total_errors": total_errors,
+            "avg_batch_size": _avg(sizes),
+            "avg_wait_ms": _avg(waits),
+            "max_wait_observed_ms": round(max(waits), 2) if waits else 0.0,
+            "avg_batch_run_ms": _avg(runs),
+        }
+
+    # ------------------------------------------------------
+    # Vòng lặp gom batch
+    # ------------------------------------------------------
+    def _max_wait_for(self, key):
+        if self.max_wait_fn is not None:
+            wait_ms = self.max_wait_fn(key)
+            if wait_ms is not None:
+                return max(0.0, float(wait_ms)) / 1000.0
+        return self.max_wait
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and self._running:
+                self._cond.wait()
+            if not self._pending:
+                return None, []
+
+            first = self._pending[0]
+            deadline = first.enqueued_at + self._max_wait_for(first.key)
+            while self._running:
+                same_key = sum(1 for r in self._pending if r.key == first.key)
+                remaining = deadline - time.monotonic()
+                if same_key >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, rest = [], deque()
+            for r in self._pending:
+                if r.key == first.key and len(batch) < self.max_batch_size:
+                    batch.append(r)
+                else:
+                    rest.append(r)
+            self._pending = rest
+            return first.key, batch
+
+    def _loop(self):
+        while True:
+            # Chờ còn chỗ trước khi gom batch, để ảnh mới tiếp tục dồn vào batch kế tiếp
+            self._slots.acquire()
+            key, batch = self._next_batch()
+            if not batch:
+                self._slots.release()
+                if not self._running:
+                    return
+                continue
+            if self._executor is not None:
+                self._executor.submit(self._execute, key, batch)
+            else:
+                self._execute(key, batch)
+
+    def _execute(self, key, batch):
+        try:
+            self._run_batch(key, batch)
+        finally:
+            self._slots.release()
+
+    def _run_batch(self, key, batch):
+        started = time.monotonic()
+        max_wait_ms = (started - batch[0].enqueued_at) * 1000
+        failed = False
+        try:
+            results = self.batch_fn(key, [r.source for r in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"batch_fn trả về {len(results)} kết quả cho {len(batch)} ảnh")
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+        except Exception as e:
+            failed = True
+            log.error(f"❌ Lỗi khi chạy batch {len(batch)} ảnh: {e}")
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+
+        run_ms = (time.monotonic() - started) * 1000
+        with self._stats_lock:
+            self._total_requests += len(batch)
+            self._total_batches += 1
+            self._total_errors += int(failed)
+            self._recent.append((len(batch), max_wait_ms, run_ms))
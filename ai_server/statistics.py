@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from ai_server.supabase_utils import supabase, is_missing_function
+from ai_server.metrics import get_logger
+
+log = get_logger("statistics")
+
+# Cache response thống kê theo user (giây) và số user tối đa giữ trong cache
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "10"))
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "1024"))
+
+_rpc_available = True
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _count(res):
+    if hasattr(res, 'count') and res.count is not None:
+        return res.count
+    return len(res.data) if res.data else 0
+
+
+def _compute_statistics_legacy(user_id):
+    """Cách tính cũ (quét images/predictions), chỉ dùng khi chưa tạo get_user_statistics."""
+    # 1. Lượt phân loại của người dùng hiện tại (số images có status = 'done')
+    user_images_res = supabase.table("images").select("image_id", count="exact").eq("user_id", user_id).eq("status", "done").execute()
+    user_classifications = _count(user_images_res)
+
+    # 2. Độ chính xác trung bình của người dùng hiện tại
+    user_images_list = supabase.table("images").select("image_id").eq("user_id", user_id).execute()
+    image_ids = [img["image_id"] for img in (user_images_list.data if user_images_list.data else [])]
+
+    avg_confidence = 0
+    if image_ids:
+        user_predictions_res = supabase.table("predictions").select("confidence").in_("image_id", image_ids).execute()
+        user_predictions = user_predictions_res.data if user_predictions_res.data else []
+        if user_predictions:
+            avg_confidence = sum(p.get("confidence", 0) for p in user_predictions) / len(user_predictions) * 100
+
+    # 3. Tổng số người dùng và 4. tổng số predictions
+    total_users = _count(supabase.table("users").select("user_id", count="exact").execute())
+    total_predictions = _count(supabase.table("predictions").select("prediction_id", count="exact").execute())
+
+    return {
+        "userClassifications": user_classifications,
+        "avgConfidence": round(avg_confidence, 1),
+        "totalUsers": total_users,
+        "totalPredictions": total_predictions
+    }
+
+
+def compute_user_statistics(user_id):
+    """
+    Đọc thống kê từ bộ đếm tăng dần trong database (statistics_supabase.txt):
+    một RPC, chi phí không phụ thuộc số predictions của user.
+    """
+    global _rpc_available
+    if _rpc_available:
+        try:
+            res = supabase.rpc("get_user_statistics", {"p_user_id": user_id}).execute()
+            stats = res.data or {}
+            return {
+                "userClassifications": int(stats.get("userClassifications", 0)),
+                "avgConfidence": float(stats.get("avgConfidence", 0)),
+                "totalUsers": int(stats.get("totalUsers", 0)),
+                "totalPredictions": int(stats.get("totalPredictions", 0))
+            }
+        except Exception as e:
+            if not is_missing_function(e):
+                raise
+            _rpc_available = False
+            log.warning("⚠️ Chưa có hàm get_user_statistics trong database, dùng cách tính cũ.")
+    return _compute_statistics_legacy(user_id)
+
+
+def get_user_statistics(user_id):
+    """Thống kê cho dashboard, cache ngắn hạn theo user (STATS_CACHE_TTL)."""
+    now = time.monotonic()
+    with _cache_lock:
+        entry = _cache.get(user_id)
+        if entry is not None and entry[0] > now:
+            _cache.move_to_end(user_id)
+            return entry[1]
+
+    stats = compute_user_statistics(user_id)
+
+    with _cache_lock:
+        _cache[user_id] = (time.monotonic() + STATS_CACHE_TTL, stats)
+        _cache.move_to_end(user_id)
+        while len(_cache) > STATS_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return stats
+
+
+def invalidate_user_statistics(user_id=None):
+    """Xóa cache thống kê của một user (hoặc toàn bộ khi user_id=None)."""
+    with _cache_lock:
+        if user_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(user_id, None)
@@ -0,0 +1,199 @@
+import contextvars
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ai_server.metrics import get_logger, span
+
+log = get_logger("storage")
+
+# Backend lưu ảnh gốc: "drive" (Google Drive) hoặc "local" (thư mục trên đĩa, dùng khi test/đo tải)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "drive")
+# Số upload chạy song song tối đa tới storage
+STORAGE_UPLOAD_WORKERS = int(os.getenv("STORAGE_UPLOAD_WORKERS", "4"))
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", os.path.join("uploads", "storage"))
+# URL gốc để phục vụ file của LocalStorage (bỏ trống → trả về file://)
+LOCAL_STORAGE_BASE_URL = os.getenv("LOCAL_STORAGE_BASE_URL", "")
+# Số upload gần nhất dùng để tính thống kê trượt
+STATS_WINDOW = 200
+
+
+# ==========================================================
+# 🗄️ BACKEND LƯU TRỮ ẢNH GỐC
+# ==========================================================
+class StorageBackend:
+    """Giao diện chung: upload ảnh và trả về URL công khai để lưu vào images.file_path."""
+
+    name = "base"
+
+    def upload_file(self, file_path, folder_id=None, mimetype=None):
+        raise NotImplementedError
+
+    def upload_fileobj(self, fileobj, filename, folder_id=None, mimetype=None, size=None):
+        raise NotImplementedError
+
+
+class DriveStorage(StorageBackend):
+    """Google Drive qua DriveClient dùng chung (nạp lười để backend local không cần credentials)."""
+
+    name = "drive"
+
+    def __init__(self):
+        from ai_server.upload_drive import drive_client
+
+        self.client = drive_client
+
+    def upload_file(self, file_path, folder_id=None, mimetype=None):
+        return self.client.upload_file(file_path, folder_id, mimetype)
+
+    def upload_fileobj(self, fileobj, filename, folder_id=None, mimetype=None, size=None):
+        return self.client.upload_fileobj(fileobj, filename, folder_id, mimetype, size)
+
+
+class LocalStorage(StorageBackend):
+    """Ghi ảnh vào thư mục cục bộ; thay cho Drive khi test hoặc đo throughput upload."""
+
+    name = "local"
+
+    def __init__(self, root=LOCAL_STORAGE_DIR, base_url=LOCAL_STORAGE_BASE_URL):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def _target(self, filename, folder_id):
+        directory = os.path.join(self.root, folder_id) if folder_id else self.root
+        os.makedirs(directory, exist_ok=True)
+        name = f"{uuid.uuid4().hex}_{os.path.basename(filename)}"
+        return directory, name
+
+    def _url(self, directory, name):
+        relative = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, "/")
+        if self.base_url:
+            return f"{self.base_url}/{relative}"
+        return f"file://{os.path.join(directory, name)}"
+
+    def upload_file(self, file_path, folder_id=None, mimetype=None):
+        directory, name = self._target(file_path, folder_id)
+        shutil.copyfile(file_path, os.path.join(directory, name))
+        return self._url(directory, name)
+
+    def upload_fileobj(self, fileobj, filename, folder_id=None, mimetype=None, size=None):
+        directory, name = self._target(filename, folder_id)
+        with open(os.path.join(directory, name), "wb") as out:
+            shutil.copyfileobj(fileobj, out)
+        return self._url(directory, name)
+
+
+STORAGE_BACKENDS = {
+    "drive": DriveStorage,
+    "local": LocalStorage,
+}
+
+
+# ==========================================================
+# 🚚 POOL UPLOAD SONG SONG CÓ GIỚI HẠN
+# ==========================================================
+class UploadPool:
+    """
+    Chạy upload tới storage trên một ThreadPoolExecutor có số worker cố định,
+    dùng chung cho /upload (đồng bộ) và job nền, để số kết nối tới storage
+    luôn bị chặn và throughput đo được ở một chỗ.
+    """
+
+    def __init__(self, backend, workers=STORAGE_UPLOAD_WORKERS):
+        self.backend = backend
+        self.workers = max(1, int(workers))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="storage-upload")
+
+        self._stats_lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._bytes = 0
+        self._recent = deque(maxlen=STATS_WINDOW)  # (finished_at, size, duration_ms)
+
+    def _run(self, fn, size, *args):
+        started = time.monotonic()
+        with self._stats_lock:
+            self._in_flight += 1
+        try:
+            with span("storage_upload"):
+                url = fn(*args)
+        except Exception:
+            with self._stats_lock:
+                self._failed += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self._in_flight -= 1
+        finished = time.monotonic()
+        with self._stats_lock:
+            self._completed += 1
+            self._bytes += size or 0
+            self._recent.append((finished, size or 0, (finished - started) * 1000))
+        return url
+
+    def submit_file(self, file_path, folder_id=None, mimetype=None):
+        """Upload file trên đĩa, trả về Future chứa URL."""
+        size = os.path.getsize(file_path)
+        # copy_context: span trong thread upload vẫn mang nhãn endpoint của request gọi
+        return self._executor.submit(
+            contextvars.copy_context().run, self._run, self.backend.upload_file, size, file_path, folder_id, mimetype
+        )
+
+    def submit_fileobj(self, fileobj, filename, folder_id=None, mimetype=None, size=None):
+        """Upload file-like (buffer trong RAM), trả về Future chứa URL."""
+        return self._executor.submit(
+            contextvars.copy_context().run,
+            self._run, self.backend.upload_fileobj, size, fileobj, filename, folder_id, mimetype, size
+        )
+
+    def upload_file(self, file_path, folder_id=None, mimetype=None):
+        return self.submit_file(file_path, folder_id, mimetype).result()
+
+    def upload_fileobj(self, fileobj, filename, folder_id=None, mimetype=None, size=None):
+        return self.submit_fileobj(fileobj, filename, folder_id, mimetype, size).result()
+
+    def stats(self):
+        """Số upload đang chạy, đã xong, lỗi và throughput trên cửa sổ gần nhất."""
+        with self._stats_lock:
+            recent = list(self._recent)
+            stats = {
+                "backend": self.backend.name,
+                "workers": self.workers,
+                "in_flight": self._in_flight,
+                "completed": self._completed,
+                "failed": self._failed,
+                "bytes_uploaded": self._bytes,
+            }
+
+        durations = [r[2] for r in recent]
+        span = recent[-1][0] - recent[0][0] if len(recent) > 1 else 0.0
+        stats["avg_upload_ms"] = round(sum(durations) / len(durations), 1) if durations else 0.0
+        stats["uploads_per_sec"] = round((len(recent) - 1) / span, 2) if span > 0 else 0.0
+        stats["mb_per_sec"] = round(sum(r[1] for r in recent[1:]) / span / (1024 * 1024), 3) if span > 0 else 0.0
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_storage(name=None):
+    """Tạo backend lưu trữ theo tên (mặc định STORAGE_BACKEND)."""
+    name = name or STORAGE_BACKEND
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(f"❌ Storage backend không hợp lệ: '{name}'. Hỗ trợ: {', '.join(STORAGE_BACKENDS)}")
+    return STORAGE_BACKENDS[name]()
+
+def get_upload_pool():
+    """Pool upload dùng chung cho cả process (tạo lần đầu khi cần)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = UploadPool(get_storage())
+                log.info(f"🚚 Pool upload '{_pool.backend.name}' chạy với {_pool.workers} worker")
+    return _pool
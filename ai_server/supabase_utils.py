@@ -1,26 +1,47 @@
 from supabase import create_client
 import os
 from dotenv import load_dotenv
+from ai_server.metrics import get_logger
+from ai_server.http_transport import supabase_client_options
 load_dotenv()
 
 url = os.getenv("SUPABASE_URL")
 key = os.getenv("SUPABASE_KEY")
-supabase = create_client(url, key)
+# Client duy nhất của cả process (model_manager, statistics, persistence... đều dùng lại)
+supabase = create_client(url, key, options=supabase_client_options())
+
+log = get_logger("supabase_utils")
+
+def is_missing_function(error):
+    """True nếu lỗi RPC là do chưa tạo hàm SQL trong database (PostgREST PGRST202)."""
+    return getattr(error, "code", None) == "PGRST202" or "PGRST202" in str(error)
 
 # ==========================================================
 # 1️⃣ TẠO BẢN GHI ẢNH BAN ĐẦU
 # ==========================================================
-def create_image_record(user_id, local_path):
-    """Tạo bản ghi ảnh với trạng thái ban đầu là 'uploaded'."""
+def create_image_record(user_id, local_path, status="uploaded"):
+    """Tạo bản ghi ảnh với trạng thái ban đầu (mặc định là 'uploaded')."""
     res = supabase.table("images").insert({
         "user_id": user_id,
         "file_path": local_path,
-        "status": "uploaded"
+        "status": status
     }).execute()
     if not res.data:
         raise Exception("❌ Không thể tạo record ảnh trong Supabase.")
     return res.data[0]["image_id"]
 
+def create_image_records(user_id, file_paths, status="uploaded"):
+    """Tạo nhiều bản ghi ảnh bằng một request; trả về image_id theo đúng thứ tự file_paths."""
+    if not file_paths:
+        return []
+    res = supabase.table("images").insert([
+        {"user_id": user_id, "file_path": path, "status": status}
+        for path in file_paths
+    ]).execute()
+    if not res.data or len(res.data) != len(file_paths):
+        raise Exception("❌ Không thể tạo record ảnh trong Supabase.")
+    return [row["image_id"] for row in res.data]
+
 # ==========================================================
 # 2️⃣ CẬP NHẬT TRẠNG THÁI ẢNH
 # ==========================================================
@@ -30,17 +51,14 @@ def update_image_status(image_id, status, new_path=None):
     if new_path:
         data["file_path"] = new_path
     supabase.table("images").update(data).eq("image_id", image_id).execute()
-    print(f"🔄 Cập nhật ảnh {image_id}: {status}")
+    log.info(f"🔄 Cập nhật ảnh {image_id}: {status}")
 
 # ==========================================================
 # 3️⃣ LƯU PREDICTIONS
 # ==========================================================
-def save_predictions(image_id, predictions):
-    """Lưu danh sách dự đoán vào bảng predictions."""
-    if not predictions or not isinstance(predictions, list):
-        print("⚠️ Không có dự đoán nào để lưu.")
-        return
-
+def build_prediction_rows(image_id, predictions):
+    """Chuyển predictions từ inference thành các dòng của bảng predictions (bỏ qua dòng thiếu dữ liệu)."""
+    rows = []
     for idx, p in enumerate(predictions, start=1):
         try:
             category_id = p.get("category_id")
@@ -49,10 +67,10 @@ def save_predictions(image_id, predictions):
             confidence = p.get("confidence", 0.0)
 
             if category_id is None or model_id is None:
-                print(f"⚠️ Dự đoán {idx}: thiếu category_id hoặc model_id, bỏ qua.")
+                log.warning(f"⚠️ Dự đoán {idx}: thiếu category_id hoặc model_id, bỏ qua.")
                 continue
 
-            data = {
+            rows.append({
                 "image_id": image_id,
                 "category_id": category_id,
                 "model_id": model_id,
@@ -61,13 +79,45 @@ def save_predictions(image_id, predictions):
                 "bbox_y1": bbox[1],
                 "bbox_x2": bbox[2],
                 "bbox_y2": bbox[3]
-            }
-
-            res_pred = supabase.table("predictions").insert(data).execute()
-            print(f"✅ Prediction {idx} saved:", res_pred.data)
+            })
 
         except Exception as e:
-            print(f"❌ Lỗi khi lưu prediction {idx}: {e}")
+            log.error(f"❌ Lỗi khi chuẩn bị prediction {idx}: {e}")
+    return rows
+
+def insert_prediction_rows(rows):
+    """
+    Chèn nhiều dòng predictions bằng một request (multi-row insert).
+    Nếu cả lô bị từ chối, chèn lại từng dòng để dòng lỗi không kéo theo dòng khác.
+    Trả về số dòng đã lưu.
+    """
+    if not rows:
+        return 0
+
+    try:
+        res = supabase.table("predictions").insert(rows).execute()
+        saved = len(res.data) if res.data else len(rows)
+        log.info(f"✅ Đã lưu {saved} predictions trong một lần insert.")
+        return saved
+    except Exception as e:
+        log.warning(f"⚠️ Insert cả lô {len(rows)} predictions lỗi, thử lưu từng dòng: {e}")
+
+    saved = 0
+    for idx, row in enumerate(rows, start=1):
+        try:
+            supabase.table("predictions").insert(row).execute()
+            saved += 1
+        except Exception as e:
+            log.error(f"❌ Lỗi khi lưu prediction {idx}: {e}")
+    return saved
+
+def save_predictions(image_id, predictions):
+    """Lưu danh sách dự đoán vào bảng predictions (một request cho cả ảnh)."""
+    if not predictions or not isinstance(predictions, list):
+        log.warning("⚠️ Không có dự đoán nào để lưu.")
+        return
+
+    insert_prediction_rows(build_prediction_rows(image_id, predictions))
             
 # def save_image_record(user_id, file_url, predictions):
 #     """Lưu thông tin ảnh và các dự đoán tương ứng vào Supabase."""
@@ -1,9 +1,13 @@
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
-import os, pickle, json
+import os, json, mimetypes, threading
+from ai_server.metrics import get_logger
+from ai_server.http_transport import RequestsHttp, get_session, mount_pool
+
+log = get_logger("upload_drive")
 
 # Ứng dụng này chỉ có quyền truy cập các file mà chính nó tạo hoặc tải lên.
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
@@ -11,13 +15,21 @@ SCOPES = ['https://www.googleapis.com/auth/drive.file']
 base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "backend"))
 cred_path = os.getenv("GOOGLE_CREDENTIALS_PATH", "credentials.json")
 token_path = os.getenv("GOOGLE_TOKEN_PATH","token.json")
-flow = InstalledAppFlow.from_client_secrets_file(cred_path, SCOPES)
 
 # 🔹 Chuyển thành đường dẫn tuyệt đối để tránh lỗi khi chạy Flask từ gốc dự án
 cred_path = os.path.abspath(cred_path)
 token_path = os.path.abspath(token_path)
 
-def get_drive_service():
+# File lớn hơn ngưỡng này (byte) được upload dạng resumable theo từng chunk
+DRIVE_RESUMABLE_THRESHOLD = int(os.getenv("DRIVE_RESUMABLE_THRESHOLD", str(5 * 1024 * 1024)))
+DRIVE_CHUNK_SIZE = int(os.getenv("DRIVE_CHUNK_SIZE", str(4 * 1024 * 1024)))
+# Số lần retry (backoff của googleapiclient) cho mỗi request tới Drive
+DRIVE_NUM_RETRIES = int(os.getenv("DRIVE_NUM_RETRIES", "3"))
+# Folder đích đã chia sẻ công khai → file con kế thừa quyền, bỏ qua permissions().create
+DRIVE_PUBLIC_FOLDER = os.getenv("DRIVE_PUBLIC_FOLDER", "0") == "1"
+
+
+def _load_credentials():
     creds = None
 
     # ✅ Kiểm tra token tồn tại ở đúng đường dẫn cấu hình
@@ -27,32 +39,110 @@ def get_drive_service():
     # 🔄 Nếu chưa có token hoặc token hết hạn → yêu cầu đăng nhập lại
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(Request(session=get_session()))
         else:
-            print("⚠️ Đang xác thực Google Drive API...")
+            log.info("⚠️ Đang xác thực Google Drive API...")
             flow = InstalledAppFlow.from_client_secrets_file(cred_path, SCOPES)
             creds = flow.run_local_server(port=0)
+        _save_credentials(creds)
 
-        # 💾 Lưu lại token mới để lần sau không cần xác thực nữa
-        with open(token_path, "w") as token:
-            token.write(creds.to_json())
+    return creds
 
-    print(f"✅ Đã sẵn sàng kết nối Google Drive.\n📂 Token: {token_path}")
-    return build("drive", "v3", credentials=creds)
+def _save_credentials(creds):
+    # 💾 Lưu lại token mới để lần sau không cần xác thực nữa
+    with open(token_path, "w") as token:
+        token.write(creds.to_json())
 
-def upload_to_drive(file_path, folder_id=None):
-    service = get_drive_service()
 
-    file_metadata = {'name': os.path.basename(file_path)}
-    if folder_id:
-        file_metadata['parents'] = [folder_id]
+# ==========================================================
+# ☁️ GOOGLE DRIVE CLIENT DÙNG CHUNG
+# ==========================================================
+class DriveClient:
+    """
+    Client Drive được khởi tạo một lần cho cả process: credentials đọc từ
+    token.json một lần và được refresh tại chỗ khi hết hạn. Service của
+    googleapiclient gửi request qua pool kết nối dùng chung (http_transport)
+    thay vì httplib2, nên một service phục vụ được mọi thread upload.
+    """
+
+    def __init__(self):
+        self._creds = None
+        self._creds_lock = threading.Lock()
+        self._service = None
+        self._service_creds = None
+
+    def credentials(self):
+        with self._creds_lock:
+            if self._creds is None:
+                self._creds = _load_credentials()
+                log.info(f"✅ Đã sẵn sàng kết nối Google Drive.\n📂 Token: {token_path}")
+            elif not self._creds.valid and self._creds.refresh_token:
+                self._creds.refresh(Request(session=get_session()))
+                _save_credentials(self._creds)
+                log.info("🔄 Đã làm mới token Google Drive.")
+            return self._creds
+
+    def service(self):
+        creds = self.credentials()
+        with self._creds_lock:
+            if self._service is None or self._service_creds is not creds:
+                session = mount_pool(AuthorizedSession(creds, auth_request=Request(session=get_session())))
+                self._service = build("drive", "v3", http=RequestsHttp(session), cache_discovery=False)
+                self._service_creds = creds
+            return self._service
+
+    def upload(self, media, filename, folder_id=None):
+        """Tạo file trên Drive từ media đã chuẩn bị và trả về link xem công khai."""
+        service = self.service()
+
+        file_metadata = {'name': filename}
+        if folder_id:
+            file_metadata['parents'] = [folder_id]
 
-    media = MediaFileUpload(file_path, mimetype='image/jpeg')
-    file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+        request = service.files().create(body=file_metadata, media_body=media, fields='id')
+        if media.resumable():
+            file = None
+            while file is None:
+                _, file = request.next_chunk(num_retries=DRIVE_NUM_RETRIES)
+        else:
+            file = request.execute(num_retries=DRIVE_NUM_RETRIES)
+
+        if not DRIVE_PUBLIC_FOLDER:
+            # Cấp quyền xem công khai
+            service.permissions().create(
+                fileId=file['id'], body={'type': 'anyone', 'role': 'reader'}
+            ).execute(num_retries=DRIVE_NUM_RETRIES)
+
+        drive_link = f"https://drive.google.com/uc?export=view&id={file['id']}"
+        log.info(f"☁️ Đã upload lên Google Drive: {drive_link}")
+        return drive_link
+
+    def upload_file(self, file_path, folder_id=None, mimetype=None):
+        mimetype = mimetype or mimetypes.guess_type(file_path)[0] or 'image/jpeg'
+        resumable = os.path.getsize(file_path) > DRIVE_RESUMABLE_THRESHOLD
+        media = MediaFileUpload(
+            file_path, mimetype=mimetype, resumable=resumable, chunksize=DRIVE_CHUNK_SIZE
+        )
+        return self.upload(media, os.path.basename(file_path), folder_id)
+
+    def upload_fileobj(self, fileobj, filename, folder_id=None, mimetype=None, size=None):
+        mimetype = mimetype or mimetypes.guess_type(filename)[0] or 'image/jpeg'
+        resumable = size is not None and size > DRIVE_RESUMABLE_THRESHOLD
+        media = MediaIoBaseUpload(
+            fileobj, mimetype=mimetype, resumable=resumable, chunksize=DRIVE_CHUNK_SIZE
+        )
+        return self.upload(media, filename, folder_id)
 
-    # Cấp quyền xem công khai
-    service.permissions().create(fileId=file['id'], body={'type': 'anyone', 'role': 'reader'}).execute()
 
-    drive_link = f"https://drive.google.com/uc?export=view&id={file['id']}"
-    print(f"☁️ Đã upload lên Google Drive: {drive_link}")
-    return drive_link
\ No newline at end of file
+drive_client = DriveClient()
+
+def get_drive_service():
+    """Service Drive dùng chung (tạo một lần, dùng lại các lần sau)."""
+    return drive_client.service()
+
+def upload_to_drive(file_path, folder_id=None):
+    return drive_client.upload_file(file_path, folder_id)
+
+def upload_fileobj_to_drive(fileobj, filename, folder_id=None, mimetype=None):
+    """Upload trực tiếp từ buffer trong bộ nhớ (không cần file tạm trên đĩa); mimetype đoán theo tên file nếu bỏ trống."""
+    return drive_client.upload_fileobj(fileobj, filename, folder_id, mimetype)
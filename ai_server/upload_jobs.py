@@ -0,0 +1,133 @@
+import io
+import os
+from datetime import datetime, timedelta, timezone
+from ai_server.job_queue import JobQueue
+from ai_server.storage import get_upload_pool
+from ai_server.supabase_utils import supabase, update_image_status
+from ai_server.persistence import persist_image_result
+from ai_server.prediction_cache import prediction_cache
+from ai_server.history import invalidate_user_history
+from ai_server.statistics import invalidate_user_statistics
+from ai_server.ingest import IngestedImage
+from ai_server.preprocess import THUMBNAIL_ENABLED, upload_thumbnail
+from ai_server.metrics import get_logger
+
+log = get_logger("upload_jobs")
+
+UPLOAD_JOB = "upload"
+# Ảnh 'processing' lâu hơn ngưỡng này (giây) mà không có job nào được coi là bị bỏ dở (0 = tắt)
+UPLOAD_ORPHAN_SECONDS = float(os.getenv("UPLOAD_ORPHAN_SECONDS", "900"))
+
+# ==========================================================
+# ☁️ JOB HẬU XỬ LÝ SAU /upload
+# ==========================================================
+def process_upload_job(job):
+    """
+    Upload ảnh gốc (và thumbnail hiển thị) lên Google Drive, lưu predictions
+    và chuyển ảnh sang 'done'.
+    Mỗi bước xong được ghi vào payload để lần retry không làm lại
+    (tránh upload trùng file hoặc chèn trùng predictions).
+    """
+    payload = job.payload
+    image_id = job.image_id
+    temp_path = payload.get("temp_path")
+
+    file_url = payload.get("file_url")
+    if not file_url:
+        if job.blob is not None:
+            # Ảnh nhỏ được lưu ngay trong job, upload thẳng từ bộ nhớ
+            file_url = get_upload_pool().upload_fileobj(
+                io.BytesIO(job.blob), payload["filename"], payload.get("folder_id"),
+                payload.get("mimetype", "image/jpeg"), len(job.blob)
+            )
+        else:
+            file_url = get_upload_pool().upload_file(temp_path, payload.get("folder_id"), payload.get("mimetype"))
+        job.save_progress(file_url=file_url)
+        log.info(f"☁️ [JOB {job.job_id}] Đã upload ảnh {image_id} lên storage: {file_url}")
+        if payload.get("sha256"):
+            prediction_cache.remember_file_url(payload["sha256"], file_url)
+
+    thumbnail_url = payload.get("thumbnail_url")
+    if THUMBNAIL_ENABLED and "thumbnail_url" not in payload and (job.blob is not None or temp_path):
+        # Giải mã lại ảnh trong job nền để request /upload không phải chờ nén thumbnail
+        image = IngestedImage(payload["filename"], payload.get("mimetype"), data=job.blob, path=temp_path)
+        thumbnail_url = upload_thumbnail(image, payload.get("folder_id"))
+        job.save_progress(thumbnail_url=thumbnail_url)
+
+    if not payload.get("finalized"):
+        # Predictions + trạng thái 'done' được ghi cùng nhau
+        persist_image_result(image_id, payload.get("predictions") or [], "done", file_url, thumbnail_path=thumbnail_url)
+        job.save_progress(finalized=True)
+        if payload.get("user_id"):
+            invalidate_user_statistics(payload["user_id"])
+            invalidate_user_history(payload["user_id"])
+
+    _remove_temp_file(temp_path)
+
+def on_upload_failed(job, error):
+    """Hết lượt retry: đánh dấu ảnh 'failed' và dọn file tạm."""
+    update_image_status(job.image_id, "failed")
+    _remove_temp_file(job.payload.get("temp_path"))
+
+def _remove_temp_file(path):
+    try:
+        if path and os.path.exists(path):
+            os.remove(path)
+    except Exception as e:
+        log.warning(f"⚠️ Không thể xóa file tạm: {e}")
+
+
+upload_queue = JobQueue({UPLOAD_JOB: process_upload_job}, on_failed=on_upload_failed, name="upload")
+
+def enqueue_upload(image_id, image, predictions, folder_id=None, file_url=None, user_id=None, thumbnail_url=None):
+    """
+    Đưa phần upload Drive + lưu Supabase của một ảnh (IngestedImage) vào hàng đợi nền.
+    Ảnh trong RAM được lưu kèm job; ảnh đã spill ra đĩa thì job giữ đường dẫn
+    và tự xóa file khi xong. Nếu đã có file_url (cùng nội dung đã upload trước đó,
+    kèm thumbnail_url nếu có) thì job chỉ còn bước lưu Supabase. user_id dùng
+    để làm mới cache thống kê và lịch sử khi xong.
+    """
+    payload = {
+        "filename": image.filename,
+        "mimetype": image.mimetype,
+        "folder_id": folder_id,
+        "predictions": predictions,
+        "sha256": image.sha256,
+        "user_id": user_id,
+    }
+    if file_url:
+        payload["file_url"] = file_url
+        payload["thumbnail_url"] = thumbnail_url
+        return upload_queue.enqueue(UPLOAD_JOB, payload, image_id=image_id)
+    if image.data is not None:
+        return upload_queue.enqueue(UPLOAD_JOB, payload, image_id=image_id, blob=image.data)
+
+    payload["temp_path"] = os.path.abspath(image.path)
+    return upload_queue.enqueue(UPLOAD_JOB, payload, image_id=image_id)
+
+
+def sweep_orphaned_images(older_than=UPLOAD_ORPHAN_SECONDS):
+    """
+    Chuyển sang 'failed' các ảnh còn 'processing' quá older_than giây mà không
+    có job trong hàng đợi (server tắt giữa create_image_record và enqueue_upload).
+    Trả về số ảnh đã xử lý.
+    """
+    # images.created_at là TIMESTAMP (không múi giờ) theo giờ UTC của database
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=older_than)).replace(tzinfo=None).isoformat()
+    res = supabase.table("images").select("image_id").eq("status", "processing").lt("created_at", cutoff).execute()
+    orphaned = [row["image_id"] for row in (res.data or []) if upload_queue.get_by_image(row["image_id"]) is None]
+    if orphaned:
+        supabase.table("images").update({"status": "failed"}).in_("image_id", orphaned).eq("status", "processing").execute()
+        log.warning(f"⚠️ {len(orphaned)} ảnh 'processing' không có job, chuyển sang 'failed': {orphaned}")
+    return len(orphaned)
+
+
+def start_upload_queue():
+    """Khôi phục job dang dở, khởi động worker và dọn ảnh 'processing' bị bỏ dở."""
+    upload_queue.start()
+    if UPLOAD_ORPHAN_SECONDS <= 0:
+        return
+    try:
+        sweep_orphaned_images()
+    except Exception as e:
+        log.warning(f"⚠️ Không dọn được ảnh 'processing' bị bỏ dở: {e}")
@@ -0,0 +1,431 @@
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from ai_server.metrics import get_logger
+
+log = get_logger("worker_pool")
+
+# Số process inference (0 = chạy mô hình ngay trong process Flask như trước)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "0"))
+# Số thread PyTorch mỗi worker (mặc định chia đều số core cho các worker)
+INFERENCE_TORCH_THREADS = int(os.getenv(
+    "INFERENCE_TORCH_THREADS", str(max(1, (os.cpu_count() or 1) // max(1, INFERENCE_WORKERS)))
+))
+# Chu kỳ kiểm tra sức khỏe worker (giây)
+INFERENCE_HEALTH_INTERVAL = float(os.getenv("INFERENCE_HEALTH_INTERVAL", "2"))
+# Một batch chạy quá thời gian này (giây) thì worker bị coi là treo và được khởi động lại
+INFERENCE_TASK_TIMEOUT = float(os.getenv("INFERENCE_TASK_TIMEOUT", "60"))
+# Thời gian chờ worker nạp xong mô hình (giây)
+INFERENCE_START_TIMEOUT = float(os.getenv("INFERENCE_START_TIMEOUT", "180"))
+INFERENCE_WARMUP_IMGSZ = int(os.getenv("MODEL_WARMUP_IMGSZ", "640"))
+# Khởi động lại worker lỗi với thời gian chờ tăng gấp đôi (giây, tối đa INFERENCE_RESTART_BACKOFF_MAX);
+# quá INFERENCE_MAX_RESTARTS lần liên tiếp mà chưa worker nào của thế hệ đó sẵn sàng thì bỏ cuộc
+INFERENCE_RESTART_BACKOFF = float(os.getenv("INFERENCE_RESTART_BACKOFF", "1"))
+INFERENCE_RESTART_BACKOFF_MAX = float(os.getenv("INFERENCE_RESTART_BACKOFF_MAX", "60"))
+INFERENCE_MAX_RESTARTS = int(os.getenv("INFERENCE_MAX_RESTARTS", "5"))
+
+
+# ==========================================================
+# 🧵 CODE CHẠY TRONG PROCESS WORKER
+# ==========================================================
+def _attach_shared_memory(name):
+    """
+    Mở vùng nhớ do process cha tạo; chỉ process cha được quyền unlink.
+
+    Trước Python 3.13 không được unregister ở đây: process con (spawn) dùng
+    chung resource_tracker với process cha, unregister sẽ xóa luôn bản đăng ký
+    của cha và unlink() sau đó báo KeyError. Đăng ký trùng tên chỉ tính một lần,
+    cha unlink là đủ.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+def _worker_main(worker_id, generation, model_path, backend, torch_threads, tasks, results):
+    """Vòng lặp của một process worker: nạp mô hình một lần rồi xử lý batch từ `tasks`."""
+    import numpy as np
+
+    try:
+        import torch
+
+        torch.set_num_threads(torch_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # đã được thiết lập khi import trong process con
+
+        from ai_server.backends import load_runtime
+
+        model = load_runtime(backend, model_path)
+        model.predict(np.zeros((INFERENCE_WARMUP_IMGSZ, INFERENCE_WARMUP_IMGSZ, 3), dtype=np.uint8),
+                      imgsz=INFERENCE_WARMUP_IMGSZ, verbose=False)
+    except Exception as e:
+        results.put(("failed", worker_id, generation, str(e)))
+        return
+
+    results.put(("ready", worker_id, generation, dict(model.names)))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+
+        task_id, shm_name, layout, kwargs = task
+        shm = None
+        try:
+            shm = _attach_shared_memory(shm_name)
+            images = [
+                np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+                for offset, shape, dtype in layout
+            ]
+            output = model.predict(images, verbose=False, **kwargs)
+            boxes = [
+                (r.boxes.xyxy.tolist(), r.boxes.conf.tolist(), r.boxes.cls.tolist())
+                if r.boxes is not None else ([], [], [])
+                for r in output
+            ]
+            del images, output
+            results.put(("result", task_id, boxes))
+        except Exception as e:
+            results.put(("error", task_id, str(e)))
+        finally:
+            if shm is not None:
+                shm.close()
+
+
+# ==========================================================
+# 🏭 POOL PROCESS INFERENCE
+# ==========================================================
+class _Worker:
+    def __init__(self, worker_id, generation, model_id, process, tasks):
+        self.worker_id = worker_id
+        self.generation = generation
+        self.model_id = model_id
+        self.process = process
+        self.tasks = tasks
+        self.names = None
+        self.ready = False
+        self.stopping = False
+        self.in_flight = {}  # task_id -> thời điểm gửi
+        self.completed = 0
+        self.restarts = 0
+        self.error = None  # lỗi nạp mô hình (nếu có)
+
+
+class _Task:
+    __slots__ = ("future", "shm", "worker")
+
+    def __init__(self, future, shm, worker):
+        self.future = future
+        self.shm = shm
+        self.worker = worker
+
+
+class InferenceWorkerPool:
+    """
+    N process inference, mỗi process giữ mô hình của riêng mình và giới hạn
+    số thread PyTorch, nên các batch chạy song song thật sự trên nhiều core
+    thay vì tranh GIL trong process Flask.
+
+    Ảnh đã giải mã được chép một lần vào shared memory; worker chỉ nhận tên
+    vùng nhớ + vị trí từng ảnh (không pickle mảng ảnh). Thread giám sát khởi
+    động lại worker chết hoặc treo. Khi mô hình active đổi, worker thế hệ mới
+    được nạp trước; worker cũ xử lý nốt batch đang có rồi mới dừng (drain).
+    """
+
+    def __init__(self, workers=INFERENCE_WORKERS, torch_threads=INFERENCE_TORCH_THREADS):
+        self.size = max(1, int(workers))
+        self.torch_threads = max(1, int(torch_threads))
+        self._ctx = mp.get_context("spawn")
+        self._results = self._ctx.Queue()
+        self._lock = threading.Condition()
+        self._workers = {}
+        self._tasks = {}
+        self._ids = itertools.count(1)
+        self._task_ids = itertools.count(1)
+        self._generation = 0
+        self._model = None  # (model_id, path, backend)
+        self._running = False
+        self._restart_streak = {}  # thế hệ -> số lần khởi động lại liên tiếp chưa có worker sẵn sàng
+        self._pending_restarts = []  # (thời điểm, thế hệ, restarts)
+        self._given_up = {}  # thế hệ -> lỗi cuối cùng khi đã bỏ cuộc
+        self.restarts = 0
+        self.failed_tasks = 0
+
+    # ------------------------------------------------------
+    # Vòng đời
+    # ------------------------------------------------------
+    def start(self, model_id, model_path, backend="pytorch"):
+        with self._lock:
+            if self._running:
+                return self
+            self._running = True
+            self._model = (model_id, model_path, backend)
+            for _ in range(self.size):
+                self._spawn(self._generation)
+        threading.Thread(target=self._collect, name="inference-pool-results", daemon=True).start()
+        threading.Thread(target=self._monitor, name="inference-pool-health", daemon=True).start()
+        log.info(f"🏭 Pool inference: {self.size} process × {self.torch_threads} thread PyTorch")
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            workers = list(self._workers.values())
+            for worker in workers:
+                worker.stopping = True
+                worker.tasks.put(None)
+            self._lock.notify_all()
+        for worker in workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def reload(self, model_id, model_path, backend="pytorch"):
+        """Chuyển sang mô hình mới: nạp worker thế hệ mới, drain worker cũ khi thế hệ mới sẵn sàng."""
+        with self._lock:
+            if not self._running:
+                return
+            self._generation += 1
+            self._model = (model_id, model_path, backend)
+            for _ in range(self.size):
+                self._spawn(self._generation)
+        log.info(f"🔁 Pool inference đang nạp mô hình mới (thế hệ {self._generation})")
+
+    def _spawn(self, generation, worker_id=None):
+        model_id, model_path, backend = self._model
+        worker_id = worker_id or next(self._ids)
+        tasks = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, generation, model_path, backend, self.torch_threads, tasks, self._results),
+            name=f"inference-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        worker = _Worker(worker_id, generation, model_id, process, tasks)
+        self._workers[worker_id] = worker
+        return worker
+
+    def _retire_old_generations(self):
+        for worker in self._workers.values():
+            if worker.generation < self._generation and not worker.stopping:
+                worker.stopping = True
+                worker.tasks.put(None)  # worker chạy nốt các batch đã nhận rồi thoát
+
+    # ------------------------------------------------------
+    # Gửi batch
+    # ------------------------------------------------------
+    def _unavailable_error(self):
+        """Lỗi trả ngay cho submit khi thế hệ hiện tại đã bỏ cuộc và không còn worker nào phục vụ."""
+        if self._generation not in self._given_up:
+            return None
+        if any(not w.stopping for w in self._workers.values()):
+            return None
+        return (f"❌ Worker inference không nạp được mô hình {self._model[0]} sau "
+                f"{INFERENCE_MAX_RESTARTS} lần khởi động lại: {self._given_up[self._generation]}")
+
+    def _select_worker(self):
+        ready = [w for w in self._workers.values() if w.ready and not w.stopping]
+        if not ready:
+            return None
+        newest = max(w.generation for w in ready)
+        candidates = [w for w in ready if w.generation == newest]
+        return min(candidates, key=lambda w: len(w.in_flight))
+
+    def submit(self, images, kwargs):
+        """Gửi một batch ảnh (numpy) tới worker rảnh nhất; Future trả về (names, model_id, boxes)."""
+        layout, offset = [], 0
+        for image in images:
+            layout.append((offset, image.shape, image.dtype.str))
+            offset += image.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(1, offset))
+        try:
+            import numpy as np
+
+            for (start, shape, dtype), image in zip(layout, images):
+                np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=start)[...] = image
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+
+        future = Future()
+        deadline = time.monotonic() + INFERENCE_START_TIMEOUT
+        with self._lock:
+            worker = self._select_worker()
+            while worker is None:
+                remaining = deadline - time.monotonic()
+                error = self._unavailable_error()
+                if error or not self._running or remaining <= 0:
+                    shm.close()
+                    shm.unlink()
+                    raise RuntimeError(error or "❌ Không có worker inference nào sẵn sàng")
+                self._lock.wait(min(remaining, 1.0))
+                worker = self._select_worker()
+
+            task_id = next(self._task_ids)
+            self._tasks[task_id] = _Task(future, shm, worker)
+            worker.in_flight[task_id] = time.monotonic()
+            worker.tasks.put((task_id, shm.name, layout, kwargs))
+        return future
+
+    def predict(self, images, kwargs, timeout=None):
+        return self.submit(images, kwargs).result(timeout)
+
+    # ------------------------------------------------------
+    # Nhận kết quả và giám sát
+    # ------------------------------------------------------
+    def _finish(self, task_id, result=None, error=None):
+        task = self._tasks.pop(task_id, None)
+        if task is None:
+            return
+        task.worker.in_flight.pop(task_id, None)
+        task.shm.close()
+        task.shm.unlink()
+        if error is not None:
+            self.failed_tasks += 1
+            task.future.set_exception(RuntimeError(error))
+        else:
+            task.worker.completed += 1
+            task.future.set_result((task.worker.names, task.worker.model_id, result))
+
+    def _collect(self):
+        while True:
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if not self._running:
+                    return
+                continue
+
+            kind = message[0]
+            with self._lock:
+                if kind == "ready":
+                    _, worker_id, generation, names = message
+                    worker = self._workers.get(worker_id)
+                    if worker is not None:
+                        worker.names = names
+                        worker.ready = True
+                        self._restart_streak.pop(generation, None)
+                        self._given_up.pop(generation, None)
+                        if generation == self._generation:
+                            self._retire_old_generations()
+                        self._lock.notify_all()
+                elif kind == "failed":
+                    _, worker_id, generation, error = message
+                    worker = self._workers.get(worker_id)
+                    if worker is not None:
+                        worker.error = error
+                    log.error(f"❌ Worker inference {worker_id} không nạp được mô hình: {error}")
+                elif kind == "result":
+                    self._finish(message[1], result=message[2])
+                elif kind == "error":
+                    self._finish(message[1], error=message[2])
+
+    def _monitor(self):
+        while self._running:
+            time.sleep(INFERENCE_HEALTH_INTERVAL)
+            with self._lock:
+                now = time.monotonic()
+                for worker_id, worker in list(self._workers.items()):
+                    alive = worker.process.is_alive()
+                    if worker.stopping:
+                        if not alive:
+                            # Worker cũ đã drain xong (batch còn sót nếu có là do worker chết giữa chừng)
+                            for task_id in list(worker.in_flight):
+                                self._finish(task_id, error=f"Worker inference {worker_id} dừng khi đang drain")
+                            del self._workers[worker_id]
+                        continue
+
+                    hung = any(now - sent > INFERENCE_TASK_TIMEOUT for sent in worker.in_flight.values())
+                    if alive and not hung:
+                        continue
+
+                    reason = "bị treo" if alive else f"đã dừng (exit {worker.process.exitcode})"
+                    log.warning(f"⚠️ Worker inference {worker_id} {reason}, đang khởi động lại")
+                    if alive:
+                        worker.process.terminate()
+                    for task_id in list(worker.in_flight):
+                        self._finish(task_id, error=f"Worker inference {worker_id} {reason}")
+                    del self._workers[worker_id]
+                    if worker.generation == self._generation:
+                        self._schedule_restart(worker, now, worker.error or reason)
+
+                self._run_pending_restarts(now)
+
+    def _schedule_restart(self, worker, now, error):
+        """Hẹn khởi động lại worker với backoff tăng gấp đôi; quá số lần cho phép thì bỏ cuộc."""
+        generation = worker.generation
+        streak = self._restart_streak.get(generation, 0) + 1
+        self._restart_streak[generation] = streak
+        if streak > INFERENCE_MAX_RESTARTS:
+            if generation not in self._given_up:
+                self._given_up[generation] = error
+                log.error(f"❌ Thế hệ worker {generation} lỗi {INFERENCE_MAX_RESTARTS} lần liên tiếp, "
+                          f"ngừng khởi động lại: {error}")
+            self._lock.notify_all()  # submit đang chờ sẽ nhận lỗi ngay
+            return
+        delay = min(INFERENCE_RESTART_BACKOFF * 2 ** (streak - 1), INFERENCE_RESTART_BACKOFF_MAX)
+        self._pending_restarts.append((now + delay, generation, worker.restarts + 1))
+
+    def _run_pending_restarts(self, now):
+        pending = []
+        for due, generation, restarts in self._pending_restarts:
+            if generation != self._generation:
+                continue  # mô hình đã đổi, không cần thế hệ cũ nữa
+            if due > now:
+                pending.append((due, generation, restarts))
+                continue
+            replacement = self._spawn(generation)
+            replacement.restarts = restarts
+            self.restarts += 1
+        self._pending_restarts = pending
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.size,
+                "torch_threads": self.torch_threads,
+                "generation": self._generation,
+                "model_id": self._model[0] if self._model else None,
+                "backend": self._model[2] if self._model else None,
+                "restarts": self.restarts,
+                "pending_restarts": len(self._pending_restarts),
+                "given_up": self._generation in self._given_up,
+                "failed_tasks": self.failed_tasks,
+                "in_flight": len(self._tasks),
+                "processes": [{
+                    "worker_id": w.worker_id,
+                    "pid": w.process.pid,
+                    "generation": w.generation,
+                    "ready": w.ready,
+                    "draining": w.stopping,
+                    "alive": w.process.is_alive(),
+                    "in_flight": len(w.in_flight),
+                    "completed": w.completed,
+                } for w in self._workers.values()],
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_worker_pool(model_id, model_path, backend="pytorch"):
+    """Pool dùng chung cho process (tạo khi batch đầu tiên cần tới)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = InferenceWorkerPool().start(model_id, model_path, backend)
+    return _pool
+
+def current_worker_pool():
+    """Pool đã khởi động hoặc None."""
+    return _pool
@@ -0,0 +1,211 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import jwt
+from ai_server.http_transport import get_session
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_API_KEY = os.getenv("SUPABASE_ANON_KEY") or os.getenv("SUPABASE_KEY")
+
+# JWT secret của project (Settings → API → JWT Secret) cho token HS256
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+# JWKS cho token ký bằng khóa bất đối xứng (RS256/ES256)
+SUPABASE_JWKS_URL = os.getenv("SUPABASE_JWKS_URL") or (
+    f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json" if SUPABASE_URL else None
+)
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+# Gọi /auth/v1/user khi không xác thực được tại chỗ (thiếu secret, không tải được JWKS)
+AUTH_REMOTE_FALLBACK = os.getenv("AUTH_REMOTE_FALLBACK", "1") == "1"
+AUTH_REMOTE_TIMEOUT = float(os.getenv("AUTH_REMOTE_TIMEOUT", "10"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "1024"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
+# Sai lệch đồng hồ cho phép khi kiểm tra exp/iat (giây)
+AUTH_LEEWAY = float(os.getenv("AUTH_LEEWAY", "5"))
+
+ALLOWED_ALGORITHMS = ("HS256", "RS256", "ES256")
+
+
+class LocalVerificationUnavailable(Exception):
+    """Không đủ cấu hình/khóa để xác thực token tại chỗ."""
+
+
+# ==========================================================
+# 🗃️ CACHE LRU + TTL CHO TOKEN ĐÃ XÁC THỰC
+# ==========================================================
+class TokenCache:
+    """
+    Cache LRU các token đã xác thực. Mỗi mục hết hạn sau `ttl` giây
+    nhưng không bao giờ sống quá thời điểm `exp` của chính token.
+    Khóa là SHA-256 của token để không giữ token thô trong bộ nhớ.
+    """
+
+    def __init__(self, max_size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL):
+        self.max_size = max(0, int(max_size))
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def put(self, token, user, token_exp):
+        if self.max_size == 0:
+            return
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, float(token_exp))
+        if expires_at <= time.time():
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (user, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
+
+_jwks_client = None
+_jwks_lock = threading.Lock()
+
+def _get_jwks_client():
+    global _jwks_client
+    if not SUPABASE_JWKS_URL:
+        return None
+    with _jwks_lock:
+        if _jwks_client is None:
+            headers = {"apikey": SUPABASE_API_KEY} if SUPABASE_API_KEY else None
+            # PyJWKClient tự cache bộ khóa (mặc định 5 phút) và theo kid
+            _jwks_client = jwt.PyJWKClient(SUPABASE_JWKS_URL, cache_keys=True, headers=headers)
+        return _jwks_client
+
+
+def _user_from_claims(claims):
+    """Dựng dict người dùng giống response của /auth/v1/user từ claims."""
+    return {
+        "id": claims.get("sub"),
+        "aud": claims.get("aud"),
+        "role": claims.get("role"),
+        "email": claims.get("email"),
+        "phone": claims.get("phone"),
+        "app_metadata": claims.get("app_metadata", {}),
+        "user_metadata": claims.get("user_metadata", {}),
+        "session_id": claims.get("session_id"),
+    }
+
+
+# ==========================================================
+# 🔐 XÁC THỰC TOKEN
+# ==========================================================
+def verify_token_locally(access_token):
+    """
+    Kiểm tra chữ ký, exp và audience của access token Supabase tại chỗ.
+    Raise PermissionError nếu token không hợp lệ,
+    LocalVerificationUnavailable nếu thiếu khóa để kiểm tra.
+    """
+    try:
+        header = jwt.get_unverified_header(access_token)
+    except jwt.PyJWTError as e:
+        raise PermissionError("Token Supabase không hợp lệ hoặc đã hết hạn") from e
+
+    alg = header.get("alg")
+    if alg not in ALLOWED_ALGORITHMS:
+        raise PermissionError("Token Supabase không hợp lệ hoặc đã hết hạn")
+
+    if alg == "HS256":
+        if not SUPABASE_JWT_SECRET:
+            raise LocalVerificationUnavailable("Chưa cấu hình SUPABASE_JWT_SECRET")
+        key = SUPABASE_JWT_SECRET
+    else:
+        client = _get_jwks_client()
+        if client is None:
+            raise LocalVerificationUnavailable("Chưa cấu hình SUPABASE_JWKS_URL")
+        try:
+            key = client.get_signing_key_from_jwt(access_token).key
+        except jwt.PyJWKClientError as e:
+            raise LocalVerificationUnavailable(f"Không lấy được khóa JWKS: {e}") from e
+
+    try:
+        return jwt.decode(
+            access_token,
+            key,
+            algorithms=[alg],
+            audience=SUPABASE_JWT_AUDIENCE,
+            leeway=AUTH_LEEWAY,
+            options={"require": ["exp", "sub"]},
+        )
+    except jwt.PyJWTError as e:
+        raise PermissionError("Token Supabase không hợp lệ hoặc đã hết hạn") from e
+
+
+def fetch_user_remote(access_token):
+    """Hỏi Supabase Auth (/auth/v1/user) để lấy thông tin người dùng."""
+    if not SUPABASE_URL or not SUPABASE_API_KEY:
+        raise RuntimeError("Chưa cấu hình SUPABASE_URL hoặc SUPABASE_ANON_KEY/SUPABASE_KEY")
+
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "apikey": SUPABASE_API_KEY,
+    }
+
+    # Session dùng chung: giữ kết nối keep-alive tới Supabase Auth giữa các request
+    response = get_session().get(f"{SUPABASE_URL}/auth/v1/user", headers=headers, timeout=AUTH_REMOTE_TIMEOUT)
+
+    if response.status_code != 200:
+        raise PermissionError("Token Supabase không hợp lệ hoặc đã hết hạn")
+
+    return response.json()
+
+
+def _unverified_exp(access_token):
+    try:
+        return jwt.decode(access_token, options={"verify_signature": False}).get("exp")
+    except jwt.PyJWTError:
+        return None
+
+
+def get_user_from_token(access_token: str):
+    """
+    Trả về thông tin người dùng của access token Supabase.
+    Thứ tự: cache → xác thực tại chỗ → /auth/v1/user (nếu bật AUTH_REMOTE_FALLBACK).
+    """
+    if not access_token:
+        raise ValueError("Thiếu access token Supabase")
+
+    user = token_cache.get(access_token)
+    if user is not None:
+        return user
+
+    try:
+        claims = verify_token_locally(access_token)
+        user = _user_from_claims(claims)
+        token_cache.put(access_token, user, claims.get("exp"))
+        return user
+    except LocalVerificationUnavailable as e:
+        if not AUTH_REMOTE_FALLBACK:
+            raise RuntimeError(f"Không thể xác thực token tại chỗ: {e}") from e
+
+    user = fetch_user_remote(access_token)
+    token_cache.put(access_token, user, _unverified_exp(access_token))
+    return user
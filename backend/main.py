@@ -1,14 +1,50 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, g, request, jsonify
 import os
-import requests
+import io
 import base64
-from ai_server.inference import run_inference
-from ai_server.upload_drive import upload_to_drive
-from ai_server.supabase_utils import save_predictions, update_image_status, create_image_record, supabase
+import multiprocessing
+import time
+from functools import wraps
+from ai_server.inference import classify, scheduler
+from ai_server.profiles import DEFAULT_UPLOAD_PROFILE, DEFAULT_TEST_PROFILE, resolve_profile
+from ai_server.model_manager import warmup_active_model
+from ai_server.storage import get_upload_pool
+from ai_server import http_transport
+from ai_server.ingest import ingest_upload, ingest_stream_factory, cleanup_spilled
+from ai_server.scan_session import ScanSession
+from ai_server.upload_jobs import enqueue_upload, upload_queue, start_upload_queue
+from ai_server.supabase_utils import update_image_status, create_image_record, supabase
+from ai_server.persistence import persist_image_result
+from ai_server.prediction_cache import prediction_cache
+from ai_server.preprocess import thumbnail_key, upload_thumbnail
+from ai_server.worker_pool import current_worker_pool
+from ai_server.statistics import get_user_statistics, invalidate_user_statistics
+from ai_server.history import get_history_page, invalidate_user_history
+from ai_server.categories import category_index
+from ai_server.encoding import JSON, negotiate, encode
+from ai_server.admission import admission, Overloaded, PRIORITY_UPLOAD, PRIORITY_TEST
+from ai_server.metrics import registry as metrics_registry, current_endpoint, observe_request, span, get_logger
+from backend.auth import get_user_from_token
 from flask_cors import CORS
+from flask_sock import Sock
+
+class IngestRequest(Request):
+    """
+    Request đọc file multipart thẳng vào bộ nhớ thay vì file tạm của Werkzeug.
+    File đã spill ra đĩa được ghi lại trong `spilled_files` để xóa khi request kết thúc.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = ingest_stream_factory(total_content_length, content_type, filename, content_length)
+        if not isinstance(stream, io.BytesIO):
+            self.__dict__.setdefault("spilled_files", []).append(stream)
+        return stream
+
 
 app = Flask(__name__)
+app.request_class = IngestRequest
 CORS(app)
+sock = Sock(app)
 
 # Cấu hình để xử lý response lớn
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
@@ -19,29 +55,95 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 # Nếu bạn muốn upload ảnh vào 1 folder riêng trên Google Drive, thêm folder_id tại đây
 FOLDER_ID = "161IeJj_ZJpw_whbLSn5amY57Scxs0aJt"
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_API_KEY = os.getenv("SUPABASE_ANON_KEY") or os.getenv("SUPABASE_KEY")
+# /upload trả response ngay sau inference, phần upload Drive + lưu Supabase chạy nền
+UPLOAD_ASYNC = os.getenv("UPLOAD_ASYNC", "1") == "1"
+# Chạy bằng `python backend/main.py`: debug=True bật reloader (tắt bằng FLASK_DEBUG=0)
+FLASK_DEBUG = os.getenv("FLASK_DEBUG", "1") == "1"
+
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_KEY")  # Service role key để bypass RLS
 
+log = get_logger("api")
+
+
+# ==========================================================
+# 📈 METRICS THEO REQUEST
+# ==========================================================
+@app.before_request
+def start_request_timer():
+    g.metrics_started = time.perf_counter()
+    # Nhãn endpoint là route gốc (/api/images/<int:image_id>/status), không phải URL cụ thể
+    g.metrics_token = current_endpoint.set(request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get("metrics_started")
+    if started is not None:
+        observe_request(current_endpoint.get(), request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+
+@app.teardown_request
+def reset_request_endpoint(error=None):
+    token = g.pop("metrics_token", None)
+    if token is not None:
+        current_endpoint.reset(token)
 
-def get_user_from_token(access_token: str):
-    if not access_token:
-        raise ValueError("Thiếu access token Supabase")
 
-    if not SUPABASE_URL or not SUPABASE_API_KEY:
-        raise RuntimeError("Chưa cấu hình SUPABASE_URL hoặc SUPABASE_ANON_KEY/SUPABASE_KEY")
+@app.teardown_request
+def cleanup_spilled_uploads(error=None):
+    """Xóa mọi file multipart đã spill ra đĩa (kể cả part không dùng tới), trừ file đã giao cho job nền."""
+    streams = request.__dict__.get("spilled_files")
+    if streams:
+        cleanup_spilled(streams, keep=g.get("kept_spill_paths", ()))
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "apikey": SUPABASE_API_KEY,
-    }
 
-    response = requests.get(f"{SUPABASE_URL}/auth/v1/user", headers=headers, timeout=10)
+metrics_registry.gauge("waste_inference_queue_depth", "Số ảnh đang chờ gom batch", lambda: scheduler.queue_depth)
+metrics_registry.gauge("waste_upload_jobs", "Số job upload nền theo trạng thái", upload_queue.counts, label="state")
+metrics_registry.gauge(
+    "waste_storage_uploads_in_flight", "Số upload storage đang chạy", lambda: get_upload_pool().stats()["in_flight"]
+)
 
-    if response.status_code != 200:
-        raise PermissionError("Token Supabase không hợp lệ hoặc đã hết hạn")
 
-    return response.json()
+def admitted(priority):
+    """
+    Chỉ chạy view khi admission control cấp slot; quá tải thì trả 429 + Retry-After
+    ngay, trước khi đọc body ảnh.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if admission is None:
+                return view(*args, **kwargs)
+            try:
+                with span("admission"):
+                    held_since = admission.acquire(priority)
+            except Overloaded as e:
+                log.warning(f"⚠️ Từ chối {request.path}: {e}")
+                response = jsonify({"error": str(e), "retry_after": e.retry_after})
+                response.headers["Retry-After"] = str(e.retry_after)
+                return response, 429
+            try:
+                return view(*args, **kwargs)
+            finally:
+                admission.release(held_since)
+        return wrapper
+    return decorator
+
+
+def predictions_response(payload):
+    """
+    Response chứa predictions theo định dạng client yêu cầu (?format= hoặc Accept):
+    JSON như cũ (mặc định), compact dạng cột, hoặc MessagePack.
+    """
+    encoding = negotiate(request.headers.get("Accept"), request.args.get("format"))
+    if encoding == JSON:
+        response = jsonify(payload)
+    else:
+        body, content_type = encode(payload, encoding, category_index.table()[1])
+        response = Response(body, content_type=content_type)
+    response.vary.add("Accept")
+    return response
 
 
 def image_to_base64(image_path):
@@ -60,11 +162,12 @@ def image_to_base64(image_path):
                 mime_type = "image/gif"
             return f"data:{mime_type};base64,{encoded_string}"
     except Exception as e:
-        print(f"❌ Lỗi khi chuyển đổi ảnh sang base64: {e}")
+        log.error(f"❌ Lỗi khi chuyển đổi ảnh sang base64: {e}")
         return None
 
 
 @app.route("/upload", methods=["POST"])
+@admitted(PRIORITY_UPLOAD)
 def upload_image():
     try:
         auth_header = request.headers.get("Authorization", "")
@@ -72,129 +175,200 @@ def upload_image():
             return jsonify({"error": "Thiếu token xác thực"}), 401
 
         access_token = auth_header.split(" ", 1)[1].strip()
-        user_info = get_user_from_token(access_token)
+        with span("auth"):
+            user_info = get_user_from_token(access_token)
         user_id = user_info.get("id")
 
         if not user_id:
             return jsonify({"error": "Không tìm thấy thông tin người dùng Supabase"}), 401
 
+        # ⏱️ Profile suy luận: ?profile=... hoặc trường form "profile"
+        profile = resolve_profile(request.values.get("profile"), DEFAULT_UPLOAD_PROFILE)
+
         file = request.files.get("file")
         if not file:
             return jsonify({"error": "Chưa có file ảnh gửi lên!"}), 400
 
-        # 📥 Lưu ảnh tạm vào thư mục uploads
-        temp_path = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(temp_path)
-        print(f"📂 Đã nhận ảnh: {temp_path}")
-
-        # Lưu ảnh vào supabase với trạng thái uploaded
-        image_id = create_image_record(user_id, temp_path)
-        print(f"🆔 Tạo record ảnh (uploaded): ID = {image_id}")
-
-        # cập nhật trạng thái của ảnh : processing
-        update_image_status(image_id, "processing")
-
-        # 🤖 Chạy nhận diện YOLO (model tự lấy từ Supabase)
-        inference_result = run_inference(temp_path)
-        predictions = inference_result.get("predictions", [])
-        
-        print(f"✅ Phân loại xong, phát hiện {len(predictions)} vật thể.")
-
-        # ☁️ Upload ảnh gốc lên Google Drive (chỉ lưu ảnh gốc, không lưu ảnh có bounding box)
-        file_url = upload_to_drive(temp_path, FOLDER_ID)
-        print(f"☁️ Đã upload ảnh gốc lên Drive: {file_url}")
+        # 📥 Nhận ảnh trong bộ nhớ (chỉ ghi ra đĩa khi vượt INGEST_SPILL_BYTES)
+        with span("ingest"):
+            image = ingest_upload(file)
+        handed_to_job = False
+        log.info(f"📂 Đã nhận ảnh: {image.filename} ({image.size} bytes)")
 
-        # 💾 Lưu vào Supabase
-        update_image_status(image_id, "done", file_url)
-        if predictions:
-            save_predictions(image_id, predictions)
-            print("📦 Đã lưu dữ liệu vào Supabase!")
-        else:
-            print("⚠️ Không có predictions để lưu.")
-
-        # 🧹 Xóa file tạm (sau khi đã upload lên Google Drive)
         try:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-        except Exception as e:
-            print(f"⚠️ Không thể xóa file tạm: {e}")
+            # Lưu ảnh vào supabase, đi thẳng vào trạng thái processing
+            with span("create_record"):
+                image_id = create_image_record(user_id, image.filename, status="processing")
+            log.info(f"🆔 Tạo record ảnh (processing): ID = {image_id}")
+
+            # 🤖 Chạy nhận diện YOLO (ảnh gửi lại y hệt dùng kết quả cache theo hash nội dung)
+            try:
+                inference_result = classify(image, profile)
+            except Exception:
+                update_image_status(image_id, "failed")
+                raise
+            predictions = inference_result.get("predictions", [])
+            
+            log.info(f"✅ Phân loại xong, phát hiện {len(predictions)} vật thể.")
+
+            # ♻️ Cùng nội dung đã upload lên Drive trước đó thì dùng lại link, không upload lại
+            reused_url = prediction_cache.get_file_url(image.sha256)
+            if reused_url:
+                log.info(f"♻️ Dùng lại ảnh đã có trên Drive: {reused_url}")
+
+            if UPLOAD_ASYNC:
+                # ⏩ Upload Drive + lưu predictions + cập nhật trạng thái chạy trong job nền
+                with span("enqueue"):
+                    enqueue_upload(
+                        image_id, image, predictions, FOLDER_ID, file_url=reused_url, user_id=user_id,
+                        thumbnail_url=prediction_cache.get_file_url(thumbnail_key(image.sha256)) if reused_url else None
+                    )
+                handed_to_job = not reused_url
+                file_url = None
+                thumbnail_url = None
+                status = "processing"
+            else:
+                file_url = reused_url
+                if not file_url:
+                    # ☁️ Upload ảnh gốc lên Google Drive từ chính buffer đã nhận,
+                    # song song với việc nén + upload thumbnail hiển thị
+                    with image.open() as fileobj:
+                        pending = get_upload_pool().submit_fileobj(
+                            fileobj, image.filename, FOLDER_ID, image.mimetype, image.size
+                        )
+                        thumbnail_url = upload_thumbnail(image, FOLDER_ID)
+                        file_url = pending.result()
+                    prediction_cache.remember_file_url(image.sha256, file_url)
+                    log.info(f"☁️ Đã upload ảnh gốc lên Drive: {file_url}")
+                else:
+                    thumbnail_url = upload_thumbnail(image, FOLDER_ID)
+
+                # 💾 Lưu vào Supabase (predictions + trạng thái done)
+                persist_image_result(image_id, predictions, "done", file_url, thumbnail_path=thumbnail_url)
+                invalidate_user_statistics(user_id)
+                invalidate_user_history(user_id)
+                log.info("📦 Đã lưu dữ liệu vào Supabase!")
+                status = "done"
+        finally:
+            # 🧹 Xóa file spill (nếu có) trừ khi job nền đang giữ nó
+            if handed_to_job:
+                g.kept_spill_paths = [image.path]
+            else:
+                image.cleanup()
 
         # Trả về kết quả (KHÔNG trả về ảnh base64 để giảm kích thước response)
         # Frontend sẽ load ảnh từ file_url và vẽ bounding box
+        # Ở chế độ async, file_url lấy sau qua /api/images/<image_id>/status
+        # thumbnail_url: ảnh nén nhỏ để hiển thị, bbox vẫn theo tọa độ ảnh gốc
         response_data = {
             "message": "Phân loại thành công 🎉" if predictions else "Không phát hiện vật thể nào",
             "image_id": image_id,  # Thêm image_id để frontend có thể lưu feedback
             "file_url": file_url,  # URL ảnh trên Google Drive
+            "thumbnail_url": thumbnail_url,
+            "status": status,
             "original_image_base64": None,  # Không trả về base64 để giảm kích thước response
             "predictions": predictions,
-            "has_predictions": len(predictions) > 0
+            "has_predictions": len(predictions) > 0,
+            "cache": inference_result.get("cache")
         }
 
         # Tạo response (không cần headers đặc biệt vì không còn base64)
-        response = jsonify(response_data)
+        response = predictions_response(response_data)
         
-        print(f"📤 Đang trả về response: image_id={image_id}, predictions={len(predictions)}, file_url={file_url}")
+        log.info(f"📤 Đang trả về response: image_id={image_id}, predictions={len(predictions)}, status={status}")
         
         return response, 200
 
     except PermissionError as auth_error:
-        print("❌ Lỗi xác thực Supabase:", str(auth_error))
+        log.error(f"❌ Lỗi xác thực Supabase: {auth_error}")
         return jsonify({"error": str(auth_error)}), 401
+    except ValueError as bad_request:
+        log.error(f"❌ Request không hợp lệ: {bad_request}")
+        return jsonify({"error": str(bad_request)}), 400
     except Exception as e:
-        print("❌ Lỗi:", str(e))
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ Lỗi: {e}")
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/test", methods=["POST"])
+@admitted(PRIORITY_TEST)
 def test_classify():
     """
     Endpoint test - chỉ chạy inference, KHÔNG lưu vào Supabase
     Dùng cho chức năng quét real-time
     """
     try:
+        # ⏱️ Mặc định dùng profile realtime cho quét liên tục
+        profile = resolve_profile(request.values.get("profile"), DEFAULT_TEST_PROFILE)
+
         file = request.files.get("file")
         if not file:
             return jsonify({"error": "Chưa có file ảnh gửi lên!"}), 400
 
-        # 📥 Lưu ảnh tạm
-        temp_path = os.path.join(UPLOAD_FOLDER, f"test_{file.filename}")
-        file.save(temp_path)
-        print(f"🧪 [TEST MODE] Đã nhận ảnh: {temp_path}")
+        # 📥 Nhận ảnh trong bộ nhớ, không ghi file tạm
+        with span("ingest"):
+            image = ingest_upload(file)
+        log.info(f"🧪 [TEST MODE] Đã nhận ảnh: {image.filename} ({image.size} bytes)")
 
-        # 🤖 Chạy nhận diện YOLO (chỉ inference, không lưu)
-        inference_result = run_inference(temp_path)
+        # 🤖 Chạy nhận diện YOLO (chỉ inference, không lưu); frame gần trùng dùng lại kết quả
+        try:
+            inference_result = classify(image, profile, allow_near=True)
+        finally:
+            image.cleanup()
         predictions = inference_result.get("predictions", [])
         
-        print(f"✅ [TEST MODE] Phân loại xong, phát hiện {len(predictions)} vật thể.")
-
-        # 🧹 Xóa file tạm ngay sau khi inference
-        try:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-        except Exception as e:
-            print(f"⚠️ Không thể xóa file tạm: {e}")
+        log.info(f"✅ [TEST MODE] Phân loại xong, phát hiện {len(predictions)} vật thể.")
 
         # Trả về kết quả (không có image_id, file_url vì không lưu)
         response_data = {
             "message": "Test phân loại thành công 🎉" if predictions else "Không phát hiện vật thể nào",
             "predictions": predictions,
-            "has_predictions": len(predictions) > 0
+            "has_predictions": len(predictions) > 0,
+            "cache": inference_result.get("cache")
         }
 
-        response = jsonify(response_data)
-        print(f"📤 [TEST MODE] Đang trả về response: predictions={len(predictions)}")
+        response = predictions_response(response_data)
+        log.info(f"📤 [TEST MODE] Đang trả về response: predictions={len(predictions)}")
         
         return response, 200
 
+    except ValueError as bad_request:
+        log.error(f"❌ [TEST MODE] Request không hợp lệ: {str(bad_request)}")
+        return jsonify({"error": str(bad_request)}), 400
     except Exception as e:
-        print(f"❌ [TEST MODE] Lỗi: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ [TEST MODE] Lỗi: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@sock.route("/ws/scan")
+def scan_stream(ws):
+    """
+    Quét real-time qua WebSocket: client gửi liên tục các frame ảnh (binary),
+    server trả kết quả (JSON) trên cùng kết nối và luôn xử lý frame mới nhất.
+    Message text là lệnh điều khiển JSON, ví dụ {"profile": "realtime"}.
+    """
+    session = ScanSession(
+        lambda image, profile: classify(image, profile, allow_near=True),
+        ws.send,
+        request.args.get("profile"),
+        encoding=negotiate(None, request.args.get("format")),
+    )
+    session.start()
+    log.info("📡 [SCAN] Mở phiên quét real-time")
+    try:
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            if isinstance(message, str):
+                session.handle_control(message)
+            else:
+                session.push_frame(message)
+    finally:
+        session.close()
+        log.info(f"📡 [SCAN] Đóng phiên quét: {session.stats()}")
+
+
 @app.route("/api/statistics", methods=["GET"])
 def get_statistics():
     """Lấy thống kê hệ thống từ Supabase (sử dụng service role key để bypass RLS)"""
@@ -210,50 +384,187 @@ def get_statistics():
         if not user_id:
             return jsonify({"error": "Không tìm thấy thông tin người dùng Supabase"}), 401
 
-        # Sử dụng supabase client với service role key (đã có trong supabase_utils)
-        # 1. Lượt phân loại của người dùng hiện tại (số images có status = 'done')
-        user_images_res = supabase.table("images").select("image_id", count="exact").eq("user_id", user_id).eq("status", "done").execute()
-        user_classifications = user_images_res.count if hasattr(user_images_res, 'count') and user_images_res.count is not None else (len(user_images_res.data) if user_images_res.data else 0)
+        # Thống kê tổng hợp phía database (bộ đếm tăng dần) + cache ngắn hạn
+        return jsonify(get_user_statistics(user_id)), 200
 
-        # 2. Độ chính xác trung bình của người dùng hiện tại
-        # Lấy predictions thông qua images của user
-        user_images_list = supabase.table("images").select("image_id").eq("user_id", user_id).execute()
-        image_ids = [img["image_id"] for img in (user_images_list.data if user_images_list.data else [])]
-        
-        avg_confidence = 0
-        if image_ids:
-            user_predictions_res = supabase.table("predictions").select("confidence").in_("image_id", image_ids).execute()
-            user_predictions = user_predictions_res.data if user_predictions_res.data else []
-            if user_predictions:
-                avg_confidence = sum(p.get("confidence", 0) for p in user_predictions) / len(user_predictions) * 100
+    except PermissionError as auth_error:
+        log.error(f"❌ Lỗi xác thực Supabase: {auth_error}")
+        return jsonify({"error": str(auth_error)}), 401
+    except Exception as e:
+        log.exception(f"❌ Lỗi khi lấy thống kê: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        # 3. Tổng số người dùng (sử dụng service role key để bypass RLS)
-        all_users_res = supabase.table("users").select("user_id", count="exact").execute()
-        total_users = all_users_res.count if hasattr(all_users_res, 'count') and all_users_res.count is not None else (len(all_users_res.data) if all_users_res.data else 0)
 
-        # 4. Tổng số predictions (sử dụng service role key để bypass RLS)
-        all_predictions_res = supabase.table("predictions").select("prediction_id", count="exact").execute()
-        total_predictions = all_predictions_res.count if hasattr(all_predictions_res, 'count') and all_predictions_res.count is not None else (len(all_predictions_res.data) if all_predictions_res.data else 0)
+@app.route("/api/history", methods=["GET"])
+def get_history():
+    """
+    Lịch sử phân loại của user, phân trang theo cursor (?cursor=...&limit=...).
+    Mỗi trang có ETag: client gửi If-None-Match và nhận 304 khi trang không đổi
+    (trang còn trong cache thì không cần truy vấn database).
+    """
+    try:
+        auth_header = request.headers.get("Authorization", "")
+        if not auth_header.startswith("Bearer "):
+            return jsonify({"error": "Thiếu token xác thực"}), 401
+
+        access_token = auth_header.split(" ", 1)[1].strip()
+        user_info = get_user_from_token(access_token)
+        user_id = user_info.get("id")
+
+        if not user_id:
+            return jsonify({"error": "Không tìm thấy thông tin người dùng Supabase"}), 401
+
+        page, etag = get_history_page(user_id, request.args.get("cursor"), request.args.get("limit"))
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(page)
+        response.set_etag(etag)
+        # Dữ liệu riêng của user: client luôn hỏi lại bằng If-None-Match
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    except PermissionError as auth_error:
+        log.error(f"❌ Lỗi xác thực Supabase: {auth_error}")
+        return jsonify({"error": str(auth_error)}), 401
+    except ValueError as bad_request:
+        log.error(f"❌ Request không hợp lệ: {bad_request}")
+        return jsonify({"error": str(bad_request)}), 400
+    except Exception as e:
+        log.exception(f"❌ Lỗi khi lấy lịch sử: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/images/<int:image_id>/status", methods=["GET"])
+def get_image_status(image_id):
+    """Trạng thái xử lý của ảnh (uploaded/processing/done/failed) và kết quả khi đã xong."""
+    try:
+        auth_header = request.headers.get("Authorization", "")
+        if not auth_header.startswith("Bearer "):
+            return jsonify({"error": "Thiếu token xác thực"}), 401
+
+        access_token = auth_header.split(" ", 1)[1].strip()
+        user_info = get_user_from_token(access_token)
+        user_id = user_info.get("id")
+
+        if not user_id:
+            return jsonify({"error": "Không tìm thấy thông tin người dùng Supabase"}), 401
+
+        image_res = supabase.table("images").select("image_id, user_id, file_path, thumbnail_path, status").eq("image_id", image_id).limit(1).execute()
+        if not image_res.data or image_res.data[0]["user_id"] != user_id:
+            return jsonify({"error": "Không tìm thấy ảnh"}), 404
+        image = image_res.data[0]
+
+        job = upload_queue.get_by_image(image_id)
+        predictions = None
+        if job is not None:
+            predictions = job["payload"].get("predictions")
+        elif image["status"] == "done":
+            pred_res = supabase.table("predictions").select(
+                "category_id, model_id, confidence, bbox_x1, bbox_y1, bbox_x2, bbox_y2, waste_categories(name)"
+            ).eq("image_id", image_id).execute()
+            predictions = [{
+                "category_id": p["category_id"],
+                "category_name": (p.get("waste_categories") or {}).get("name"),
+                "model_id": p["model_id"],
+                "confidence": p["confidence"],
+                "bbox": [p["bbox_x1"], p["bbox_y1"], p["bbox_x2"], p["bbox_y2"]]
+            } for p in (pred_res.data or [])]
 
         return jsonify({
-            "userClassifications": user_classifications,
-            "avgConfidence": round(avg_confidence, 1),
-            "totalUsers": total_users,
-            "totalPredictions": total_predictions
+            "image_id": image_id,
+            "status": image["status"],
+            "file_url": image["file_path"] if image["status"] == "done" else None,
+            "thumbnail_url": image.get("thumbnail_path") if image["status"] == "done" else None,
+            "predictions": predictions,
+            "job": {
+                "state": job["state"],
+                "attempts": job["attempts"],
+                "last_error": job["last_error"]
+            } if job is not None else None
         }), 200
 
     except PermissionError as auth_error:
-        print("❌ Lỗi xác thực Supabase:", str(auth_error))
+        log.error(f"❌ Lỗi xác thực Supabase: {auth_error}")
         return jsonify({"error": str(auth_error)}), 401
     except Exception as e:
-        print("❌ Lỗi khi lấy thống kê:", str(e))
-        import traceback
-        traceback.print_exc()
+        log.exception(f"❌ Lỗi khi lấy trạng thái ảnh: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/categories", methods=["GET"])
+def get_categories():
+    """
+    Bảng danh mục rác (category_id → name) cho response compact. Trả ETag theo
+    nội dung: client gửi If-None-Match và nhận 304 khi bảng không đổi.
+    """
+    rows, etag = category_index.table()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({"categories": rows, "etag": etag})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age=300"
+    return response
+
+
+@app.route("/api/inference/stats", methods=["GET"])
+def get_inference_stats():
+    """Thống kê scheduler (hàng đợi, kích thước batch, thời gian chờ), cache kết quả và pool worker."""
+    pool = current_worker_pool()
+    return jsonify({
+        **scheduler.stats(),
+        "cache": prediction_cache.stats(),
+        "workers": pool.stats() if pool is not None else None
+    }), 200
+
+
+@app.route("/api/transport/stats", methods=["GET"])
+def get_transport_stats():
+    """Thống kê pool kết nối HTTP ra ngoài (Supabase, Auth, Drive): request theo host, tỉ lệ dùng lại kết nối."""
+    return jsonify(http_transport.stats()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Metrics dạng text cho Prometheus: thời gian từng bước, số vật thể, cache, lỗi, nạp mô hình."""
+    return Response(metrics_registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/api/admission/stats", methods=["GET"])
+def get_admission_stats():
+    """Thống kê admission control: request đang xử lý, hàng đợi theo mức ưu tiên, số request bị loại."""
+    return jsonify(admission.stats() if admission is not None else {"enabled": False}), 200
+
+
+@app.route("/api/storage/stats", methods=["GET"])
+def get_storage_stats():
+    """Thống kê pool upload storage: số upload đang chạy, throughput, hàng đợi job nền."""
+    return jsonify({**get_upload_pool().stats(), "jobs": upload_queue.counts()}), 200
+
+
+def start_background_workers():
+    """Khởi động worker job nền, khôi phục job dang dở và dọn ảnh 'processing' bị bỏ dở."""
+    if UPLOAD_ASYNC:
+        start_upload_queue()
+
+
 if __name__ == "__main__":
+    # Warm-up mô hình trước khi nhận request (bật bằng MODEL_WARMUP=1)
+    if os.getenv("MODEL_WARMUP", "0") == "1":
+        warmup_active_model()
+
+    # Process cha của reloader (debug=True) không phục vụ request nên không chạy worker
+    if not FLASK_DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_workers()
+
     # app.run(port=5000, debug=True)
     # host='0.0.0.0' cho phép kết nối từ bên ngoài (emulator, thiết bị thật)
     # Nếu chỉ dùng localhost, dùng host='127.0.0.1'
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=FLASK_DEBUG)
+elif __name__ != "__mp_main__" and multiprocessing.parent_process() is None:
+    # Chạy qua WSGI server (gunicorn, flask run...): khởi động ngay khi nạp app.
+    # Process con của multiprocessing (worker inference spawn nạp lại module
+    # chính dưới tên __mp_main__) không phục vụ request nên không chạy worker.
+    # Nhiều worker gunicorn cùng chạy vẫn an toàn: job được giữ bằng lease.
+    start_background_workers()
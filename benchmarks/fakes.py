@@ -0,0 +1,386 @@
+"""
+Bản giả lập cục bộ của Supabase, Supabase Auth, Google Drive và mô hình YOLO
+dùng cho benchmark: giữ dữ liệu trong bộ nhớ và mô phỏng độ trễ mạng cấu hình được.
+"""
+import base64
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Latency:
+    """Độ trễ mô phỏng: mean_ms ± jitter_ms (phân phối đều), cộng thêm theo MB nếu có."""
+
+    def __init__(self, mean_ms=0.0, jitter_ms=0.0, per_mb_ms=0.0):
+        self.mean_ms = float(mean_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.per_mb_ms = float(per_mb_ms)
+
+    def sleep(self, size=0):
+        delay = self.mean_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        delay += self.per_mb_ms * size / (1024 * 1024)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+
+def make_token(sub, secret="bench-secret", ttl=3600, role="authenticated"):
+    """Access token dạng JWT HS256 giống Supabase (dùng PyJWT)."""
+    import jwt
+
+    now = int(time.time())
+    return jwt.encode(
+        {"sub": sub, "aud": "authenticated", "role": role, "exp": now + ttl, "iat": now},
+        secret, algorithm="HS256",
+    )
+
+
+# ==========================================================
+# 🗄️ SUPABASE CLIENT GIẢ (POSTGREST TRONG BỘ NHỚ)
+# ==========================================================
+class FakeAPIError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+PRIMARY_KEYS = {
+    "images": "image_id",
+    "predictions": "prediction_id",
+    "ai_models": "model_id",
+    "waste_categories": "category_id",
+    "users": "user_id",
+    "feedbacks": "feedback_id",
+}
+
+_EMBED = re.compile(r"(\w+)\(([^)]*)\)")
+
+
+class FakeQuery:
+    """Query builder tối giản cho các lệnh mà ai_server/backend dùng."""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table_name = table
+        self.op = "select"
+        self.columns = "*"
+        self.count = None
+        self.payload = None
+        self.filters = []
+        self.order_by = None
+        self.desc = False
+        self.limit_n = None
+
+    # --- thao tác ---
+    def select(self, columns="*", count=None):
+        self.op, self.columns, self.count = "select", columns, count
+        return self
+
+    def insert(self, rows):
+        self.op, self.payload = "insert", rows
+        return self
+
+    def update(self, data):
+        self.op, self.payload = "update", data
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    # --- điều kiện ---
+    def eq(self, column, value):
+        self.filters.append(lambda r: r.get(column) == value)
+        return self
+
+    def neq(self, column, value):
+        self.filters.append(lambda r: r.get(column) != value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda r: r.get(column) is not None and r.get(column) > value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda r: r.get(column) is not None and r.get(column) < value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda r: r.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by, self.desc = column, desc
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def execute(self):
+        return self.db.execute(self)
+
+
+class FakeRPC:
+    def __init__(self, db, name, params):
+        self.db, self.name, self.params = db, name, params
+
+    def execute(self):
+        return self.db.call(self.name, self.params)
+
+
+class FakeSupabase:
+    """
+    Thay cho client supabase-py: bảng trong bộ nhớ, mỗi request chịu một
+    độ trễ `latency` như một round-trip tới PostgREST.
+    """
+
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.tables = {name: [] for name in PRIMARY_KEYS}
+        self._next_id = {name: 1 for name in PRIMARY_KEYS}
+        self._lock = threading.Lock()
+        self.request_count = 0
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params=None):
+        return FakeRPC(self, name, params or {})
+
+    # ------------------------------------------------------
+    def seed(self, table, rows):
+        with self._lock:
+            for row in rows:
+                self._insert_row(table, dict(row))
+
+    def _insert_row(self, table, row):
+        pk = PRIMARY_KEYS.get(table)
+        rows = self.tables.setdefault(table, [])
+        if pk:
+            if row.get(pk) is None:
+                row[pk] = self._next_id.get(table, 1)
+            if isinstance(row[pk], int):
+                # SERIAL: id kế tiếp luôn lớn hơn mọi id đã có (kể cả id seed sẵn)
+                self._next_id[table] = max(self._next_id.get(table, 1), row[pk] + 1)
+        rows.append(row)
+        return row
+
+    def _project(self, row, columns):
+        if columns.strip() == "*":
+            return dict(row)
+        result = {}
+        for embed, inner in _EMBED.findall(columns):
+            result[embed] = self._embed(row, embed, inner)
+        plain = _EMBED.sub("", columns)
+        for column in (c.strip() for c in plain.split(",")):
+            if column and column != "*":
+                result[column] = row.get(column)
+        return result
+
+    def _embed(self, row, table, inner):
+        pk = PRIMARY_KEYS.get(table)
+        if pk is None or row.get(pk) is None:
+            return None
+        for other in self.tables.get(table, []):
+            if other.get(pk) == row[pk]:
+                return self._project(other, inner or "*")
+        return None
+
+    def execute(self, query):
+        self.latency.sleep()
+        with self._lock:
+            self.request_count += 1
+            rows = self.tables.setdefault(query.table_name, [])
+
+            if query.op == "insert":
+                payload = query.payload if isinstance(query.payload, list) else [query.payload]
+                return FakeResponse([dict(self._insert_row(query.table_name, dict(r))) for r in payload])
+
+            matched = [r for r in rows if all(f(r) for f in query.filters)]
+            if query.op == "update":
+                for r in matched:
+                    r.update(query.payload)
+                return FakeResponse([dict(r) for r in matched])
+            if query.op == "delete":
+                removed = {id(r) for r in matched}
+                self.tables[query.table_name] = [r for r in rows if id(r) not in removed]
+                return FakeResponse([dict(r) for r in matched])
+
+            if query.order_by:
+                matched.sort(key=lambda r: (r.get(query.order_by) is None, r.get(query.order_by)), reverse=query.desc)
+            count = len(matched) if query.count else None
+            if query.limit_n is not None:
+                matched = matched[:query.limit_n]
+            return FakeResponse([self._project(r, query.columns) for r in matched], count)
+
+    # ------------------------------------------------------
+    # Hàm SQL (RPC) mà server gọi
+    # ------------------------------------------------------
+    def call(self, name, params):
+        self.latency.sleep()
+        with self._lock:
+            self.request_count += 1
+            handler = getattr(self, f"_rpc_{name}", None)
+            if handler is None:
+                raise FakeAPIError(f"Could not find the function public.{name}", code="PGRST202")
+            return FakeResponse(handler(**params))
+
+    def _rpc_finalize_images(self, p_items):
+        inserted = 0
+        for item in p_items:
+            exists = any(p["image_id"] == item["image_id"] for p in self.tables["predictions"])
+            for row in [] if exists else (item.get("predictions") or []):
+                self._insert_row("predictions", dict(row))
+                inserted += 1
+            for image in self.tables["images"]:
+                if image["image_id"] == item["image_id"]:
+                    image["status"] = item["status"]
+                    if item.get("file_path"):
+                        image["file_path"] = item["file_path"]
+                    if item.get("thumbnail_path"):
+                        image["thumbnail_path"] = item["thumbnail_path"]
+        return inserted
+
+    def _rpc_get_user_statistics(self, p_user_id):
+        image_ids = {i["image_id"] for i in self.tables["images"] if i["user_id"] == p_user_id}
+        done = sum(1 for i in self.tables["images"] if i["user_id"] == p_user_id and i.get("status") == "done")
+        confs = [p["confidence"] for p in self.tables["predictions"] if p["image_id"] in image_ids]
+        return {
+            "userClassifications": done,
+            "avgConfidence": round(sum(confs) / len(confs) * 100, 1) if confs else 0,
+            "totalUsers": len(self.tables["users"]),
+            "totalPredictions": len(self.tables["predictions"]),
+        }
+
+
+# ==========================================================
+# 🔐 SUPABASE AUTH GIẢ (/auth/v1/user)
+# ==========================================================
+def _claims(token):
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except Exception:
+        return None
+
+
+class FakeAuthServer:
+    """HTTP server cục bộ trả lời GET /auth/v1/user giống Supabase Auth."""
+
+    def __init__(self, latency=None, host="127.0.0.1", port=0):
+        latency = latency or Latency()
+        stats = {"requests": 0}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                latency.sleep()
+                stats["requests"] += 1
+                token = self.headers.get("Authorization", "").replace("Bearer ", "", 1)
+                claims = _claims(token) if self.path.startswith("/auth/v1/user") else None
+                if not claims or not claims.get("sub"):
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                body = json.dumps({"id": claims["sub"], "aud": claims.get("aud"), "role": claims.get("role")}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.stats = stats
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-auth", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+# ==========================================================
+# ☁️ STORAGE GIẢ THAY GOOGLE DRIVE
+# ==========================================================
+def make_fake_drive_storage(latency):
+    """Tạo lớp StorageBackend giả lập Drive (độ trễ theo request + theo MB)."""
+    from ai_server.storage import StorageBackend
+
+    class FakeDriveStorage(StorageBackend):
+        name = "fake_drive"
+        _ids = itertools.count(1)
+
+        def upload_file(self, file_path, folder_id=None, mimetype=None):
+            import os
+
+            latency.sleep(os.path.getsize(file_path))
+            return f"https://drive.example/uc?id=bench-{next(self._ids)}"
+
+        def upload_fileobj(self, fileobj, filename, folder_id=None, mimetype=None, size=None):
+            data = fileobj.read()
+            latency.sleep(len(data))
+            return f"https://drive.example/uc?id=bench-{next(self._ids)}"
+
+    return FakeDriveStorage
+
+
+# ==========================================================
+# 🤖 MÔ HÌNH GIẢ (ĐO PIPELINE KHÔNG CẦN TRỌNG SỐ)
+# ==========================================================
+class _List:
+    def __init__(self, values):
+        self.values = values
+
+    def tolist(self):
+        return list(self.values)
+
+
+class _Boxes:
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy, self.conf, self.cls = _List(xyxy), _List(conf), _List(cls)
+
+    def __len__(self):
+        return len(self.xyxy.values)
+
+
+class _Result:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class FakeYOLO:
+    """Giả lập YOLO.predict: tốn batch_ms + per_image_ms, trả 1-3 box ngẫu nhiên."""
+
+    def __init__(self, names, batch_ms=20.0, per_image_ms=30.0):
+        self.names = dict(enumerate(names))
+        self.batch_ms = batch_ms
+        self.per_image_ms = per_image_ms
+
+    def predict(self, source, **kwargs):
+        images = source if isinstance(source, list) else [source]
+        time.sleep((self.batch_ms + self.per_image_ms * len(images)) / 1000.0)
+        results = []
+        for _ in images:
+            n = random.randint(1, 3)
+            xyxy = [[10.0 * i, 10.0 * i, 100.0 + 10 * i, 120.0 + 10 * i] for i in range(n)]
+            conf = [round(random.uniform(0.4, 0.95), 4) for _ in range(n)]
+            cls = [float(random.randrange(len(self.names))) for _ in range(n)]
+            results.append(_Result(_Boxes(xyxy, conf, cls)))
+        return results
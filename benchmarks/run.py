@@ -0,0 +1,446 @@
+"""
+Benchmark end-to-end cho /upload, /test và /api/statistics.
+
+Flask app thật chạy trong process này (werkzeug, threaded), còn Supabase,
+Supabase Auth và Google Drive được thay bằng bản giả cục bộ có độ trễ cấu
+hình được (benchmarks/fakes.py). Kết quả p50/p95/p99 + throughput theo
+endpoint và theo từng bước pipeline được ghi ra file JSON để so sánh giữa
+các lần chạy.
+
+Ví dụ:
+    # Chỉ đo pipeline (mô hình giả), 8 luồng, 200 request mỗi endpoint
+    python -m benchmarks.run --fake-model --concurrency 8 --requests 200
+
+    # Mô hình thật + độ trễ mạng giống production
+    python -m benchmarks.run --weights ai_server/weights/yolov8s/weights/best.pt \\
+        --db-latency-ms 40 --auth-latency-ms 80 --drive-latency-ms 400 --drive-per-mb-ms 300
+
+    # So sánh với lần chạy trước
+    python -m benchmarks.run --fake-model --compare benchmarks/results/bench_20250101_120000.json
+"""
+import argparse
+import functools
+import glob
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+BENCH_JWT_SECRET = "bench-secret-0123456789abcdef0123456789abcdef"
+FAKE_LABELS = ["plastic", "paper", "metal", "glass", "organic"]
+
+
+# ==========================================================
+# 📊 GHI NHẬN ĐỘ TRỄ
+# ==========================================================
+def percentile(sorted_values, p):
+    """Percentile theo nearest-rank trên danh sách đã sắp xếp."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+def summarize(samples, seconds=None):
+    values = sorted(samples)
+    summary = {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 2) if values else 0.0,
+        "p50_ms": round(percentile(values, 50), 2),
+        "p95_ms": round(percentile(values, 95), 2),
+        "p99_ms": round(percentile(values, 99), 2),
+        "max_ms": round(values[-1], 2) if values else 0.0,
+    }
+    if seconds:
+        summary["throughput_per_sec"] = round(len(values) / seconds, 2)
+    return summary
+
+
+class Recorder:
+    """Thu thập độ trễ (ms) theo tên, an toàn giữa các thread."""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, ms, ok=True):
+        with self._lock:
+            self.samples.setdefault(name, []).append(ms)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, seconds=None):
+        with self._lock:
+            return {
+                name: {**summarize(values, seconds), "errors": self.errors.get(name, 0)}
+                for name, values in sorted(self.samples.items())
+            }
+
+
+def instrument(recorder, stage, owner, attr):
+    """Bọc owner.attr để mỗi lần gọi ghi thời gian vào stage."""
+    original = getattr(owner, attr)
+
+    @functools.wraps(original)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        ok = True
+        try:
+            return original(*args, **kwargs)
+        except Exception:
+            ok = False
+            raise
+        finally:
+            recorder.add(stage, (time.perf_counter() - started) * 1000, ok)
+
+    setattr(owner, attr, timed)
+
+
+# ==========================================================
+# 🧪 DỰNG MÔI TRƯỜNG GIẢ LẬP
+# ==========================================================
+def configure_environment(args, auth_url, workdir):
+    """Đặt biến môi trường trước khi import backend/ai_server (cấu hình đọc lúc import)."""
+    from benchmarks.fakes import make_token
+
+    service_key = make_token("service", BENCH_JWT_SECRET, role="service_role")
+    os.environ.update({
+        "SUPABASE_URL": auth_url,
+        "SUPABASE_KEY": service_key,
+        "SUPABASE_ANON_KEY": service_key,
+        # Chuỗi rỗng để load_dotenv không lấy secret thật từ backend/.env
+        "SUPABASE_JWT_SECRET": BENCH_JWT_SECRET if args.auth_mode == "local" else "",
+        "SUPABASE_JWKS_URL": "",
+        "AUTH_REMOTE_FALLBACK": "1",
+        "JOB_QUEUE_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        "INGEST_SPILL_DIR": os.path.join(workdir, "spill"),
+        "STORAGE_BACKEND": "fake_drive",
+        "UPLOAD_ASYNC": "1" if args.upload_async else "0",
+        # backend.main được import trước khi thay client Supabase bằng FakeSupabase
+        "UPLOAD_ORPHAN_SECONDS": "0",
+        "INFERENCE_BACKEND": "pytorch" if args.fake_model else os.environ.get("INFERENCE_BACKEND", ""),
+    })
+    if args.fake_model:
+        # Mô hình giả chỉ chạy được trong process này
+        os.environ["INFERENCE_WORKERS"] = "0"
+    if args.no_cache:
+        os.environ["PREDICTION_CACHE_SIZE"] = "0"
+        os.environ["PREDICTION_CACHE_NEAR_SIZE"] = "0"
+
+
+def build_fake_world(args, workdir):
+    """Thay client Supabase ở mọi module bằng FakeSupabase và seed dữ liệu."""
+    from benchmarks.fakes import FakeSupabase, FakeYOLO, Latency, make_fake_drive_storage
+    import ai_server.categories
+    import ai_server.model_manager
+    import ai_server.persistence
+    import ai_server.statistics
+    import ai_server.storage
+    import ai_server.supabase_utils
+    import ai_server.upload_jobs
+    import backend.main
+
+    db = FakeSupabase(Latency(args.db_latency_ms, args.db_jitter_ms))
+    for module in (ai_server.supabase_utils, ai_server.persistence, ai_server.categories,
+                   ai_server.statistics, ai_server.model_manager, ai_server.upload_jobs, backend.main):
+        module.supabase = db
+
+    ai_server.storage.STORAGE_BACKENDS["fake_drive"] = make_fake_drive_storage(
+        Latency(args.drive_latency_ms, args.drive_jitter_ms, args.drive_per_mb_ms)
+    )
+
+    if args.fake_model:
+        weights = os.path.join(workdir, "fake.pt")
+        open(weights, "wb").close()
+        fake = FakeYOLO(FAKE_LABELS, args.fake_batch_ms, args.fake_image_ms)
+        ai_server.model_manager.load_runtime = lambda backend, path: fake
+    else:
+        weights = os.path.abspath(args.weights)
+
+    db.seed("ai_models", [{
+        "model_id": 1, "name": "bench", "version": "v1", "file_path": weights,
+        "is_active": True, "backend": "pytorch" if args.fake_model else None,
+    }])
+    db.seed("users", [{"user_id": f"bench-user-{i}"} for i in range(args.users)])
+
+    # Danh mục cho mọi lớp của mô hình (tra theo LABEL_TO_CATEGORY như khi chạy thật)
+    names = ai_server.model_manager.get_active_model().names or dict(enumerate(FAKE_LABELS))
+    labels = names.values() if isinstance(names, dict) else names
+    db.seed("waste_categories", [
+        {"name": ai_server.categories.LABEL_TO_CATEGORY.get(label, label.lower())}
+        for label in dict.fromkeys(labels)
+    ])
+    return db
+
+
+def install_stage_timers(recorder):
+    """Đo từng bước pipeline bằng cách bọc các hàm mà route gọi tới."""
+    import ai_server.inference
+    import ai_server.storage
+    import ai_server.upload_jobs
+    import backend.main
+
+    stages = [
+        ("auth", backend.main, "get_user_from_token"),
+        ("ingest", backend.main, "ingest_upload"),
+        ("create_record", backend.main, "create_image_record"),
+        ("classify", backend.main, "classify"),
+        ("inference", ai_server.inference, "run_inference"),
+        ("predict_batch", ai_server.inference, "predict_batch"),
+        ("enqueue_upload", backend.main, "enqueue_upload"),
+        ("persist", backend.main, "persist_image_result"),
+        ("persist", ai_server.upload_jobs, "persist_image_result"),
+        ("statistics", backend.main, "get_user_statistics"),
+        ("storage_upload", ai_server.storage.UploadPool, "upload_fileobj"),
+        ("storage_upload", ai_server.storage.UploadPool, "upload_file"),
+    ]
+    for stage, owner, attr in stages:
+        instrument(recorder, stage, owner, attr)
+
+    # Job nền: handler được giữ trong dict của JobQueue
+    queue = ai_server.upload_jobs.upload_queue
+    kind = ai_server.upload_jobs.UPLOAD_JOB
+    original = queue.handlers[kind]
+
+    def timed_job(job):
+        started = time.perf_counter()
+        ok = True
+        try:
+            return original(job)
+        except Exception:
+            ok = False
+            raise
+        finally:
+            recorder.add("upload_job", (time.perf_counter() - started) * 1000, ok)
+
+    queue.handlers[kind] = timed_job
+
+
+# ==========================================================
+# 🚦 TẠO TẢI
+# ==========================================================
+def load_images(pattern):
+    files = sorted(glob.glob(pattern, recursive=True))
+    if not files:
+        raise ValueError(f"❌ Không tìm thấy ảnh mẫu: {pattern}")
+    images = []
+    for path in files:
+        with open(path, "rb") as f:
+            images.append((os.path.basename(path), f.read()))
+    return images
+
+
+def drive_load(base_url, endpoint, total, concurrency, images, tokens, recorder, profile=None):
+    """Gửi `total` request tới endpoint với `concurrency` luồng; trả về thời gian chạy (giây)."""
+    import requests
+
+    local = threading.local()
+    counter = iter(range(total))
+    lock = threading.Lock()
+
+    def session():
+        if getattr(local, "session", None) is None:
+            local.session = requests.Session()
+        return local.session
+
+    def one(i):
+        filename, data = images[i % len(images)]
+        token = tokens[i % len(tokens)]
+        headers = {"Authorization": f"Bearer {token}"}
+        params = {"profile": profile} if profile else None
+        started = time.perf_counter()
+        try:
+            if endpoint == "statistics":
+                response = session().get(f"{base_url}/api/statistics", headers=headers, timeout=120)
+            else:
+                path = "/upload" if endpoint == "upload" else "/test"
+                response = session().post(f"{base_url}{path}", headers=headers, params=params,
+                                          files={"file": (filename, data, "image/jpeg")}, timeout=120)
+            ok = response.status_code == 200
+        except Exception:
+            ok = False
+        recorder.add(endpoint, (time.perf_counter() - started) * 1000, ok)
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            one(i)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    return time.perf_counter() - started
+
+
+def wait_for_jobs(timeout):
+    """Chờ job upload nền chạy hết (để đo cả phần sau response của /upload)."""
+    from ai_server.upload_jobs import upload_queue
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        counts = upload_queue.counts()
+        if not counts.get("pending") and not counts.get("running"):
+            return counts
+        time.sleep(0.2)
+    return upload_queue.counts()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(current, previous_path):
+    """In chênh lệch p50/p95 so với file kết quả trước đó."""
+    with open(previous_path, "r", encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\n📐 So sánh với {os.path.basename(previous_path)} (commit {previous['meta'].get('git_commit')}):")
+    for section in ("endpoints", "stages"):
+        for name, stats in current[section].items():
+            old = previous.get(section, {}).get(name)
+            if not old:
+                continue
+            for key in ("p50_ms", "p95_ms"):
+                delta = stats[key] - old[key]
+                pct = (delta / old[key] * 100) if old[key] else 0.0
+                print(f"  {section[:-1]:8s} {name:16s} {key}: {old[key]:9.1f} → {stats[key]:9.1f} ({pct:+.1f}%)")
+
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    print(f"  {'tên':16s} {'n':>6s} {'lỗi':>5s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'max':>9s} {'req/s':>8s}")
+    for name, s in rows.items():
+        print(f"  {name:16s} {s['count']:6d} {s['errors']:5d} {s['p50_ms']:9.1f} {s['p95_ms']:9.1f} "
+              f"{s['p99_ms']:9.1f} {s['max_ms']:9.1f} {s.get('throughput_per_sec', 0):8.1f}")
+
+
+# ==========================================================
+# 🚀 CHẠY
+# ==========================================================
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmark /upload, /test, /api/statistics")
+    parser.add_argument("--endpoints", default="test,upload,statistics", help="Danh sách endpoint, cách nhau bởi dấu phẩy")
+    parser.add_argument("--requests", type=int, default=100, help="Số request mỗi endpoint")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--users", type=int, default=10, help="Số user (token) giả lập")
+    parser.add_argument("--images", default=os.path.join(ROOT, "ai_server", "weights", "*", "val_batch*_labels.jpg"),
+                        help="Glob ảnh mẫu")
+    parser.add_argument("--profile", default=None, help="Profile suy luận gửi kèm request")
+    parser.add_argument("--weights", help="File trọng số thật (bỏ qua khi --fake-model)")
+    parser.add_argument("--fake-model", action="store_true", help="Dùng mô hình giả thay YOLO")
+    parser.add_argument("--fake-batch-ms", type=float, default=20.0)
+    parser.add_argument("--fake-image-ms", type=float, default=30.0)
+    parser.add_argument("--no-cache", action="store_true", help="Tắt cache kết quả để mọi request đều chạy mô hình")
+    parser.add_argument("--auth-mode", choices=("local", "remote"), default="local",
+                        help="local: xác thực JWT tại chỗ; remote: gọi /auth/v1/user giả")
+    parser.add_argument("--db-latency-ms", type=float, default=20.0)
+    parser.add_argument("--db-jitter-ms", type=float, default=5.0)
+    parser.add_argument("--auth-latency-ms", type=float, default=60.0)
+    parser.add_argument("--drive-latency-ms", type=float, default=300.0)
+    parser.add_argument("--drive-jitter-ms", type=float, default=50.0)
+    parser.add_argument("--drive-per-mb-ms", type=float, default=200.0)
+    parser.add_argument("--sync-upload", dest="upload_async", action="store_false",
+                        help="Upload Drive trong request (UPLOAD_ASYNC=0)")
+    parser.add_argument("--job-timeout", type=float, default=120.0, help="Thời gian chờ job nền chạy hết (giây)")
+    parser.add_argument("--output", help="File JSON kết quả (mặc định benchmarks/results/bench_<thời gian>.json)")
+    parser.add_argument("--compare", help="File JSON của lần chạy trước để so sánh")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not args.fake_model and not args.weights:
+        print("❌ Cần --weights hoặc --fake-model")
+        return 2
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+
+    sys.path.insert(0, ROOT)
+    from benchmarks.fakes import FakeAuthServer, Latency, make_token
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    auth_server = FakeAuthServer(Latency(args.auth_latency_ms)).start()
+    configure_environment(args, auth_server.url, workdir)
+
+    db = build_fake_world(args, workdir)
+    recorder = Recorder()
+    install_stage_timers(recorder)
+
+    from werkzeug.serving import make_server
+    import backend.main
+    from ai_server.inference import scheduler
+    from ai_server.prediction_cache import prediction_cache
+    from ai_server.storage import get_upload_pool
+    from ai_server.upload_jobs import upload_queue
+
+    if args.upload_async:
+        upload_queue.start()
+    server = make_server("127.0.0.1", 0, backend.main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-flask", daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    images = load_images(args.images)
+    tokens = [make_token(f"bench-user-{i}", BENCH_JWT_SECRET) for i in range(args.users)]
+    print(f"🚦 Benchmark {base_url}: {endpoints}, {args.requests} request × {args.concurrency} luồng, {len(images)} ảnh mẫu")
+
+    endpoint_recorder = Recorder()
+    durations = {}
+    for endpoint in endpoints:
+        durations[endpoint] = drive_load(base_url, endpoint, args.requests, args.concurrency,
+                                         images, tokens, endpoint_recorder, args.profile)
+        print(f"  ✅ {endpoint}: {args.requests} request trong {durations[endpoint]:.1f} giây")
+
+    jobs = wait_for_jobs(args.job_timeout) if args.upload_async and "upload" in endpoints else None
+    server.shutdown()
+    auth_server.stop()
+
+    endpoint_report = {}
+    for endpoint, stats in endpoint_recorder.report().items():
+        seconds = durations.get(endpoint)
+        stats["throughput_per_sec"] = round(stats["count"] / seconds, 2) if seconds else 0.0
+        endpoint_report[endpoint] = stats
+
+    result = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_commit": git_commit(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "sample_images": len(images),
+        },
+        "endpoints": endpoint_report,
+        "stages": recorder.report(),
+        "scheduler": scheduler.stats(),
+        "cache": prediction_cache.stats(),
+        "storage": get_upload_pool().stats(),
+        "jobs": jobs,
+        "fakes": {"db_requests": db.request_count, "auth_requests": auth_server.stats["requests"]},
+    }
+
+    print_table("🌐 Endpoint (ms)", result["endpoints"])
+    print_table("🧩 Bước pipeline (ms)", result["stages"])
+
+    output = args.output or os.path.join(RESULTS_DIR, f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Đã ghi kết quả: {output}")
+
+    if args.compare:
+        compare(result, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
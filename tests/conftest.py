@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Chạy pytest từ thư mục gốc: import được ai_server/backend như khi chạy `python -m`
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
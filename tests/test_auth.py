@@ -0,0 +1,207 @@
+import time
+
+import pytest
+
+jwt = pytest.importorskip("jwt")
+pytest.importorskip("requests")
+
+from backend import auth
+
+SECRET = "test-jwt-secret-with-enough-length-for-hs256"
+AUDIENCE = "authenticated"
+USER_ID = "7d3f1c2e-0000-4000-8000-000000000001"
+
+# Giữ hàm thật trước khi fixture autouse thay bằng hàm báo lỗi
+REAL_FETCH_USER_REMOTE = auth.fetch_user_remote
+
+
+def mint(secret=SECRET, **overrides):
+    """Token HS256 giống access token Supabase, ký tại chỗ."""
+    now = int(time.time())
+    claims = {
+        "sub": USER_ID,
+        "aud": AUDIENCE,
+        "role": "authenticated",
+        "email": "user@example.com",
+        "iat": now,
+        "exp": now + 3600,
+    }
+    claims.update(overrides)
+    return jwt.encode(claims, secret, algorithm="HS256")
+
+
+@pytest.fixture(autouse=True)
+def local_auth(monkeypatch):
+    monkeypatch.setattr(auth, "SUPABASE_JWT_SECRET", SECRET)
+    monkeypatch.setattr(auth, "SUPABASE_JWT_AUDIENCE", AUDIENCE)
+    monkeypatch.setattr(auth, "SUPABASE_JWKS_URL", None)
+    monkeypatch.setattr(auth, "AUTH_REMOTE_FALLBACK", True)
+    monkeypatch.setattr(auth, "token_cache", auth.TokenCache(max_size=16, ttl=300))
+
+    def no_remote(access_token):
+        raise AssertionError("Không được gọi /auth/v1/user khi xác thực được tại chỗ")
+
+    monkeypatch.setattr(auth, "fetch_user_remote", no_remote)
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.calls.append((url, headers))
+        return self.response
+
+
+# ==========================================================
+# 🔐 XÁC THỰC TẠI CHỖ
+# ==========================================================
+def test_valid_token_is_verified_locally():
+    user = auth.get_user_from_token(mint())
+
+    assert user["id"] == USER_ID
+    assert user["aud"] == AUDIENCE
+    assert user["email"] == "user@example.com"
+
+
+def test_expired_token_is_rejected():
+    now = int(time.time())
+    token = mint(iat=now - 7200, exp=now - 600)
+
+    with pytest.raises(PermissionError):
+        auth.get_user_from_token(token)
+
+
+def test_wrong_audience_is_rejected():
+    with pytest.raises(PermissionError):
+        auth.get_user_from_token(mint(aud="anon"))
+
+
+def test_bad_signature_is_rejected():
+    token = mint(secret="another-secret-that-supabase-never-issued-xx")
+
+    with pytest.raises(PermissionError):
+        auth.get_user_from_token(token)
+
+
+def test_token_without_sub_is_rejected():
+    token = mint()
+    claims = jwt.decode(token, SECRET, algorithms=["HS256"], audience=AUDIENCE)
+    del claims["sub"]
+
+    with pytest.raises(PermissionError):
+        auth.get_user_from_token(jwt.encode(claims, SECRET, algorithm="HS256"))
+
+
+# ==========================================================
+# 🗃️ CACHE KHÔNG SỐNG QUÁ exp
+# ==========================================================
+def test_cache_entry_never_outlives_token_exp(monkeypatch):
+    now = 1_000_000.0
+    monkeypatch.setattr(auth.time, "time", lambda: now)
+    cache = auth.TokenCache(max_size=4, ttl=300)
+
+    cache.put("token", {"id": USER_ID}, token_exp=now + 10)
+    assert cache.get("token") == {"id": USER_ID}
+
+    monkeypatch.setattr(auth.time, "time", lambda: now + 10)
+    assert cache.get("token") is None
+
+
+def test_cache_entry_expires_after_ttl(monkeypatch):
+    now = 1_000_000.0
+    monkeypatch.setattr(auth.time, "time", lambda: now)
+    cache = auth.TokenCache(max_size=4, ttl=30)
+
+    cache.put("token", {"id": USER_ID}, token_exp=now + 3600)
+    monkeypatch.setattr(auth.time, "time", lambda: now + 31)
+    assert cache.get("token") is None
+
+
+def test_already_expired_token_is_not_cached():
+    cache = auth.TokenCache(max_size=4, ttl=300)
+    cache.put("token", {"id": USER_ID}, token_exp=time.time() - 1)
+
+    assert cache.get("token") is None
+
+
+def test_verified_token_is_cached_until_exp_at_most():
+    exp = int(time.time()) + 20
+    token = mint(exp=exp)
+
+    auth.get_user_from_token(token)
+
+    entries = list(auth.token_cache._entries.values())
+    assert len(entries) == 1
+    assert entries[0][1] <= exp
+    # Lần sau lấy từ cache, không cần xác thực lại
+    assert auth.get_user_from_token(token)["id"] == USER_ID
+
+
+def test_cache_is_bounded():
+    cache = auth.TokenCache(max_size=2, ttl=300)
+    exp = time.time() + 3600
+    for name in ("a", "b", "c"):
+        cache.put(name, {"id": name}, token_exp=exp)
+
+    assert cache.get("a") is None
+    assert cache.get("b") == {"id": "b"}
+    assert cache.get("c") == {"id": "c"}
+
+
+# ==========================================================
+# 🌐 FALLBACK /auth/v1/user
+# ==========================================================
+@pytest.fixture
+def remote_session(monkeypatch):
+    """Không có khóa để xác thực tại chỗ: dùng fetch_user_remote thật với session giả."""
+    monkeypatch.setattr(auth, "SUPABASE_JWT_SECRET", None)
+    monkeypatch.setattr(auth, "SUPABASE_URL", "https://project.supabase.co")
+    monkeypatch.setattr(auth, "SUPABASE_API_KEY", "anon-key")
+    monkeypatch.setattr(auth, "fetch_user_remote", REAL_FETCH_USER_REMOTE)
+
+    session = FakeSession(FakeResponse(200, {"id": USER_ID, "aud": AUDIENCE}))
+    monkeypatch.setattr(auth, "get_session", lambda: session)
+    return session
+
+
+def test_remote_fallback_without_local_key(remote_session):
+    token = mint()
+
+    user = auth.get_user_from_token(token)
+
+    assert user["id"] == USER_ID
+    assert len(remote_session.calls) == 1
+    url, headers = remote_session.calls[0]
+    assert url == "https://project.supabase.co/auth/v1/user"
+    assert headers["Authorization"] == f"Bearer {token}"
+    assert headers["apikey"] == "anon-key"
+
+    # Kết quả remote cũng được cache (theo exp của token)
+    auth.get_user_from_token(token)
+    assert len(remote_session.calls) == 1
+
+
+def test_remote_fallback_rejects_invalid_token(remote_session):
+    remote_session.response = FakeResponse(401)
+
+    with pytest.raises(PermissionError):
+        auth.get_user_from_token(mint())
+
+
+def test_remote_fallback_can_be_disabled(remote_session, monkeypatch):
+    monkeypatch.setattr(auth, "AUTH_REMOTE_FALLBACK", False)
+
+    with pytest.raises(RuntimeError):
+        auth.get_user_from_token(mint())
+    assert remote_session.calls == []
@@ -0,0 +1,140 @@
+import pytest
+
+from ai_server import encoding
+
+PREDICTIONS = [
+    {"category_id": 1, "model_id": 3, "confidence": 0.9731, "bbox": [12.4, 40.0, 310.6, 255.2]},
+    {"category_id": 4, "model_id": 3, "confidence": 0.5, "bbox": [0, 0, 1920, 1080]},
+    {"category_id": 2, "model_id": 3, "confidence": 0.12345, "bbox": [-3.0, 5.5, 70000.0, 8.49]},
+]
+PAYLOAD = {"image_id": 42, "file_path": "https://example.com/a.jpg", "predictions": PREDICTIONS}
+NAMES = {1: "Nhựa", 2: "Giấy", 4: "Kim loại"}
+
+
+def expected(predictions, names=None):
+    """Giá trị sau khi qua dạng compact: bbox làm tròn về pixel uint16, confidence 4 chữ số."""
+    result = []
+    for p in predictions:
+        item = {
+            "category_id": p["category_id"],
+            "model_id": p["model_id"],
+            "confidence": encoding._clamp_uint16(p["confidence"] * encoding.CONFIDENCE_SCALE)
+                          / encoding.CONFIDENCE_SCALE,
+            "bbox": [float(encoding._clamp_uint16(v)) for v in p["bbox"]],
+        }
+        if names is not None:
+            item["category_name"] = names.get(p["category_id"])
+        result.append(item)
+    return result
+
+
+@pytest.fixture
+def without_msgpack(monkeypatch):
+    monkeypatch.setattr(encoding, "msgpack", None)
+
+
+# ==========================================================
+# 🔁 ENCODE → DECODE → EXPAND
+# ==========================================================
+def test_json_round_trip_is_lossless():
+    body, content_type = encoding.encode(PAYLOAD, encoding.JSON)
+
+    assert content_type == "application/json"
+    assert encoding.decode(body, content_type) == PAYLOAD
+
+
+def test_compact_json_round_trip():
+    body, content_type = encoding.encode(PAYLOAD, encoding.COMPACT, categories_etag="abc")
+
+    assert isinstance(body, str)
+    assert content_type.startswith(encoding.MEDIA_TYPES[encoding.COMPACT])
+    decoded = encoding.decode(body, content_type, NAMES)
+    assert decoded["image_id"] == 42
+    assert decoded["file_path"] == PAYLOAD["file_path"]
+    assert "boxes" not in decoded and "categories_etag" not in decoded
+    assert decoded["predictions"] == expected(PREDICTIONS, NAMES)
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip("msgpack")
+    body, content_type = encoding.encode(PAYLOAD, encoding.MSGPACK)
+
+    assert isinstance(body, bytes)
+    assert content_type == encoding.MEDIA_TYPES[encoding.MSGPACK]
+    decoded = encoding.decode(body, content_type)
+    assert decoded["image_id"] == 42
+    assert decoded["predictions"] == expected(PREDICTIONS)
+
+
+def test_msgpack_packs_boxes_as_uint16_bytes():
+    msgpack = pytest.importorskip("msgpack")
+    body, _ = encoding.encode(PAYLOAD, encoding.MSGPACK)
+
+    boxes = msgpack.unpackb(body, raw=False)["boxes"]
+    assert boxes["n"] == 3
+    assert boxes["model_id"] == 3
+    assert len(boxes["conf"]) == 2 * 3
+    assert len(boxes["xyxy"]) == 2 * 4 * 3
+    assert encoding.expand_predictions(boxes) == expected(PREDICTIONS)
+
+
+def test_mixed_model_ids_are_kept_per_box():
+    predictions = [dict(PREDICTIONS[0]), dict(PREDICTIONS[1], model_id=5)]
+
+    boxes = encoding.compact_predictions(predictions)
+
+    assert boxes["model_id"] == [3, 5]
+    assert [p["model_id"] for p in encoding.expand_predictions(boxes)] == [3, 5]
+
+
+def test_empty_predictions_round_trip():
+    payload = {"image_id": 1, "predictions": []}
+    body, content_type = encoding.encode(payload, encoding.COMPACT)
+
+    assert encoding.decode(body, content_type)["predictions"] == []
+
+
+# ==========================================================
+# 🤝 NEGOTIATE: ?format= VÀ ACCEPT
+# ==========================================================
+@pytest.mark.parametrize("accept, requested, result", [
+    (None, None, encoding.JSON),
+    ("", "", encoding.JSON),
+    ("*/*", None, encoding.JSON),
+    ("application/json", None, encoding.JSON),
+    ("application/vnd.waste.compact+json", None, encoding.COMPACT),
+    ("text/html, application/vnd.waste.compact+json;q=0.5", None, encoding.COMPACT),
+    ("application/json;q=0.5, application/vnd.waste.compact+json", None, encoding.COMPACT),
+    ("application/vnd.waste.compact+json;q=0, application/json", None, encoding.JSON),
+    ("application/vnd.waste.compact+json;q=abc", None, encoding.JSON),
+    ("application/vnd.waste.compact+json", "json", encoding.JSON),
+    ("application/json", "compact", encoding.COMPACT),
+    (None, " Compact ", encoding.COMPACT),
+    ("application/vnd.waste.compact+json", "xml", encoding.COMPACT),
+])
+def test_negotiate(accept, requested, result):
+    assert encoding.negotiate(accept, requested) == result
+
+
+@pytest.mark.parametrize("accept, requested", [
+    ("application/vnd.waste.compact+msgpack", None),
+    ("application/x-msgpack;q=0.9, application/json;q=0.1", None),
+    ("application/msgpack", None),
+    (None, "msgpack"),
+])
+def test_negotiate_msgpack_when_installed(accept, requested):
+    pytest.importorskip("msgpack")
+
+    assert encoding.negotiate(accept, requested) == encoding.MSGPACK
+
+
+def test_requested_msgpack_falls_back_to_compact_when_missing(without_msgpack):
+    assert encoding.negotiate("application/json", "msgpack") == encoding.COMPACT
+
+
+def test_accept_msgpack_skipped_when_missing(without_msgpack):
+    accept = "application/vnd.waste.compact+msgpack, application/vnd.waste.compact+json;q=0.8"
+
+    assert encoding.negotiate(accept) == encoding.COMPACT
+    assert encoding.negotiate("application/x-msgpack") == encoding.JSON
+    assert not encoding.available(encoding.MSGPACK)
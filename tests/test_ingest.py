@@ -0,0 +1,131 @@
+import io
+import os
+import struct
+
+import pytest
+
+from ai_server import ingest
+
+
+@pytest.fixture
+def spill_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "INGEST_SPILL_DIR", str(tmp_path))
+    monkeypatch.setattr(ingest, "INGEST_SPILL_BYTES", 16)
+    return tmp_path
+
+
+def test_small_parts_stay_in_memory(spill_dir):
+    stream = ingest.ingest_stream_factory(10, "image/jpeg", "a.jpg")
+
+    assert isinstance(stream, io.BytesIO)
+    assert os.listdir(spill_dir) == []
+
+
+def test_cleanup_removes_every_spilled_part(spill_dir):
+    # Ví dụ: part không tên "file", part thừa, hoặc lỗi trước khi ingest_upload
+    streams = [ingest.ingest_stream_factory(1024, "image/jpeg", name) for name in ("a.jpg", "b.png")]
+    for stream in streams:
+        stream.write(b"x" * 100)
+    assert len(os.listdir(spill_dir)) == 2
+
+    ingest.cleanup_spilled(streams)
+
+    assert os.listdir(spill_dir) == []
+    assert all(stream.closed for stream in streams)
+
+
+def test_cleanup_keeps_file_handed_to_job(spill_dir):
+    handed, unused = (ingest.ingest_stream_factory(1024, "image/jpeg", "a.jpg") for _ in range(2))
+
+    ingest.cleanup_spilled([handed, unused], keep=[handed.name])
+
+    assert os.listdir(spill_dir) == [os.path.basename(handed.name)]
+
+
+def test_cleanup_ignores_files_already_removed(spill_dir):
+    stream = ingest.ingest_stream_factory(1024, "image/jpeg", "a.jpg")
+    image = ingest.IngestedImage("a.jpg", "image/jpeg", path=stream.name)
+    image.cleanup()
+
+    ingest.cleanup_spilled([stream])
+
+    assert os.listdir(spill_dir) == []
+
+
+# ==========================================================
+# 🧭 EXIF ORIENTATION
+# ==========================================================
+def exif_segment(orientation, order="<"):
+    """APP1 Exif chỉ có IFD0 với một tag Orientation."""
+    mark = b"II" if order == "<" else b"MM"
+    tiff = mark + struct.pack(order + "HI", 42, 8)
+    tiff += struct.pack(order + "H", 1)
+    tiff += struct.pack(order + "HHIHH", 0x0112, 3, 1, orientation, 0)
+    tiff += struct.pack(order + "I", 0)
+    payload = b"Exif\x00\x00" + tiff
+    return b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+
+
+def with_exif(jpeg, orientation, order="<"):
+    """Chèn APP1 Exif ngay sau SOI của một JPEG."""
+    return jpeg[:2] + exif_segment(orientation, order) + jpeg[2:]
+
+
+JFIF = b"\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+HEADER = b"\xff\xd8" + JFIF + b"\xff\xda\x00\x02"
+
+
+@pytest.mark.parametrize("order", ["<", ">"])
+@pytest.mark.parametrize("orientation", range(1, 9))
+def test_exif_orientation_is_read_after_other_segments(orientation, order):
+    assert ingest.exif_orientation(with_exif(HEADER, orientation, order)) == orientation
+    # APP1 nằm sau APP0 (JFIF)
+    head = HEADER[:2] + JFIF + exif_segment(orientation, order) + HEADER[2 + len(JFIF):]
+    assert ingest.exif_orientation(head) == orientation
+
+
+@pytest.mark.parametrize("data", [b"", b"\x89PNG\r\n\x1a\n", HEADER, b"\xff\xd8\xff\xe1\x00"])
+def test_exif_orientation_defaults_to_upright(data):
+    assert ingest.exif_orientation(data) == 1
+
+
+def test_apply_orientation_matches_exif_transforms():
+    np = pytest.importorskip("numpy")
+    stored = np.arange(6).reshape(2, 3)  # [[0, 1, 2], [3, 4, 5]]
+
+    expected = {
+        1: [[0, 1, 2], [3, 4, 5]],
+        2: [[2, 1, 0], [5, 4, 3]],
+        3: [[5, 4, 3], [2, 1, 0]],
+        4: [[3, 4, 5], [0, 1, 2]],
+        5: [[0, 3], [1, 4], [2, 5]],
+        6: [[3, 0], [4, 1], [5, 2]],
+        7: [[5, 2], [4, 1], [3, 0]],
+        8: [[2, 5], [1, 4], [0, 3]],
+    }
+    for orientation, rows in expected.items():
+        result = ingest.apply_orientation(stored, orientation)
+        assert result.tolist() == rows, orientation
+        assert result.flags["C_CONTIGUOUS"]
+
+
+def test_rotated_jpeg_is_decoded_upright(spill_dir):
+    cv2 = pytest.importorskip("cv2")
+    np = pytest.importorskip("numpy")
+    # Ảnh lưu 40x80 (cao x rộng), ô sáng ở góc trên-trái; Orientation=6 => hiển thị 80x40
+    stored = np.zeros((40, 80, 3), dtype=np.uint8)
+    stored[:20, :20] = 255
+    ok, buffer = cv2.imencode(".jpg", stored)
+    assert ok
+    data = with_exif(buffer.tobytes(), 6)
+
+    in_memory = ingest.IngestedImage("a.jpg", "image/jpeg", data=data).array
+    path = spill_dir / "rotated.jpg"
+    path.write_bytes(data)
+    on_disk = ingest.IngestedImage("a.jpg", "image/jpeg", path=str(path)).array
+
+    for array in (in_memory, on_disk):
+        assert array.shape[:2] == (80, 40)
+        # Xoay 90° theo chiều kim đồng hồ: góc trên-trái chuyển sang góc trên-phải
+        assert array[:20, 20:].mean() > 200
+        assert array[:20, :20].mean() < 50
@@ -0,0 +1,108 @@
+import time
+
+import pytest
+
+from ai_server.job_queue import JobQueue
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "jobs.sqlite3")
+
+
+def make_queue(path, handler=None, **kwargs):
+    return JobQueue({"upload": handler or (lambda job: None)}, path=path, workers=1, name="test", **kwargs)
+
+
+def add_job(queue):
+    """enqueue() khởi động worker; ở đây chèn thẳng để tự điều khiển việc nhận job."""
+    now = time.time()
+    return queue._execute(
+        "INSERT INTO jobs (kind, image_id, payload, state, next_run_at, created_at, updated_at) "
+        "VALUES ('upload', 1, '{}', 'pending', ?, ?, ?)",
+        (now, now, now),
+    ).lastrowid
+
+
+def state(queue, job_id):
+    return dict(queue._fetchall("SELECT state, owner, attempts FROM jobs WHERE job_id = ?", (job_id,))[0])
+
+
+# ==========================================================
+# 🔒 LEASE GIỮA CÁC PROCESS
+# ==========================================================
+def test_recover_keeps_jobs_leased_by_a_live_process(path):
+    owner, other = make_queue(path), make_queue(path)
+    job_id = add_job(owner)
+
+    job, _ = owner._claim()
+    assert job.job_id == job_id
+
+    # Một process khác khởi động (worker gunicorn, process con) không được lấy lại job đang chạy
+    assert other.recover() == 0
+    assert state(other, job_id)["state"] == "running"
+    assert state(other, job_id)["owner"] == owner.owner
+
+
+def test_recover_reclaims_expired_lease(path):
+    owner, other = make_queue(path), make_queue(path)
+    job_id = add_job(owner)
+    owner._claim()
+
+    owner._execute("UPDATE jobs SET lease_until = ? WHERE job_id = ?", (time.time() - 1, job_id))
+
+    assert other.recover() == 1
+    assert state(other, job_id)["state"] == "pending"
+    assert state(other, job_id)["owner"] is None
+
+
+def test_recover_reclaims_running_jobs_without_lease(path):
+    queue = make_queue(path)
+    job_id = add_job(queue)
+    queue._execute("UPDATE jobs SET state = 'running' WHERE job_id = ?", (job_id,))
+
+    assert queue.recover() == 1
+    assert state(queue, job_id)["state"] == "pending"
+
+
+def test_renew_extends_only_own_leases(path):
+    owner, other = make_queue(path), make_queue(path)
+    job_id = add_job(owner)
+    owner._claim()
+    owner._execute("UPDATE jobs SET lease_until = ? WHERE job_id = ?", (time.time() + 1, job_id))
+
+    other._renew_leases()
+    assert owner._fetchall("SELECT lease_until FROM jobs")[0]["lease_until"] < time.time() + 2
+
+    owner._renew_leases()
+    assert owner._fetchall("SELECT lease_until FROM jobs")[0]["lease_until"] > time.time() + 30
+
+
+def test_result_of_lost_lease_is_discarded(path):
+    owner, other = make_queue(path), make_queue(path)
+    job_id = add_job(owner)
+    job, _ = owner._claim()
+
+    # Lease hết hạn, process khác đã nhận lại và đang chạy job
+    owner._execute("UPDATE jobs SET lease_until = ? WHERE job_id = ?", (time.time() - 1, job_id))
+    other.recover()
+    other._claim()
+
+    owner._run_job(job)
+
+    assert state(owner, job_id) == {"state": "running", "owner": other.owner, "attempts": 2}
+
+
+def test_worker_runs_job_to_done(path):
+    seen = []
+    queue = make_queue(path, handler=lambda job: seen.append(job.job_id))
+    try:
+        job_id = queue.enqueue("upload", {}, image_id=1)
+        deadline = time.monotonic() + 5
+        while state(queue, job_id)["state"] != "done" and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        queue.stop(timeout=5)
+
+    assert seen == [job_id]
+    assert state(queue, job_id) == {"state": "done", "owner": None, "attempts": 1}
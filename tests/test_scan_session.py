@@ -0,0 +1,48 @@
+import json
+import threading
+import time
+
+from ai_server.scan_session import ScanSession
+
+
+class ExclusiveSend:
+    """send giả: ghi nhận nếu hai thread cùng gửi một lúc (WebSocket không cho phép)."""
+
+    def __init__(self):
+        self.messages = []
+        self.overlaps = 0
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, frame):
+        with self._lock:
+            self._active += 1
+            if self._active > 1:
+                self.overlaps += 1
+        time.sleep(0.001)
+        with self._lock:
+            self._active -= 1
+            self.messages.append(json.loads(frame))
+
+
+def test_results_and_control_replies_are_never_sent_concurrently():
+    send = ExclusiveSend()
+    session = ScanSession(lambda image, profile: {"predictions": []}, send, max_fps=0).start()
+    try:
+        def control():
+            for _ in range(50):
+                session.handle_control('{"type": "stats"}')
+
+        thread = threading.Thread(target=control)
+        thread.start()
+        for _ in range(50):
+            session.push_frame(b"frame")
+            time.sleep(0.001)
+        thread.join()
+        time.sleep(0.1)
+    finally:
+        session.close()
+
+    assert send.overlaps == 0
+    kinds = {message["type"] for message in send.messages}
+    assert kinds == {"stats", "result"}